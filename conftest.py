@@ -0,0 +1,24 @@
+from typing import Callable, Optional
+
+import pytest
+
+from utils.models import User
+
+
+@pytest.fixture
+def make_user() -> Callable[..., User]:
+    """Builds a User with only the columns the tests care about."""
+
+    def make(fid: int, address: Optional[str], registered_at: int = 0) -> User:
+        return User(
+            fid=fid,
+            display_name=f"user {fid}",
+            following_count=0,
+            follower_count=0,
+            verified=0,
+            generated_farcaster_address="",
+            address=address,
+            registered_at=registered_at,
+        )
+
+    return make
@@ -1,5 +1,6 @@
 import os
 import time
+from functools import partial
 from typing import Any, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
@@ -9,6 +10,7 @@ from sqlalchemy.orm import sessionmaker
 from utils.fetcher import SyncFetcher
 from utils.models import Cast
 from utils.utils import save_casts_to_sqlite
+from utils.writer import DatabaseWriter, shared_writer
 
 
 class WarpcastCastFetcher(SyncFetcher):
@@ -116,13 +118,15 @@ class WarpcastCastFetcher(SyncFetcher):
 load_dotenv()
 
 
-def main(engine: Engine):
+def main(engine: Engine, writer: Optional[DatabaseWriter] = None):
     warpcast_hub_key = os.getenv("WARPCAST_HUB_KEY")
 
     if not warpcast_hub_key:
         raise Exception("WARPCAST_HUB_KEY not found in .env file.")
 
-    with sessionmaker(bind=engine)() as session:
+    with shared_writer(engine, writer) as database_writer, sessionmaker(
+        bind=engine
+    )() as session:
         latest_cast = session.query(Cast).order_by(Cast.timestamp.desc()).first()
         latest_timestamp = latest_cast.timestamp if latest_cast else 0
         print(latest_timestamp)
@@ -131,4 +135,6 @@ def main(engine: Engine):
             key=warpcast_hub_key, latest_timestamp=latest_timestamp
         )
         data = fetcher.fetch()
-        save_casts_to_sqlite(session, data, latest_timestamp)
+        database_writer.write(
+            partial(save_casts_to_sqlite, casts=data, timestamp=latest_timestamp)
+        )
@@ -1,49 +1,198 @@
 import asyncio
-from typing import Any, Dict, List
+import os
+import re
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
 
+import aiohttp
+from sqlalchemy import func, or_
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session, sessionmaker
 
 from utils.fetcher import AsyncFetcher
 from utils.models import ENSData, User
 from utils.utils import save_objects
+from utils.writer import DatabaseWriter, shared_writer
+
+# ENS ReverseRecords helper contract: resolves the reverse records of many
+# addresses in one eth_call, and only returns names that forward resolve
+# back to the address.
+REVERSE_RECORDS_ADDRESS = "0x3671aE578E63FdF66ad4F3E12CC0c0d71Ac7510C"
+GET_NAMES_SELECTOR = "cbf8b66c"  # getNames(address[])
+
+ADDRESS_PATTERN = re.compile(r"^0x[0-9a-fA-F]{40}$")
+
+
+def encode_get_names_call(addresses: List[str]) -> str:
+    """ABI encodes a getNames(address[]) call."""
+    words = [f"{32:064x}", f"{len(addresses):064x}"]
+    words += [address[2:].lower().rjust(64, "0") for address in addresses]
+    return "0x" + GET_NAMES_SELECTOR + "".join(words)
+
+
+def decode_string_array(data: str) -> List[str]:
+    """ABI decodes a string[] return value."""
+    raw = bytes.fromhex(data[2:])
+
+    def word(offset: int) -> int:
+        return int.from_bytes(raw[offset : offset + 32], "big")  # noqa: E203
+
+    array_start = word(0)
+    count = word(array_start)
+    # String offsets are relative to the first word after the array length
+    items_start = array_start + 32
+    names = []
+    for i in range(count):
+        string_start = items_start + word(items_start + 32 * i)
+        length = word(string_start)
+        value = raw[string_start + 32 : string_start + 32 + length]  # noqa: E203
+        names.append(value.decode("utf-8", errors="replace"))
+    return names
+
+
+class ReverseRecordsResolver(AsyncFetcher):
+    """
+    Resolves the primary ENS names of many addresses through the Alchemy
+    JSON-RPC endpoint: `chunk_size` addresses per eth_call and
+    `calls_per_request` eth_calls per JSON-RPC batch request.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        addresses: List[str],
+        chunk_size: int = 200,
+        calls_per_request: int = 10,
+    ):
+        self.base_url = f"https://eth-mainnet.g.alchemy.com/v2/{key}"
+        self.addresses = addresses
+        self.chunk_size = chunk_size
+        self.calls_per_request = calls_per_request
+        self.names: Dict[str, Optional[str]] = {}
+
+    def _chunks(self) -> List[List[str]]:
+        valid = [
+            address for address in self.addresses if ADDRESS_PATTERN.match(address)
+        ]
+        return [
+            valid[i : i + self.chunk_size]  # noqa: E203
+            for i in range(0, len(valid), self.chunk_size)
+        ]
+
+    async def _resolve_batch(self, chunks: List[List[str]]) -> None:
+        payload = [
+            {
+                "jsonrpc": "2.0",
+                "id": i,
+                "method": "eth_call",
+                "params": [
+                    {
+                        "to": REVERSE_RECORDS_ADDRESS,
+                        "data": encode_get_names_call(chunk),
+                    },
+                    "latest",
+                ],
+            }
+            for i, chunk in enumerate(chunks)
+        ]
+        responses = await self._make_async_request_with_retry(
+            self.base_url,
+            headers={"Content-Type": "application/json"},
+            data=payload,
+            method="POST",
+            delay=2,
+            timeout=30,
+        )
+        for response in responses or []:
+            # Chunks that failed are left out and retried on the next run
+            if "result" not in response:
+                print(f"Failed to resolve ENS names: {response.get('error')}")
+                continue
+            self.names.update(self._extract_data((chunks[response["id"]], response)))
+
+    async def _fetch_data(self) -> None:
+        chunks = self._chunks()
+        batches = [
+            chunks[i : i + self.calls_per_request]  # noqa: E203
+            for i in range(0, len(chunks), self.calls_per_request)
+        ]
+        await asyncio.gather(*[self._resolve_batch(batch) for batch in batches])
+
+    def _extract_data(
+        self, data: Tuple[List[str], Dict[str, Any]]
+    ) -> Dict[str, Optional[str]]:
+        """Names of the addresses of a chunk, from its eth_call response."""
+        chunk, response = data
+        names = decode_string_array(response["result"])
+        return {address: name or None for address, name in zip(chunk, names)}
+
+    def _get_models(self) -> Dict[str, Optional[str]]:
+        return self.names
+
+    async def fetch(self) -> Dict[str, Optional[str]]:
+        """ENS name of every resolved address, None if it has none."""
+        await self._fetch_data()
+        return self._get_models()
 
 
 class EnsdataFetcher(AsyncFetcher):
     addresses: List[str] = []
-    json_data: List[Dict[str, Any]] = []
+    json_data: Dict[str, Optional[Dict[str, Any]]] = {}
+    max_retries = 3
+    retry_delay = 5
 
     def __init__(self, addresses: List[str]):
         self.addresses = addresses
 
     async def _fetch_data(self):
         users = await self._get_users_from_ensdata(self.addresses)
-        self.json_data = users
+        # By requested address, the address in the data may be missing
+        self.json_data = dict(zip(self.addresses, users))
 
     def _get_models(self) -> List[ENSData]:
-        extracted_users = [self._extract_data(user) for user in self.json_data]
-        return extracted_users
+        """
+        A row for every address ensdata.net answered for, without records
+        when it has none. Addresses whose requests failed are left out, so
+        the next run retries them.
+        """
+        return [
+            self._extract_data({**data, "address": address})
+            for address, data in self.json_data.items()
+            if data is not None
+        ]
 
-    async def _get_single_user_from_ensdata(self, address: str) -> Dict[str, Any]:
+    async def _get_single_user_from_ensdata(
+        self, address: str
+    ) -> Optional[Dict[str, Any]]:
+        """The data of `address`, empty when it has none, None on failure."""
         url = f"https://ensdata.net/{address}"
-        json_data = await self._make_async_request_with_retry(
-            url, max_retries=3, delay=5, timeout=10
-        )
-        return json_data if json_data else None
+        for _ in range(self.max_retries):
+            try:
+                return await self._make_async_request(url, timeout=10) or {}
+            except aiohttp.ClientResponseError as e:
+                # ensdata.net answers 404 for addresses without records
+                if e.status == 404:
+                    return {}
+                print(f"Error occurred for URL {url}. Error: {e}. Retrying...")
+            except asyncio.TimeoutError:
+                print(f"Timed out fetching {url}. Retrying...")
+            await asyncio.sleep(self.retry_delay)
+        print(f"Failed to fetch data from URL {url} after {self.max_retries} attempts.")
+        return None
 
     async def _get_users_from_ensdata(
         self, addresses: List[str]
-    ) -> List[Dict[str, Any]]:
+    ) -> List[Optional[Dict[str, Any]]]:
         tasks = [
             asyncio.create_task(self._get_single_user_from_ensdata(address))
             for address in addresses
         ]
-        users = await asyncio.gather(*tasks)
-        return list(filter(None, users))
+        return await asyncio.gather(*tasks)
 
     def _extract_data(self, data: Dict[str, Any]) -> ENSData:
         return ENSData(
-            address=data.get("address"),
+            address=data["address"],
             ens=data.get("ens"),
             url=data.get("url"),
             github=data.get("github"),
@@ -51,6 +200,7 @@ class EnsdataFetcher(AsyncFetcher):
             telegram=data.get("telegram"),
             email=data.get("email"),
             discord=data.get("discord"),
+            fetched_at=int(time.time() * 1000),
         )
 
     async def fetch(self):
@@ -58,24 +208,89 @@ class EnsdataFetcher(AsyncFetcher):
         return self._get_models()
 
 
-def get_users(session: Session) -> List[User]:
-    """Get all users with an address that is not in the database."""
-    return (
-        session.query(User)
+def get_addresses_to_refresh(session: Session, ttl: timedelta) -> List[str]:
+    """
+    The refresh queue: user addresses without ENS data first, then those
+    whose ENS data is older than `ttl`, least recently refreshed first.
+    """
+    stale_before = int((time.time() - ttl.total_seconds()) * 1000)
+    rows = (
+        session.query(User.address, func.max(ENSData.fetched_at))
+        .outerjoin(ENSData, ENSData.address == User.address)
         .filter(
             User.address.isnot(None),
-            ~User.address.in_(session.query(ENSData.address)),
+            or_(
+                ENSData.address.is_(None),
+                ENSData.fetched_at.is_(None),
+                ENSData.fetched_at < stale_before,
+            ),
         )
+        .group_by(User.address)
+        .order_by(func.coalesce(func.max(ENSData.fetched_at), -1))
         .all()
     )
+    # Only valid addresses can be resolved, the others would never leave
+    # the head of the queue
+    return [address for address, _ in rows if ADDRESS_PATTERN.match(address)]
 
 
-async def main(engine: Engine):
-    with sessionmaker(bind=engine)() as session:
-        addresses = [user.address for user in get_users(session)]
-
-        batch_size = 50
+async def refresh_ens_data(
+    key: Optional[str], addresses: List[str], batch_size: int = 50
+) -> List[ENSData]:
+    """
+    Resolves names in bulk over JSON-RPC, then fetches text records from
+    ensdata.net for the addresses that have a name. Without an Alchemy key
+    every address goes through ensdata.net. Addresses whose requests failed
+    are left out, to be retried by the next run.
+    """
+    if not key:
+        models = []
         for i in range(0, len(addresses), batch_size):
             batch = addresses[i : i + batch_size]  # noqa: E203
-            fetcher = EnsdataFetcher(batch)
-            save_objects(session, await fetcher.fetch())
+            models += await EnsdataFetcher(batch).fetch()
+        return models
+
+    names = await ReverseRecordsResolver(key, addresses).fetch()
+    named = [address for address, name in names.items() if name]
+
+    records = {}
+    for i in range(0, len(named), batch_size):
+        batch = named[i : i + batch_size]  # noqa: E203
+        for record in await EnsdataFetcher(batch).fetch():
+            records[record.address] = record
+
+    fetched_at = int(time.time() * 1000)
+    models = []
+    for address, name in names.items():
+        record = records.get(address)
+        if record is None:
+            if name:
+                # ensdata.net failed, keep the records stored until a retry
+                continue
+            record = ENSData(address=address, fetched_at=fetched_at)
+        # The name that forward resolves wins over ensdata.net's
+        record.ens = name
+        models.append(record)
+    return models
+
+
+async def main(
+    engine: Engine,
+    ttl_days: int = 7,
+    chunk_size: int = 1000,
+    writer: Optional[DatabaseWriter] = None,
+):
+    alchemy_api_key = os.getenv("ALCHEMY_API_KEY")
+    if not alchemy_api_key:
+        print("ALCHEMY_API_KEY is not set, resolving names one by one.")
+
+    with shared_writer(engine, writer) as database_writer, sessionmaker(
+        bind=engine
+    )() as session:
+        addresses = get_addresses_to_refresh(session, timedelta(days=ttl_days))
+        print(f"Refreshing ENS data of {len(addresses)} addresses...")
+
+        for i in range(0, len(addresses), chunk_size):
+            chunk = addresses[i : i + chunk_size]  # noqa: E203
+            models = await refresh_ens_data(alchemy_api_key, chunk)
+            await database_writer.run(lambda session: save_objects(session, models))
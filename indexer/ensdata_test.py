@@ -0,0 +1,146 @@
+import asyncio
+import time
+from datetime import timedelta
+
+import aiohttp
+import pytest
+from multidict import CIMultiDict, CIMultiDictProxy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from yarl import URL
+
+from indexer.ensdata import (
+    GET_NAMES_SELECTOR,
+    EnsdataFetcher,
+    ReverseRecordsResolver,
+    decode_string_array,
+    encode_get_names_call,
+    get_addresses_to_refresh,
+    refresh_ens_data,
+)
+from utils.models import Base, ENSData
+
+ALICE = "0x" + "a1" * 20
+BOB = "0x" + "b2" * 20
+CAROL = "0x" + "c3" * 20
+DAVE = "0x" + "d4" * 20
+
+
+@pytest.fixture
+def test_sessionmaker():
+    test_engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(test_engine)
+    return sessionmaker(bind=test_engine)
+
+
+def encode_string_array(values):
+    """What the ReverseRecords contract returns for getNames."""
+    words = [f"{32:064x}", f"{len(values):064x}"]
+    tails, offset = [], 32 * len(values)
+    for value in values:
+        data = value.encode()
+        words.append(f"{offset:064x}")
+        tail = f"{len(data):064x}" + data.hex().ljust(-(-len(data) // 32) * 64, "0")
+        tails.append(tail)
+        offset += len(tail) // 2
+    return "0x" + "".join(words + tails)
+
+
+def test_encode_get_names_call():
+    data = encode_get_names_call([ALICE, BOB.upper().replace("0X", "0x")])
+    assert data.startswith("0x" + GET_NAMES_SELECTOR)
+
+    words = data[10:]
+    assert len(words) == 64 * 4
+    assert int(words[0:64], 16) == 32
+    assert int(words[64:128], 16) == 2
+    assert words[128:192] == "0" * 24 + ALICE[2:]
+    assert words[192:256] == "0" * 24 + BOB[2:]
+
+
+def test_decode_string_array():
+    names = ["alice.eth", "", "a-much-longer-name-than-one-word-of-abi.eth"]
+    assert decode_string_array(encode_string_array(names)) == names
+
+
+def test_reverse_records_resolver_skips_failed_chunks(monkeypatch):
+    resolver = ReverseRecordsResolver("key", [ALICE, BOB, "not an address", CAROL])
+    resolver.chunk_size = 2
+
+    async def fake_request(url, data=None, **kwargs):
+        assert len(data) == 2
+        return [
+            {"id": 0, "result": encode_string_array(["alice.eth", ""])},
+            {"id": 1, "error": {"message": "execution reverted"}},
+        ]
+
+    monkeypatch.setattr(resolver, "_make_async_request_with_retry", fake_request)
+    names = asyncio.run(resolver.fetch())
+    assert names == {ALICE: "alice.eth", BOB: None}
+
+
+def test_ensdata_fetcher_skips_failed_requests(monkeypatch):
+    fetcher = EnsdataFetcher([ALICE, BOB, CAROL])
+    monkeypatch.setattr(fetcher, "retry_delay", 0)
+
+    async def fake_request(url, **kwargs):
+        if url.endswith(ALICE):
+            # ensdata.net may leave the address out
+            return {"ens": "alice.eth"}
+        status = 404 if url.endswith(BOB) else 429
+        request = aiohttp.RequestInfo(
+            URL(url), "GET", CIMultiDictProxy(CIMultiDict()), URL(url)
+        )
+        raise aiohttp.ClientResponseError(request, (), status=status)
+
+    monkeypatch.setattr(fetcher, "_make_async_request", fake_request)
+    models = asyncio.run(fetcher.fetch())
+    # Bob has no records, Carol's requests failed and are retried next run
+    assert [(model.address, model.ens) for model in models] == [
+        (ALICE, "alice.eth"),
+        (BOB, None),
+    ]
+    assert all(model.fetched_at for model in models)
+
+
+def test_refresh_ens_data_leaves_failed_addresses_out(monkeypatch):
+    async def resolve(self):
+        return {ALICE: "alice.eth", BOB: "bob.eth", CAROL: None}
+
+    async def fetch(self):
+        # ensdata.net failed for Bob
+        return [ENSData(address=ALICE, url="https://alice.example", fetched_at=1)]
+
+    monkeypatch.setattr(ReverseRecordsResolver, "fetch", resolve)
+    monkeypatch.setattr(EnsdataFetcher, "fetch", fetch)
+    models = asyncio.run(refresh_ens_data("key", [ALICE, BOB, CAROL]))
+    assert [(model.address, model.ens, model.url) for model in models] == [
+        (ALICE, "alice.eth", "https://alice.example"),
+        (CAROL, None, None),
+    ]
+
+
+def test_get_addresses_to_refresh(test_sessionmaker, make_user):
+    now = int(time.time() * 1000)
+    day = 24 * 3600 * 1000
+    with test_sessionmaker() as session:
+        session.add_all(
+            [
+                make_user(1, ALICE),
+                make_user(2, BOB),
+                make_user(3, CAROL),
+                make_user(4, DAVE),
+                make_user(5, None),
+                make_user(6, ALICE),
+                make_user(7, "not an address"),
+                ENSData(address=BOB, ens="bob.eth", fetched_at=now - day),
+                ENSData(address=CAROL, ens=None, fetched_at=now - 10 * day),
+                ENSData(address=DAVE, ens="dave.eth", fetched_at=None),
+            ]
+        )
+        session.commit()
+
+        addresses = get_addresses_to_refresh(session, timedelta(days=7))
+    assert len(addresses) == 3
+    assert set(addresses[:2]) == {ALICE, DAVE}
+    assert addresses[2] == CAROL
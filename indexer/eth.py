@@ -3,25 +3,97 @@ import csv
 import os
 import time
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple, Union
-
+from functools import partial
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import requests
 from dotenv import load_dotenv
-from sqlalchemy import not_
+from sqlalchemy import func
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session, sessionmaker
 
 from utils.fetcher import AsyncFetcher
-from utils.models import ERC1155Metadata, EthTransaction, User
+from utils.models import Cast, ERC1155Metadata, EthTransaction, User
+from utils.state import bump_data_versions
+from utils.utils import bulk_insert_ignore
+from utils.writer import DatabaseWriter, shared_writer
 
 load_dotenv()
 
+# Alchemy compute units charged per call, see
+# https://docs.alchemy.com/reference/compute-unit-costs
+ASSET_TRANSFERS_CU = 150
+BLOCK_NUMBER_CU = 10
+
+
+class ComputeUnitBudget:
+    """
+    Token bucket that keeps the Alchemy compute-unit spend under a
+    per-second budget. Every request awaits `spend` before it is sent.
+    """
+
+    def __init__(self, cu_per_second: int):
+        self.cu_per_second = cu_per_second
+        self.available = float(cu_per_second)
+        self.spent = 0
+        self.started_at = time.monotonic()
+        self._updated_at = self.started_at
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(
+            self.cu_per_second,
+            self.available + (now - self._updated_at) * self.cu_per_second,
+        )
+        self._updated_at = now
+
+    async def spend(self, cost: int) -> None:
+        # Waiters queue up on the lock, so requests are released in order
+        async with self._lock:
+            self._refill()
+            if self.available < cost:
+                await asyncio.sleep((cost - self.available) / self.cu_per_second)
+                self._refill()
+            self.available -= cost
+            self.spent += cost
+
+    def rate(self) -> float:
+        """Average compute units spent per second since creation."""
+        elapsed = time.monotonic() - self.started_at
+        return self.spent / elapsed if elapsed > 0 else 0.0
+
 
 class AlchemyTransactionFetcher(AsyncFetcher):
-    def __init__(self, key: str, addresses_blocknum: List[Tuple[str, int]]):
+    def __init__(
+        self,
+        key: str,
+        addresses_blocknum: List[Tuple[str, int]],
+        budget: Optional[ComputeUnitBudget] = None,
+    ):
         self.base_url = f"https://eth-mainnet.g.alchemy.com/v2/{key}"
         self.transactions: List[Dict[str, Any]] = []
         self.addresses_blocknum = addresses_blocknum
+        self.budget = budget
+
+    async def _spend(self, cost: int) -> None:
+        if self.budget is not None:
+            await self.budget.spend(cost)
 
     def _get_addresses(self) -> List[str]:
         return [address for address, _ in self.addresses_blocknum]
@@ -39,70 +111,79 @@ class AlchemyTransactionFetcher(AsyncFetcher):
             transaction for sublist in all_transactions for transaction in sublist
         ]
 
-    async def _fetch_data_for_address(self, address: str, latest_block_of_user: int):
-        transactions = []
-        page_key = None
-        while True:
-            headers = {"Content-Type": "application/json"}
+    async def _iter_pages(
+        self,
+        address: str,
+        latest_block_of_user: int,
+        to_block: Optional[int] = None,
+    ) -> AsyncIterator[Tuple[List[Dict[str, Any]], Optional[int]]]:
+        """
+        Yields the transfers of an address one API page at a time, so callers
+        can process them without holding the whole history as dicts, along
+        with the block a restart can resume from (None once done).
+
+        Incoming and outgoing transfers are paged independently since each
+        direction has its own page key. Transfers come in ascending block
+        order, so nothing before the lowest last-seen block of the unfinished
+        directions is missing.
+        """
+        headers = {"Content-Type": "application/json"}
+        page_keys: Dict[str, Optional[str]] = {}
+        last_blocks = {
+            "fromAddress": latest_block_of_user,
+            "toAddress": latest_block_of_user,
+        }
+        pending = ["fromAddress", "toAddress"]
 
-            to_payload = self._build_payload(
-                address=address,
-                latest_block_of_user=latest_block_of_user,
-                addr_type="toAddress",
-                page_key=page_key,
-            )
-            from_payload = self._build_payload(
+        async def fetch_page(addr_type: str) -> Dict[str, Any]:
+            payload = self._build_payload(
                 address=address,
                 latest_block_of_user=latest_block_of_user,
-                addr_type="fromAddress",
-                page_key=page_key,
+                addr_type=addr_type,
+                page_key=page_keys.get(addr_type),
+                to_block=to_block,
             )
-
-            from_response = await self._make_async_request_with_retry(
-                self.base_url,
-                headers=headers,
-                data=from_payload,
-                method="POST",
-                delay=2,
-            )
-            to_response = await self._make_async_request_with_retry(
-                self.base_url, headers=headers, data=to_payload, method="POST", delay=2
+            await self._spend(ASSET_TRANSFERS_CU)
+            response = await self._make_async_request_with_retry(
+                self.base_url, headers=headers, data=payload, method="POST", delay=2
             )
+            if not response or "result" not in response:
+                raise ValueError(f"Failed to fetch {addr_type} transfers of {address}")
+            return response["result"]
+
+        while pending:
+            results = await asyncio.gather(*[fetch_page(t) for t in pending])
+
+            transfers: List[Dict[str, Any]] = []
+            for addr_type, result in zip(list(pending), results):
+                page = result.get("transfers", [])
+                transfers += page
+                if page:
+                    last_blocks[addr_type] = int(page[-1]["blockNum"], 16)
+                page_keys[addr_type] = result.get("pageKey")
+                if page_keys[addr_type] is None:
+                    pending.remove(addr_type)
+
+            resume_block = min(last_blocks[t] for t in pending) if pending else None
+            yield transfers, resume_block
 
-            if not from_response and not to_response:
-                break
-
-            from_data = from_response.get("result", {})
-            to_data = to_response.get("result", {})
-
-            transactions += from_data.get("transfers", []) + to_data.get(
-                "transfers", []
-            )
-
-            from_page_key = from_data.get("pageKey")
-            to_page_key = to_data.get("pageKey")
-
-            if from_page_key is None and to_page_key is None:
-                break
-            elif from_page_key is not None:
-                page_key = from_page_key
-            else:
-                page_key = to_page_key
-
+    async def _fetch_data_for_address(self, address: str, latest_block_of_user: int):
+        transactions = []
+        async for page, _ in self._iter_pages(address, latest_block_of_user):
+            transactions += page
         return transactions
 
     def _get_models(self) -> List[Union[EthTransaction, ERC1155Metadata]]:
         models = []
         seen_unique_ids = set()
+        addresses = set(self._get_addresses())
 
         for transaction in self.transactions:
             to_address = transaction.get("to")
             from_address = transaction.get("from")
 
             # Use the original address that was passed to the API
-            address = (
-                to_address if to_address in self._get_addresses() else from_address
-            )
+            address = to_address if to_address in addresses else from_address
 
             if address is None:
                 continue
@@ -139,6 +220,17 @@ class AlchemyTransactionFetcher(AsyncFetcher):
             category="empty",
         )
 
+    async def fetch_block_height(self) -> int:
+        payload = {"jsonrpc": "2.0", "method": "eth_blockNumber", "id": 0}
+        headers = {"Content-Type": "application/json"}
+        await self._spend(BLOCK_NUMBER_CU)
+        response = await self._make_async_request_with_retry(
+            self.base_url, headers=headers, data=payload, method="POST", delay=2
+        )
+        if not response:
+            raise ValueError("Failed to fetch the current block height")
+        return int(response["result"], 16)
+
     def _get_current_block_height(self) -> int:
         # data = requests.post(self.base_url, data={"method": "getBlockHeight"}).json()
         payload = {"jsonrpc": "2.0", "method": "eth_blockNumber", "id": 0}
@@ -188,6 +280,7 @@ class AlchemyTransactionFetcher(AsyncFetcher):
         latest_block_of_user: int,
         addr_type: str,
         page_key: Optional[str] = None,
+        to_block: Optional[int] = None,
     ) -> Dict[str, Any]:
         payload: Dict[str, Any] = {
             "id": 1,
@@ -196,7 +289,7 @@ class AlchemyTransactionFetcher(AsyncFetcher):
             "params": [
                 {
                     "fromBlock": f"0x{latest_block_of_user:x}",
-                    "toBlock": "latest",
+                    "toBlock": "latest" if to_block is None else f"0x{to_block:x}",
                     addr_type: address,
                     "category": [
                         "erc721",
@@ -221,109 +314,463 @@ class AlchemyTransactionFetcher(AsyncFetcher):
         return self._get_models()
 
 
+# Only the fields we store, anything else in the API response is dropped
+TRANSFER_SCHEMA = pa.schema(
+    [
+        ("uniqueId", pa.string()),
+        ("hash", pa.string()),
+        ("blockNum", pa.string()),
+        ("from", pa.string()),
+        ("to", pa.string()),
+        ("value", pa.float64()),
+        ("erc721TokenId", pa.string()),
+        ("tokenId", pa.string()),
+        ("asset", pa.string()),
+        ("category", pa.string()),
+        ("metadata", pa.struct([("blockTimestamp", pa.string())])),
+        (
+            "erc1155Metadata",
+            pa.list_(pa.struct([("tokenId", pa.string()), ("value", pa.string())])),
+        ),
+    ]
+)
+
+# Hex digit value of every byte, see parse_hex_column
+_HEX_DIGITS = np.zeros(256, dtype=np.int64)
+_HEX_DIGITS[np.frombuffer(b"0123456789", dtype=np.uint8)] = np.arange(10)
+_HEX_DIGITS[np.frombuffer(b"abcdef", dtype=np.uint8)] = np.arange(10, 16)
+_HEX_DIGITS[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = np.arange(10, 16)
+
+
+def parse_hex_column(values: pa.Array) -> np.ndarray:
+    """
+    Parses 0x-prefixed hex strings of up to 15 digits (e.g. block numbers)
+    into int64 without a Python loop: the strings are left-padded to a fixed
+    width so the Arrow data buffer becomes a digit matrix.
+    """
+    width = 16
+    digits_only = pc.utf8_slice_codeunits(values, start=2, stop=2 + width)
+    padded = pc.utf8_lpad(digits_only, width=width, padding="0")
+    if len(padded) == 0:
+        return np.zeros(0, dtype=np.int64)
+    padded = padded.combine_chunks() if isinstance(padded, pa.ChunkedArray) else padded
+    data = np.frombuffer(padded.buffers()[2], dtype=np.uint8)
+    digits = data[padded.offset * width : (padded.offset + len(padded)) * width]
+    powers = 16 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    return _HEX_DIGITS[digits.reshape(-1, width)] @ powers
+
+
+def transfers_to_arrow(
+    transfers: pa.Table, addresses: List[str]
+) -> Tuple[pa.Table, pa.Table]:
+    """
+    Turns raw alchemy_getAssetTransfers rows (see TRANSFER_SCHEMA) into
+    eth_transactions and erc1155_metadata tables, using vectorized
+    timestamp/hex parsing and set-based address matching.
+    """
+    # Same rule as _get_models: keep rows that have the queried address as
+    # recipient or any sender
+    keep = pc.or_(
+        pc.is_in(transfers["to"], value_set=pa.array(addresses, pa.string())),
+        pc.is_valid(transfers["from"]),
+    )
+    transfers = transfers.filter(pc.fill_null(keep, False))
+
+    # A self transfer is returned by both the from and the to query, keep
+    # the first occurrence of every uniqueId
+    unique_ids = transfers["uniqueId"]
+    group = pc.index_in(unique_ids, value_set=pc.unique(unique_ids))
+    _, first = np.unique(group.to_numpy(), return_index=True)
+    transfers = transfers.take(pa.array(np.sort(first)))
+
+    # Timestamps are stored in milliseconds truncated to the second
+    block_timestamp = pc.struct_field(transfers["metadata"], [0])
+    seconds = (
+        block_timestamp.cast(pa.timestamp("ms", tz="UTC")).cast(pa.int64()).to_numpy()
+        // 1000
+    )
+
+    eth_transactions = pa.table(
+        {
+            "unique_id": transfers["uniqueId"],
+            "hash": transfers["hash"],
+            "timestamp": seconds * 1000,
+            "block_num": parse_hex_column(transfers["blockNum"]),
+            "from_address": transfers["from"],
+            "to_address": transfers["to"],
+            "value": transfers["value"],
+            "erc721_token_id": transfers["erc721TokenId"],
+            "token_id": transfers["tokenId"],
+            "asset": transfers["asset"],
+            "category": pc.fill_null(transfers["category"], "unknown"),
+        }
+    )
+
+    erc1155 = transfers["erc1155Metadata"].combine_chunks()
+    flat = pc.list_flatten(erc1155)
+    erc1155_metadata = pa.table(
+        {
+            "eth_transaction_hash": transfers["hash"].take(
+                pc.list_parent_indices(erc1155)
+            ),
+            "token_id": pc.struct_field(flat, [0]),
+            "value": pc.struct_field(flat, [1]),
+        }
+    )
+
+    return eth_transactions, erc1155_metadata
+
+
 def read_fetched_addresses(file_path: str) -> List[str]:
     fetched_addresses = []
     try:
         with open(file_path, "r") as f:
             reader = csv.reader(f)
             for row in reader:
-                fetched_addresses.extend(row)
+                # Older files may hold checksummed addresses
+                fetched_addresses.extend(address.lower() for address in row)
     except FileNotFoundError:
         pass
     return fetched_addresses
 
 
 def get_address_to_process(session: Session, fetched_addresses_file: str) -> List[str]:
+    """
+    Addresses that haven't been fetched yet, most recently active users first
+    (by their latest cast, then by registration time).
+    """
     # Read fetched_addresses from the CSV file
-    fetched_addresses = read_fetched_addresses(fetched_addresses_file)
+    fetched_addresses = set(read_fetched_addresses(fetched_addresses_file))
+
+    last_cast = (
+        session.query(
+            Cast.author_fid.label("fid"),
+            func.max(Cast.timestamp).label("last_cast_at"),
+        )
+        .group_by(Cast.author_fid)
+        .subquery()
+    )
 
-    users = (
-        session.query(User)
+    rows = (
+        session.query(User.address)
+        .outerjoin(last_cast, last_cast.c.fid == User.fid)
         .filter(User.address.isnot(None))
-        .filter(
-            User.fid != 166 and User.fid != 5650
-        )  # these user has ungodly amount of tx
-        .filter(not_(User.address.in_(fetched_addresses)))
+        .order_by(
+            func.coalesce(last_cast.c.last_cast_at, 0).desc(),
+            func.coalesce(User.registered_at, 0).desc(),
+        )
         .all()
     )
 
-    return [user.address for user in users]
+    # Filter in Python, the fetched list is too long for an IN (...) clause
+    addresses = []
+    for (address,) in rows:
+        if address not in fetched_addresses:
+            addresses.append(address)
+            fetched_addresses.add(address)  # users can share an address
+
+    return addresses
 
 
 def insert_eth_transactions_and_metadata(
-    session, eth_transactions_metadata: List[Union[EthTransaction, ERC1155Metadata]]
+    session, eth_transactions: pa.Table, erc1155_metadata: pa.Table
 ):
-    eth_transactions = [
-        item for item in eth_transactions_metadata if isinstance(item, EthTransaction)
-    ]
-    erc1155_metadata = [
-        item for item in eth_transactions_metadata if isinstance(item, ERC1155Metadata)
-    ]
+    """
+    Bulk inserts the tables built by `transfers_to_arrow`. Transactions and
+    metadata that are already stored are skipped by their unique keys, so
+    the cost doesn't depend on the size of the existing tables.
+    """
+    inserted_transactions = bulk_insert_ignore(
+        session, EthTransaction.__table__, eth_transactions.to_pylist()
+    )
+    inserted_metadata = bulk_insert_ignore(
+        session, ERC1155Metadata.__table__, erc1155_metadata.to_pylist()
+    )
+    bump_data_versions(
+        session.connection(),
+        [EthTransaction.__tablename__, ERC1155Metadata.__tablename__],
+    )
 
-    # Get the list of existing unique_ids for EthTransaction
-    existing_unique_ids = (
-        session.query(EthTransaction.unique_id)
-        .filter(
-            EthTransaction.unique_id.in_(tuple(tx.unique_id for tx in eth_transactions))
-        )
-        .all()
+    # Commit the changes to the database
+    session.commit()
+    print(
+        f"Inserted {inserted_transactions} EthTransactions and {inserted_metadata} ERC1155Metadata"
     )
 
-    # Get the list of existing eth_transaction_hashes for ERC1155Metadata
-    existing_hashes = (
-        session.query(ERC1155Metadata.eth_transaction_hash)
-        .filter(
-            ERC1155Metadata.eth_transaction_hash.in_(
-                tuple(meta.eth_transaction_hash for meta in erc1155_metadata)
-            )
+
+class Shard(NamedTuple):
+    """A block range of an address, `to_block` None means the latest block."""
+
+    address: str
+    from_block: int = 0
+    to_block: Optional[int] = None
+
+
+def split_block_range(
+    address: str, from_block: int, head_block: int, count: int
+) -> List[Shard]:
+    """
+    Splits [from_block, latest] into `count` contiguous shards, the last one
+    stays open-ended so blocks mined while crawling are covered too.
+    """
+    step = max((head_block - from_block) // count, 1)
+    starts = [
+        from_block + i * step
+        for i in range(count)
+        if from_block + i * step < head_block or i == 0
+    ]
+    shards = [Shard(address, lo, hi - 1) for lo, hi in zip(starts, starts[1:])]
+    return shards + [Shard(address, starts[-1], None)]
+
+
+class CrawlProgress:
+    """
+    Resumable crawl state kept in two append-only CSV files: addresses that
+    are completely fetched, and the next block of every shard in flight
+    (empty once the shard is done). The last row of a shard wins, compact()
+    drops the others.
+    """
+
+    def __init__(self, fetched_addresses_file: str, shards_file: str):
+        self.fetched_addresses_file = fetched_addresses_file
+        self.shards_file = shards_file
+
+    def _next_blocks(self) -> Dict[Shard, Optional[int]]:
+        next_blocks: Dict[Shard, Optional[int]] = {}
+        try:
+            with open(self.shards_file, "r") as f:
+                for address, from_block, to_block, next_value in csv.reader(f):
+                    shard = Shard(
+                        address.lower(),
+                        int(from_block),
+                        int(to_block) if to_block else None,
+                    )
+                    next_blocks[shard] = int(next_value) if next_value else None
+        except FileNotFoundError:
+            pass
+        return next_blocks
+
+    def pending_shards(self) -> Dict[str, List[Tuple[Shard, int]]]:
+        """
+        Unfinished shards with the block to resume from, by address. An
+        address whose shards are all done maps to an empty list.
+        """
+        pending: Dict[str, List[Tuple[Shard, int]]] = {}
+        for shard, next_block in self._next_blocks().items():
+            shards = pending.setdefault(shard.address, [])
+            if next_block is not None:
+                shards.append((shard, next_block))
+        return pending
+
+    def compact(self) -> None:
+        """
+        Rewrites the files with one row per fetched address and per shard of
+        the other addresses, as a page appends a row. Run before crawling.
+        """
+        fetched_addresses = dict.fromkeys(
+            read_fetched_addresses(self.fetched_addresses_file)
+        )
+        _rewrite_csv(
+            self.fetched_addresses_file,
+            [[address] for address in fetched_addresses],
+        )
+        _rewrite_csv(
+            self.shards_file,
+            [
+                _shard_row(shard, next_block)
+                for shard, next_block in self._next_blocks().items()
+                if shard.address not in fetched_addresses
+            ],
         )
-        .all()
-    )
 
-    # Convert the lists of tuples to sets for faster lookup
-    existing_unique_ids = set([unique_id[0] for unique_id in existing_unique_ids])
-    existing_hashes = set([hash_[0] for hash_ in existing_hashes])
+    def record(self, shard: Shard, next_block: Optional[int]) -> None:
+        with open(self.shards_file, "a") as f:
+            writer = csv.writer(f)
+            writer.writerow(_shard_row(shard, next_block))
 
-    # Insert only the new EthTransactions into the database
-    for tx in eth_transactions:
-        if tx.unique_id not in existing_unique_ids:
-            session.add(tx)
+    def complete(self, address: str) -> None:
+        with open(self.fetched_addresses_file, "a") as f:
+            writer = csv.writer(f)
+            writer.writerow([address])
 
-    # Insert only the new ERC1155Metadata into the database
-    for meta in erc1155_metadata:
-        if meta.eth_transaction_hash not in existing_hashes:
-            session.add(meta)
 
-    # Commit the changes to the database
-    session.commit()
-    print(
-        f"Inserted {len(eth_transactions)} EthTransactions and {len(erc1155_metadata)} ERC1155Metadata"
-    )
+def _shard_row(shard: Shard, next_block: Optional[int]) -> List[Any]:
+    return [
+        shard.address,
+        shard.from_block,
+        "" if shard.to_block is None else shard.to_block,
+        "" if next_block is None else next_block,
+    ]
+
+
+def _rewrite_csv(file_path: str, rows: List[List[Any]]) -> None:
+    if not os.path.exists(file_path):
+        return
+    # Written aside then renamed, an interruption never loses the file
+    temporary_path = f"{file_path}.tmp"
+    with open(temporary_path, "w") as f:
+        csv.writer(f).writerows(rows)
+    os.replace(temporary_path, file_path)
+
+
+class AddressCrawlScheduler:
+    """
+    Keeps up to `concurrency` shards in flight, highest priority (lowest
+    value) first, with all requests sharing one compute-unit budget. Every
+    page is persisted as soon as it arrives, so a slow address never holds
+    back the others and an interrupted crawl resumes where it stopped.
 
+    An address that still has more pages after `whale_pages` pages is a
+    "whale": the rest of its history is split into `shard_count` block
+    ranges that are fetched in parallel.
+    """
 
-async def main(engine: Engine):
-    addresses_filename = "fetched_addresses.csv"
-    with sessionmaker(bind=engine)() as session:
-        addresses = get_address_to_process(session, addresses_filename)
+    def __init__(
+        self,
+        key: str,
+        budget: ComputeUnitBudget,
+        persist: Callable[[pa.Table, pa.Table], Awaitable[None]],
+        progress: CrawlProgress,
+        concurrency: int = 10,
+        whale_pages: int = 5,
+        shard_count: int = 8,
+    ):
+        self.key = key
+        self.budget = budget
+        self.persist = persist
+        self.progress = progress
+        self.concurrency = concurrency
+        self.whale_pages = whale_pages
+        self.shard_count = shard_count
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._counter = 0  # tie breaker, keeps insertion order within a priority
+        self._remaining: Dict[str, int] = {}  # unfinished shards by address
+        self._split: Set[str] = set()
+
+    def add(
+        self,
+        address: str,
+        priority: int,
+        shards: Optional[List[Tuple[Shard, int]]] = None,
+    ) -> None:
+        """Queues an address, or the given (shard, resume block) pairs of it."""
+        if shards is None:
+            shards = [(Shard(address), 0)]
+        self._remaining[address] = self._remaining.get(address, 0) + len(shards)
+        for shard, start_block in shards:
+            self._put(priority, shard, start_block)
+
+    def _put(self, priority: int, shard: Shard, start_block: int) -> None:
+        self.queue.put_nowait((priority, self._counter, shard, start_block))
+        self._counter += 1
+
+    async def _crawl(self, priority: int, shard: Shard, start_block: int) -> None:
+        fetcher = AlchemyTransactionFetcher(
+            key=self.key,
+            addresses_blocknum=[(shard.address, start_block)],
+            budget=self.budget,
+        )
+        pages = 0
+        async for transfers, resume_block in fetcher._iter_pages(
+            shard.address, start_block, shard.to_block
+        ):
+            eth_transactions, erc1155_metadata = transfers_to_arrow(
+                pa.Table.from_pylist(transfers, schema=TRANSFER_SCHEMA),
+                [shard.address],
+            )
+            await self.persist(eth_transactions, erc1155_metadata)
+            self.progress.record(shard, resume_block)
+            pages += 1
+
+            if (
+                resume_block is not None
+                and pages >= self.whale_pages
+                and shard.to_block is None
+                and shard.address not in self._split
+            ):
+                head_block = await fetcher.fetch_block_height()
+                shards = split_block_range(
+                    shard.address, resume_block, head_block, self.shard_count
+                )
+                print(f"{shard.address} is a whale, splitting into {len(shards)}")
+                self._split.add(shard.address)
+                self._remaining[shard.address] += len(shards)
+                for new_shard in shards:
+                    self.progress.record(new_shard, new_shard.from_block)
+                    self._put(priority, new_shard, new_shard.from_block)
+                self.progress.record(shard, None)
+                break
+
+    async def _worker(self) -> None:
+        while True:
+            priority, _, shard, start_block = await self.queue.get()
+            try:
+                await self._crawl(priority, shard, start_block)
+                self._remaining[shard.address] -= 1
+                if self._remaining[shard.address] == 0:
+                    self.progress.complete(shard.address)
+                    print(
+                        f"Fetched {shard.address}, {self.queue.qsize()} shards left "
+                        f"({self.budget.rate():.0f} CU/s)"
+                    )
+            except Exception as e:
+                # Progress so far is recorded, the shard resumes next run
+                print(f"Failed to fetch transactions for {shard}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def run(self) -> None:
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        await self.queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def main(
+    engine: Engine,
+    concurrency: int = 10,
+    cu_per_second: int = 330,
+    whale_pages: int = 5,
+    shard_count: int = 8,
+    writer: Optional[DatabaseWriter] = None,
+):
+    progress = CrawlProgress("fetched_addresses.csv", "fetched_shards.csv")
+    progress.compact()
+    with shared_writer(engine, writer) as database_writer, sessionmaker(
+        bind=engine
+    )() as session:
+        addresses = get_address_to_process(session, progress.fetched_addresses_file)
         print(len(addresses))
 
-        addresses_blocknum = [(address, 0) for address in addresses]
         alchemy_api_key = os.getenv("ALCHEMY_API_KEY")
         if not alchemy_api_key:
             raise ValueError("Missing ALCHEMY_API_KEY")
 
-        batch_size = 5
-        for i in range(0, len(addresses_blocknum), batch_size):
-            batch = addresses_blocknum[i : i + batch_size]  # noqa: E203
-            fetcher = AlchemyTransactionFetcher(
-                key=alchemy_api_key, addresses_blocknum=batch
+        async def persist(eth_transactions: pa.Table, erc1155_metadata: pa.Table):
+            await database_writer.run(
+                partial(
+                    insert_eth_transactions_and_metadata,
+                    eth_transactions=eth_transactions,
+                    erc1155_metadata=erc1155_metadata,
+                )
             )
-            txs = await fetcher.fetch()
-            insert_eth_transactions_and_metadata(session, txs)
 
-            batch_addresses = [address for address, _ in batch]
+        scheduler = AddressCrawlScheduler(
+            key=alchemy_api_key,
+            budget=ComputeUnitBudget(cu_per_second),
+            persist=persist,
+            progress=progress,
+            concurrency=concurrency,
+            whale_pages=whale_pages,
+            shard_count=shard_count,
+        )
+        pending_shards = progress.pending_shards()
+        for priority, address in enumerate(addresses):
+            shards = pending_shards.get(address)
+            if shards == []:
+                progress.complete(address)  # interrupted right before completion
+            else:
+                scheduler.add(address, priority, shards)
 
-            with open(addresses_filename, "a") as f:
-                writer = csv.writer(f)
-                for address in batch_addresses:
-                    writer.writerow([address])
+        await scheduler.run()
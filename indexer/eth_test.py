@@ -0,0 +1,403 @@
+import asyncio
+import os
+import tempfile
+import time
+
+import pyarrow as pa
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from indexer.eth import (
+    TRANSFER_SCHEMA,
+    AddressCrawlScheduler,
+    AlchemyTransactionFetcher,
+    ComputeUnitBudget,
+    CrawlProgress,
+    Shard,
+    get_address_to_process,
+    insert_eth_transactions_and_metadata,
+    parse_hex_column,
+    read_fetched_addresses,
+    split_block_range,
+    transfers_to_arrow,
+)
+from utils.migrations import migrate
+from utils.models import Cast, ERC1155Metadata, EthTransaction
+from utils.utils import bulk_insert_ignore
+
+
+@pytest.fixture
+def test_sessionmaker():
+    """
+    Returns a SQLAlchemy session maker bound to a fresh in-memory database.
+    """
+    test_engine = create_engine("sqlite:///:memory:")
+    migrate(test_engine)
+    return sessionmaker(bind=test_engine)
+
+
+def make_cast(hash: str, fid: int, timestamp: int) -> Cast:
+    return Cast(
+        hash=hash, thread_hash=hash, text="gm", timestamp=timestamp, author_fid=fid
+    )
+
+
+def make_transfer(unique_id, from_address, to_address, **kwargs):
+    transfer = {
+        "uniqueId": unique_id,
+        "hash": f"0xhash{unique_id}",
+        "blockNum": "0x103e5b4",
+        "from": from_address,
+        "to": to_address,
+        "value": 1,
+        "asset": "ETH",
+        "category": "external",
+        "metadata": {"blockTimestamp": "2023-04-16T05:37:11.000Z"},
+        "rawContract": {"value": "0xde0b6b3a7640000", "decimal": "0x12"},
+    }
+    transfer.update(kwargs)
+    return transfer
+
+
+@pytest.mark.asyncio
+async def test_compute_unit_budget_throttles_spend():
+    budget = ComputeUnitBudget(cu_per_second=1000)
+
+    start = time.monotonic()
+    for _ in range(3):
+        await budget.spend(500)
+    elapsed = time.monotonic() - start
+
+    # The first 1000 CU are available immediately, the last 500 take 0.5s
+    assert budget.spent == 1500
+    assert 0.4 < elapsed < 1.0
+
+
+def test_get_address_to_process_orders_by_activity(test_sessionmaker, make_user):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fetched_file = os.path.join(tmpdirname, "fetched.csv")
+        with open(fetched_file, "w") as f:
+            f.write("0xfetched\n")
+
+        with test_sessionmaker() as session:
+            session.add_all(
+                [
+                    make_user(1, "0xquiet", registered_at=10),
+                    make_user(2, "0xactive"),
+                    make_user(3, "0xnew", registered_at=20),
+                    make_user(4, "0xfetched"),
+                    make_user(5, None),
+                    make_cast("0x1", 2, 2000),
+                    make_cast("0x2", 4, 3000),
+                ]
+            )
+            session.commit()
+
+            addresses = get_address_to_process(session, fetched_file)
+
+        assert addresses == ["0xactive", "0xnew", "0xquiet"]
+
+
+class MemoryProgress(CrawlProgress):
+    def __init__(self):
+        self.records = []
+        self.completed = []
+
+    def record(self, shard, next_block):
+        self.records.append((shard, next_block))
+
+    def complete(self, address):
+        self.completed.append(address)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_persists_each_address(monkeypatch):
+    delays = {"0xslow": 1.0, "0xfast1": 0.01, "0xfast2": 0.01}
+
+    async def fake_pages(self, address, latest_block_of_user, to_block=None):
+        await self._spend(1)
+        await asyncio.sleep(delays[address])
+        yield [make_transfer("0x1", address, "0xother")], None
+
+    monkeypatch.setattr(AlchemyTransactionFetcher, "_iter_pages", fake_pages)
+
+    persisted = []
+
+    async def persist(txs, metadata):
+        persisted.append(txs.num_rows)
+
+    progress = MemoryProgress()
+    scheduler = AddressCrawlScheduler(
+        key="key",
+        budget=ComputeUnitBudget(cu_per_second=1000),
+        persist=persist,
+        progress=progress,
+        concurrency=2,
+    )
+    for priority, address in enumerate(["0xslow", "0xfast1", "0xfast2"]):
+        scheduler.add(address, priority)
+
+    await scheduler.run()
+
+    # The fast addresses finish while the slow one is still in flight
+    assert progress.completed == ["0xfast1", "0xfast2", "0xslow"]
+    assert persisted == [1, 1, 1]
+    assert scheduler.budget.spent == 3
+
+
+def test_split_block_range():
+    assert split_block_range("0xme", 100, 400, 3) == [
+        Shard("0xme", 100, 199),
+        Shard("0xme", 200, 299),
+        Shard("0xme", 300, None),
+    ]
+    # Never more shards than blocks left
+    assert split_block_range("0xme", 100, 102, 8) == [
+        Shard("0xme", 100, 100),
+        Shard("0xme", 101, None),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_scheduler_shards_whale_addresses(monkeypatch):
+    requested = []
+
+    async def fake_pages(self, address, latest_block_of_user, to_block=None):
+        requested.append((address, latest_block_of_user, to_block))
+        if address == "0xwhale" and to_block is None and latest_block_of_user == 0:
+            # Endless history, 100 blocks per page
+            for page in range(100):
+                yield [], (page + 1) * 100
+        else:
+            yield [], None
+
+    async def fake_block_height(self):
+        return 1000
+
+    monkeypatch.setattr(AlchemyTransactionFetcher, "_iter_pages", fake_pages)
+    monkeypatch.setattr(
+        AlchemyTransactionFetcher, "fetch_block_height", fake_block_height
+    )
+
+    async def persist(txs, metadata):
+        pass
+
+    progress = MemoryProgress()
+    scheduler = AddressCrawlScheduler(
+        key="key",
+        budget=ComputeUnitBudget(cu_per_second=1000),
+        persist=persist,
+        progress=progress,
+        concurrency=4,
+        whale_pages=3,
+        shard_count=7,
+    )
+    scheduler.add("0xwhale", 0)
+    scheduler.add("0xminnow", 1)
+
+    await scheduler.run()
+
+    assert sorted(requested) == [
+        ("0xminnow", 0, None),
+        ("0xwhale", 0, None),
+        ("0xwhale", 300, 399),
+        ("0xwhale", 400, 499),
+        ("0xwhale", 500, 599),
+        ("0xwhale", 600, 699),
+        ("0xwhale", 700, 799),
+        ("0xwhale", 800, 899),
+        ("0xwhale", 900, None),
+    ]
+    assert sorted(progress.completed) == ["0xminnow", "0xwhale"]
+    # The whole-history job is closed once its shards are recorded
+    assert (Shard("0xwhale"), None) in progress.records
+    assert (Shard("0xwhale", 300, 399), 300) in progress.records
+
+
+def test_crawl_progress_resumes_unfinished_shards():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        progress = CrawlProgress(
+            os.path.join(tmpdirname, "fetched.csv"),
+            os.path.join(tmpdirname, "shards.csv"),
+        )
+        progress.record(Shard("0xa"), 50)
+        progress.record(Shard("0xb"), 10)
+        progress.record(Shard("0xb"), None)
+        progress.record(Shard("0xc", 0, 99), 0)
+        progress.record(Shard("0xc", 100, None), 100)
+        progress.record(Shard("0xc", 0, 99), 42)
+        progress.record(Shard("0xc", 100, None), None)
+
+        assert progress.pending_shards() == {
+            "0xa": [(Shard("0xa"), 50)],
+            "0xb": [],
+            "0xc": [(Shard("0xc", 0, 99), 42)],
+        }
+
+
+def test_crawl_progress_compacts_its_files():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fetched_file = os.path.join(tmpdirname, "fetched.csv")
+        shards_file = os.path.join(tmpdirname, "shards.csv")
+        progress = CrawlProgress(fetched_file, shards_file)
+        for next_block in [10, 20, 30]:
+            progress.record(Shard("0xa"), next_block)
+            progress.record(Shard("0xb"), next_block)
+        progress.record(Shard("0xb"), None)
+        progress.complete("0xb")
+        progress.complete("0xb")
+
+        progress.compact()
+        with open(fetched_file) as f:
+            assert f.read().splitlines() == ["0xb"]
+        with open(shards_file) as f:
+            assert f.read().splitlines() == ["0xa,0,,30"]
+        assert progress.pending_shards() == {"0xa": [(Shard("0xa"), 30)]}
+
+
+def test_crawl_progress_lowercases_checksummed_addresses():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fetched_file = os.path.join(tmpdirname, "fetched.csv")
+        shards_file = os.path.join(tmpdirname, "shards.csv")
+        with open(fetched_file, "w") as f:
+            f.write("0xAbC\n")
+        with open(shards_file, "w") as f:
+            f.write("0xDeF,0,,7\n")
+
+        assert read_fetched_addresses(fetched_file) == ["0xabc"]
+        assert CrawlProgress(fetched_file, shards_file).pending_shards() == {
+            "0xdef": [(Shard("0xdef"), 7)]
+        }
+
+
+def test_parse_hex_column():
+    values = pa.array(["0x0", "0xff", "0x103e5b4", "0xFFFFFFFFFFFFFFF"])
+    assert parse_hex_column(values).tolist() == [
+        0,
+        255,
+        17032628,
+        0xFFFFFFFFFFFFFFF,
+    ]
+
+
+def test_transfers_to_arrow_matches_models():
+    transfers = [
+        make_transfer("0x1", "0xme", "0xother"),
+        make_transfer("0x2", "0xother", "0xme", value=0.5, category=None),
+        # self transfer, returned by both the from and to query
+        make_transfer("0x3", "0xme", "0xme"),
+        make_transfer("0x3", "0xme", "0xme"),
+        make_transfer(
+            "0x4",
+            "0xother",
+            "0xme",
+            category="erc1155",
+            erc1155Metadata=[
+                {"tokenId": "0x1", "value": "0x1"},
+                {"tokenId": "0x2", "value": "0x3"},
+            ],
+        ),
+    ]
+    fetcher = AlchemyTransactionFetcher(key="key", addresses_blocknum=[("0xme", 0)])
+    fetcher.transactions = transfers
+    models = fetcher._get_models()
+
+    eth_transactions, erc1155_metadata = transfers_to_arrow(
+        pa.Table.from_pylist(transfers, schema=TRANSFER_SCHEMA), ["0xme"]
+    )
+
+    expected_transactions = [
+        {c.name: getattr(m, c.name) for c in EthTransaction.__table__.columns}
+        for m in models
+        if isinstance(m, EthTransaction)
+    ]
+    expected_transactions[1]["category"] = "unknown"  # model default
+    assert eth_transactions.to_pylist() == expected_transactions
+    assert erc1155_metadata.to_pylist() == [
+        {
+            "eth_transaction_hash": m.eth_transaction_hash,
+            "token_id": m.token_id,
+            "value": m.value,
+        }
+        for m in models
+        if isinstance(m, ERC1155Metadata)
+    ]
+
+
+def test_insert_eth_transactions_and_metadata_skips_existing(
+    test_sessionmaker, monkeypatch
+):
+    # Rows are inserted in several chunks
+    monkeypatch.setattr("utils.utils.BULK_INSERT_CHUNK_SIZE", 300)
+    transfers = [make_transfer(hex(i), "0xme", "0xother") for i in range(1000)]
+    transfers.append(
+        make_transfer(
+            "0xmulti",
+            "0xother",
+            "0xme",
+            erc1155Metadata=[
+                {"tokenId": "0x1", "value": "0x1"},
+                {"tokenId": "0x2", "value": "0x1"},
+            ],
+        )
+    )
+    eth_transactions, erc1155_metadata = transfers_to_arrow(
+        pa.Table.from_pylist(transfers, schema=TRANSFER_SCHEMA), ["0xme"]
+    )
+
+    with test_sessionmaker() as session:
+        rows = eth_transactions.to_pylist()
+        assert bulk_insert_ignore(session, EthTransaction.__table__, rows[:700]) == 700
+        insert_eth_transactions_and_metadata(
+            session, eth_transactions, erc1155_metadata
+        )
+        insert_eth_transactions_and_metadata(
+            session, eth_transactions, erc1155_metadata
+        )
+        assert bulk_insert_ignore(session, EthTransaction.__table__, rows) == 0
+
+        assert session.query(EthTransaction).count() == 1001
+        # Both tokens of the multi-token transfer are kept
+        assert session.query(ERC1155Metadata).count() == 2
+
+
+@pytest.mark.asyncio
+async def test_iter_pages_pages_directions_independently(monkeypatch):
+    # Two outgoing pages, one incoming page
+    responses = {
+        ("fromAddress", None): {
+            "transfers": [make_transfer("0x1", "0xme", "0xa", blockNum="0x10")],
+            "pageKey": "from-2",
+        },
+        ("fromAddress", "from-2"): {
+            "transfers": [make_transfer("0x2", "0xme", "0xa", blockNum="0x30")]
+        },
+        ("toAddress", None): {
+            "transfers": [make_transfer("0x3", "0xa", "0xme", blockNum="0x20")]
+        },
+    }
+    requests = []
+
+    async def fake_request(self, url, data=None, **kwargs):
+        params = data["params"][0]
+        addr_type = "fromAddress" if "fromAddress" in params else "toAddress"
+        requests.append((addr_type, params.get("pageKey"), params["toBlock"]))
+        return {"result": responses[(addr_type, params.get("pageKey"))]}
+
+    monkeypatch.setattr(
+        AlchemyTransactionFetcher, "_make_async_request_with_retry", fake_request
+    )
+
+    fetcher = AlchemyTransactionFetcher(key="key", addresses_blocknum=[("0xme", 0)])
+    pages = [
+        ([t["uniqueId"] for t in transfers], resume_block)
+        async for transfers, resume_block in fetcher._iter_pages("0xme", 0, 100)
+    ]
+
+    assert pages == [(["0x1", "0x3"], 0x10), (["0x2"], None)]
+    assert requests == [
+        ("fromAddress", None, "0x64"),
+        ("toAddress", None, "0x64"),
+        ("fromAddress", "from-2", "0x64"),
+    ]
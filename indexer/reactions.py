@@ -1,7 +1,8 @@
 import asyncio
 import os
 from datetime import datetime, timedelta
-from typing import Any, Dict, List
+from functools import partial
+from typing import Any, Dict, List, Optional
 
 from dotenv import load_dotenv
 from sqlalchemy.engine import Engine
@@ -9,6 +10,8 @@ from sqlalchemy.orm import sessionmaker
 
 from utils.fetcher import AsyncFetcher
 from utils.models import Cast, Reaction
+from utils.state import bump_data_versions
+from utils.writer import DatabaseWriter, shared_writer
 
 load_dotenv()
 
@@ -138,18 +141,21 @@ def insert_reactions(session, reactions: List[Reaction]):
         if reaction.hash not in existing_hashes:
             session.add(reaction)
 
+    bump_data_versions(session.connection(), [Reaction.__tablename__])
     # Commit the changes to the database
     session.commit()
     print(f"Inserted {len(reactions)} reactions")
 
 
-async def main(engine: Engine):
+async def main(engine: Engine, writer: Optional[DatabaseWriter] = None):
     warpcast_hub_key = os.getenv("WARPCAST_HUB_KEY")
 
     if not warpcast_hub_key:
         raise Exception("WARPCAST_HUB_KEY not found in .env file.")
 
-    with sessionmaker(engine)() as session:
+    with shared_writer(engine, writer) as database_writer, sessionmaker(
+        engine
+    )() as session:
         # One week because a cast that been around for a week
         # probably would have their reactions "solidified"
         one_week_ago = datetime.now() - timedelta(days=7)
@@ -175,4 +181,4 @@ async def main(engine: Engine):
                 key=warpcast_hub_key, cast_hashes=batch, limit=100
             )
             data = await fetcher.fetch()
-            insert_reactions(session, data)
+            await database_writer.run(partial(insert_reactions, reactions=data))
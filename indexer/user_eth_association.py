@@ -1,123 +1,135 @@
-from collections import defaultdict
+from typing import Optional
 
-from sqlalchemy import func
-from sqlalchemy.engine import Engine
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy import Integer, func, literal_column, or_, select, union
+from sqlalchemy.engine import Connection, Engine
 
 from utils.models import EthTransaction, User, user_eth_transactions_association
+from utils.state import (
+    bump_data_versions,
+    get_state,
+    set_state,
+    warpy_state,
+    warpy_user_addresses,
+)
+from utils.writer import DatabaseWriter, shared_writer
+
+WATERMARK_KEY = "user_eth_association.eth_transactions_rowid"
+
+transaction_rowid = literal_column("eth_transactions.rowid", Integer)
+
+
+def association_select(*criteria):
+    """
+    (user_fid, eth_transaction_unique_id) of every transfer from or to a
+    user, restricted to the users and transactions matching `criteria`.
+    """
+    return union(
+        *[
+            select(User.fid, EthTransaction.unique_id)
+            .join(EthTransaction, address_column == User.address)
+            .where(*criteria)
+            for address_column in (
+                EthTransaction.from_address,
+                EthTransaction.to_address,
+            )
+        ]
+    )
 
 
-def delete_duplicate_associations(session: Session):
-    # Create a subquery to identify duplicate associations
-    duplicates_subquery = session.query(
-        user_eth_transactions_association.c.user_fid,
-        user_eth_transactions_association.c.eth_transaction_unique_id,
-        func.row_number()
-        .over(
-            partition_by=[
-                user_eth_transactions_association.c.user_fid,
-                user_eth_transactions_association.c.eth_transaction_unique_id,
-            ],
-            order_by=user_eth_transactions_association.c.user_fid,
-        )
-        .label("row_number"),
-    ).subquery("duplicates_subquery")
-
-    # Get the user_fid and eth_transaction_unique_id of duplicate rows
-    duplicate_rows = (
-        session.query(
-            duplicates_subquery.c.user_fid,
-            duplicates_subquery.c.eth_transaction_unique_id,
-        )
-        .filter(duplicates_subquery.c.row_number > 1)
-        .all()
+def build_associations(connection: Connection, associations) -> int:
+    """
+    Inserts the (user_fid, eth_transaction_unique_id) rows selected by
+    `associations` with a single INSERT ... SELECT, skipping those that
+    already exist. Returns the number of associations created.
+    """
+    statement = (
+        user_eth_transactions_association.insert()
+        .prefix_with("OR IGNORE")
+        .from_select(["user_fid", "eth_transaction_unique_id"], associations)
     )
-
-    # Delete the duplicate rows
-    affected_rows = 0
-    for user_fid, eth_transaction_unique_id in duplicate_rows:
-        deletion_count = (
-            session.query(user_eth_transactions_association)
-            .filter(
-                user_eth_transactions_association.c.user_fid == user_fid,
-                user_eth_transactions_association.c.eth_transaction_unique_id
-                == eth_transaction_unique_id,
+    return connection.execute(statement).rowcount
+
+
+def changed_users_select():
+    """Fids of the users whose address changed since associations were built."""
+    return (
+        select(User.fid)
+        .outerjoin(warpy_user_addresses, warpy_user_addresses.c.fid == User.fid)
+        .where(
+            or_(
+                warpy_user_addresses.c.fid.is_(None),
+                warpy_user_addresses.c.address.is_distinct_from(User.address),
             )
-            .delete(synchronize_session=False)
         )
-        affected_rows += deletion_count
-        session.commit()
-
-    print(f"Deleted {affected_rows} duplicate rows")
-
-
-def process_tx_batch(session, tx_batch, user_address_cache):
-    unique_addresses = set(tx.from_address for tx in tx_batch).union(
-        tx.to_address for tx in tx_batch
+        # Used as a subquery of statements on users, which must not correlate
+        .correlate(None)
     )
 
-    # Remove addresses already present in the cache
-    uncached_addresses = unique_addresses - set(user_address_cache.keys())
 
-    # Query uncached addresses
-    if uncached_addresses:
-        new_users = (
-            session.query(User).filter(User.address.in_(uncached_addresses)).all()
+def backfill_changed_users(connection: Connection) -> int:
+    """
+    Rebuilds the associations of the users whose address changed, against
+    every transaction, and records their current address.
+    """
+    changed = changed_users_select()
+    count = connection.execute(
+        select(func.count()).select_from(changed.subquery())
+    ).scalar()
+    if not count:
+        return 0
+
+    print(f"Backfilling associations of {count} users...")
+    association = user_eth_transactions_association
+    connection.execute(association.delete().where(association.c.user_fid.in_(changed)))
+    created = build_associations(connection, association_select(User.fid.in_(changed)))
+    # Last, the statements above compare against the previous addresses
+    connection.execute(
+        warpy_user_addresses.insert()
+        .prefix_with("OR REPLACE")
+        .from_select(
+            ["fid", "address"],
+            select(User.fid, User.address).where(User.fid.in_(changed)),
         )
+    )
+    return created
+
+
+def update_associations(connection: Connection) -> int:
+    """
+    Associates the transactions indexed since the last run with users, and
+    the users whose address changed since the last run with all of their
+    transactions, so the cost follows the amount of new data.
+    """
+    backfilled = backfill_changed_users(connection)
+
+    watermark = int(get_state(connection, WATERMARK_KEY) or 0)
+    head = connection.execute(
+        select(func.max(transaction_rowid)).select_from(EthTransaction.__table__)
+    ).scalar()
+    created = build_associations(
+        connection,
+        association_select(
+            transaction_rowid > watermark, transaction_rowid <= (head or 0)
+        ),
+    )
+    set_state(connection, WATERMARK_KEY, str(head or watermark))
+    if backfilled or created:
+        bump_data_versions(connection, [user_eth_transactions_association.name])
+    return backfilled + created
 
-        # Add new users to the cache
-        for user in new_users:
-            user_address_cache[user.address] = user.fid
-
-    associations_to_create = []
-    for tx in tx_batch:
-        from_fid = user_address_cache.get(tx.from_address)
-        to_fid = user_address_cache.get(tx.to_address)
-
-        if from_fid:
-            associations_to_create.append(
-                {"user_fid": from_fid, "eth_transaction_unique_id": tx.unique_id}
-            )
-        if to_fid and to_fid != from_fid:
-            associations_to_create.append(
-                {"user_fid": to_fid, "eth_transaction_unique_id": tx.unique_id}
-            )
-
-    print(f"Creating {len(associations_to_create)} associations...")
-
-    if associations_to_create:
-        for association in associations_to_create:
-            session.execute(
-                user_eth_transactions_association.insert().values(**association)
-            )
-        session.commit()
-
-
-def main(engine: Engine):
-    batch_size = 20000  # Decrease batch size to reduce unique_addresses count
-    user_address_cache = defaultdict(int)
-    last_unique_id = "0"  # Start with a character that is lexicographically smaller than any unique_id
-
-    with sessionmaker(bind=engine)() as session:
-        while True:
-            tx_batch = (
-                session.query(EthTransaction)
-                .filter(
-                    EthTransaction.unique_id > last_unique_id
-                )  # Select records with unique_id lexicographically greater than the last one processed
-                .order_by(EthTransaction.unique_id)
-                .limit(batch_size)
-                .all()
-            )
-
-            if not tx_batch:
-                break
-
-            print(f"Processing records after unique_id: {last_unique_id}")
 
-            process_tx_batch(session, tx_batch, user_address_cache)
+def reset_associations(connection: Connection) -> None:
+    """
+    Forgets which transactions and addresses the associations were built
+    from, for when their sources were replaced: the next run builds them all.
+    """
+    connection.execute(warpy_state.delete().where(warpy_state.c.key == WATERMARK_KEY))
+    connection.execute(warpy_user_addresses.delete())
 
-            # Update the last_unique_id
-            last_unique_id = tx_batch[-1].unique_id
 
-        # delete_duplicate_associations(session)
+def main(engine: Engine, writer: Optional[DatabaseWriter] = None):
+    with shared_writer(engine, writer) as database_writer:
+        created = database_writer.write(
+            lambda session: update_associations(session.connection())
+        )
+    print(f"Created {created} associations")
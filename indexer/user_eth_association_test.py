@@ -0,0 +1,116 @@
+import os
+import tempfile
+from typing import Optional
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from indexer.user_eth_association import main, reset_associations
+from utils.migrations import migrate
+from utils.models import EthTransaction, User, user_eth_transactions_association
+
+ALICE = "0x" + "a1" * 20
+BOB = "0x" + "b2" * 20
+STRANGER = "0x" + "ff" * 20
+
+
+@pytest.fixture
+def test_engine():
+    # A file, the writer thread doesn't see in-memory databases of others
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        engine = create_engine(f"sqlite:///{os.path.join(tmpdirname, 'test.db')}")
+        migrate(engine)
+        yield engine
+
+
+def make_transaction(
+    unique_id: str, from_address: Optional[str], to_address: Optional[str]
+):
+    return EthTransaction(
+        unique_id=unique_id,
+        hash=f"0x{unique_id}",
+        timestamp=0,
+        block_num=0,
+        from_address=from_address,
+        to_address=to_address,
+        category="external",
+    )
+
+
+def associations(engine):
+    with engine.connect() as connection:
+        rows = connection.execute(select(user_eth_transactions_association))
+        return sorted(tuple(row) for row in rows)
+
+
+def test_build_associations(test_engine, make_user):
+    with sessionmaker(bind=test_engine)() as session:
+        session.add_all(
+            [
+                make_user(1, ALICE),
+                make_user(2, BOB),
+                make_user(3, None),
+                make_transaction("t1", ALICE, BOB),
+                make_transaction("t2", ALICE, STRANGER),
+                make_transaction("t3", STRANGER, BOB),
+                make_transaction("t4", ALICE, ALICE),
+                make_transaction("t5", STRANGER, None),
+            ]
+        )
+        session.commit()
+
+    expected = [(1, "t1"), (1, "t2"), (1, "t4"), (2, "t1"), (2, "t3")]
+    main(test_engine)
+    assert associations(test_engine) == expected
+
+    # Running it again doesn't create duplicates
+    main(test_engine)
+    assert associations(test_engine) == expected
+
+
+def test_associations_are_incremental(test_engine, make_user):
+    Session = sessionmaker(bind=test_engine)
+    with Session() as session:
+        session.add_all(
+            [
+                make_user(1, ALICE),
+                make_user(2, None),
+                make_transaction("t1", ALICE, STRANGER),
+            ]
+        )
+        session.commit()
+    main(test_engine)
+    assert associations(test_engine) == [(1, "t1")]
+
+    # Associations of processed transactions aren't looked at again
+    with test_engine.begin() as connection:
+        connection.execute(user_eth_transactions_association.delete())
+    with Session() as session:
+        session.add(make_transaction("t2", STRANGER, ALICE))
+        session.commit()
+    main(test_engine)
+    assert associations(test_engine) == [(1, "t2")]
+
+    # Users whose address changed are backfilled against every transaction
+    with Session() as session:
+        session.add(make_transaction("t3", BOB, STRANGER))
+        session.get(User, 1).address = BOB
+        session.get(User, 2).address = ALICE
+        session.commit()
+    main(test_engine)
+    assert associations(test_engine) == [(1, "t3"), (2, "t1"), (2, "t2")]
+
+
+def test_reset_associations_builds_them_all_again(test_engine, make_user):
+    with sessionmaker(bind=test_engine)() as session:
+        session.add_all([make_user(1, ALICE), make_transaction("t1", ALICE, None)])
+        session.commit()
+    main(test_engine)
+
+    # As when a download replaced the tables
+    with test_engine.begin() as connection:
+        connection.execute(user_eth_transactions_association.delete())
+        reset_associations(connection)
+    main(test_engine)
+    assert associations(test_engine) == [(1, "t1")]
@@ -9,7 +9,9 @@ from sqlalchemy.orm import sessionmaker
 
 from utils.fetcher import AsyncFetcher, SyncFetcher
 from utils.models import Location, User
+from utils.state import bump_data_versions
 from utils.utils import save_objects, update_users_warpcast
+from utils.writer import DatabaseWriter, shared_writer
 
 
 class WarpcastUserFetcher(SyncFetcher):
@@ -197,31 +199,41 @@ def delete_unregistered_users(session):
     need better way to handle this
     """
     session.query(User).filter(User.registered_at == -1).delete()
+    bump_data_versions(session.connection(), [User.__tablename__])
     session.commit()
 
 
 def update_user_searchcaster(session, user_list):
     for user in user_list:
         session.merge(user)
+    bump_data_versions(session.connection(), [User.__tablename__])
     session.commit()
 
 
-async def main(engine: Engine):
+async def main(engine: Engine, writer: Optional[DatabaseWriter] = None):
     fetch_warpcast = True
 
-    with sessionmaker(bind=engine)() as session:
+    with shared_writer(engine, writer) as database_writer, sessionmaker(
+        bind=engine
+    )() as session:
         if fetch_warpcast:
             warpcast_hub_key = os.getenv("WARPCAST_HUB_KEY")
             if warpcast_hub_key is None:
                 raise ValueError("WARPCAST_HUB_KEY is not set")
             warpcast_fetcher = WarpcastUserFetcher(key=warpcast_hub_key)
-            users_and_location = warpcast_fetcher.fetch(partial=False)
+            users_and_location = await asyncio.to_thread(
+                warpcast_fetcher.fetch, partial=False
+            )
 
             location_list = [x for x in users_and_location if isinstance(x, Location)]
             user_list = [x for x in users_and_location if isinstance(x, User)]
 
-            save_objects(session, location_list)
-            update_users_warpcast(session, user_list)
+            await database_writer.run(
+                lambda session: save_objects(session, location_list)
+            )
+            await database_writer.run(
+                lambda session: update_users_warpcast(session, user_list)
+            )
 
         unprocessed_user = session.query(User).filter_by(registered_at=-1).all()
         batch_size = 50
@@ -229,6 +241,8 @@ async def main(engine: Engine):
             batch = unprocessed_user[i : i + batch_size]  # noqa: E203
             searchcaster_fetcher = SearchcasterFetcher(batch)
             updated_users = await searchcaster_fetcher.fetch()
-            save_objects(session, updated_users)
+            await database_writer.run(
+                lambda session: save_objects(session, updated_users)
+            )
 
-        delete_unregistered_users(session)
+        await database_writer.run(delete_unregistered_users)
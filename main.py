@@ -1,10 +1,12 @@
 import asyncio
 import os
 import time
+from typing import List, Optional
 
+import requests
 import typer
 from dotenv import load_dotenv, set_key
-from sqlalchemy import create_engine
+from sqlalchemy.pool import SingletonThreadPool
 
 from indexer.casts import main as cast_indexer_main
 from indexer.ensdata import main as ensdata_indexer_main
@@ -12,20 +14,72 @@ from indexer.eth import main as eth_indexer_main
 from indexer.reactions import main as reaction_indexer_main
 from indexer.user_eth_association import main as user_eth_association_main
 from indexer.users import main as user_indexer_main
+from packager.archive import archived_tables
+from packager.archive import main as archiver_main
+from packager.download import (
+    apply_deltas,
+    download_package,
+    download_tables,
+    load_parquet_files,
+)
 from packager.download import main as downloader_main
+from packager.package import ARCHIVE_EXTENSIONS
 from packager.package import main as packager_main
 from packager.upload import main as uploader_main
-from utils.models import Base
-from utils.query import execute_natural_language_query, execute_raw_sql
+from utils.db import DB_PATH, PROFILES, create_sqlite_engine
+from utils.duckdb_query import parquet_tables
+from utils.migrations import is_up_to_date, migrate
+from utils.runner import QueryRunner
+from utils.shell import run_shell
+from utils.storage import configure_storage, convert_to_compact
+from utils.views import refresh_views, reset_views
+from utils.writer import DatabaseWriter
 
-db_path = "datasets/datasets.db"
-engine = create_engine(f"sqlite:///{db_path}")
+db_path = DB_PATH
 
 if not os.path.exists(os.path.dirname(db_path)):
     os.makedirs(os.path.dirname(db_path))
 
-if not os.path.exists(db_path):
-    Base.metadata.create_all(engine)
+# Set by the --profile option, overrides the profiles picked by the commands
+profile_override = None
+
+
+def get_engine(profile: str, **kwargs):
+    """The DB engine, with the SQLite profile suited to the command."""
+    engine = create_sqlite_engine(
+        f"sqlite:///{db_path}", profile_override or profile, **kwargs
+    )
+    configure_storage(engine)
+    migrate(engine)
+    return engine
+
+
+def get_query_engine(parquet_dir: Optional[str] = None, **kwargs):
+    """
+    The DB engine of the query commands and the Parquet files they query.
+    They don't write the schema of a database an indexer may be writing
+    to, one that needs migrating is refused. Without a database, they
+    query the Parquet files downloaded to its directory.
+    """
+    if not os.path.exists(db_path):
+        parquet_dir = parquet_dir or os.path.dirname(db_path)
+        if not parquet_tables(parquet_dir):
+            raise ValueError("there is no data yet, run `python main.py download`.")
+        # Holds the query cache, for the session only
+        engine = create_sqlite_engine("sqlite://", profile_override or "read")
+        configure_storage(engine)
+        migrate(engine)
+        return engine, parquet_dir
+
+    engine = create_sqlite_engine(
+        f"sqlite:///{db_path}", profile_override or "read", **kwargs
+    )
+    configure_storage(engine)
+    if not is_up_to_date(engine):
+        raise ValueError(
+            "the database schema is out of date, run `python main.py migrate`."
+        )
+    return engine, parquet_dir
 
 
 load_dotenv()
@@ -41,6 +95,18 @@ app.add_typer(indexer_app, name="indexer")
 app.add_typer(env_app, name="env")
 
 
+@app.callback()
+def select_profile(
+    profile: str = typer.Option(
+        None,
+        help=f"SQLite profile ({', '.join(PROFILES)}), "
+        "instead of the one picked by the command.",
+    ),
+):
+    global profile_override
+    profile_override = profile
+
+
 def update_warpcast_key():
     dotenv_path = ".env"
     global warpcast_hub_key
@@ -114,9 +180,30 @@ def refresh_all_data():
             "Error: you need to set the environment variables WARPCAST_HUB_KEY and ALCHEMY_API_KEY. Run `python main.py env all` to do so."
         )
         return
-    asyncio.run(user_indexer_main())
-    cast_indexer_main()
-    asyncio.run(eth_indexer_main())
+    asyncio.run(run_all_indexers(get_engine("bulk")))
+
+
+async def run_all_indexers(engine):
+    """
+    Runs the indexers concurrently, their writes serialized by one writer,
+    then associates the new transactions with users and refreshes the
+    materialized views.
+    """
+    with DatabaseWriter(engine) as writer:
+        indexers = {
+            "user": user_indexer_main(engine, writer),
+            "cast": asyncio.to_thread(cast_indexer_main, engine, writer),
+            "reaction": reaction_indexer_main(engine, writer),
+            "ens": ensdata_indexer_main(engine, writer=writer),
+            "eth": eth_indexer_main(engine, writer=writer),
+        }
+        results = await asyncio.gather(*indexers.values(), return_exceptions=True)
+        for name, result in zip(indexers, results):
+            if isinstance(result, Exception):
+                print(f"Error: the {name} indexer failed. {result}")
+
+        await asyncio.to_thread(user_eth_association_main, engine, writer)
+    refresh_views(engine)
 
 
 @indexer_app.command("user")
@@ -128,7 +215,9 @@ def refresh_user_data():
         )
         return
 
+    engine = get_engine("bulk")
     asyncio.run(user_indexer_main(engine))
+    refresh_views(engine)
 
 
 @indexer_app.command("cast")
@@ -140,7 +229,9 @@ def refresh_cast_data():
         )
         return
 
+    engine = get_engine("bulk")
     cast_indexer_main(engine)
+    refresh_views(engine)
 
 
 @indexer_app.command("reaction")
@@ -152,11 +243,22 @@ def refresh_reaction_data():
         )
         return
 
-    asyncio.run(reaction_indexer_main(engine))
+    asyncio.run(reaction_indexer_main(get_engine("bulk")))
 
 
 @indexer_app.command("eth")
-def refresh_eth_data():
+def refresh_eth_data(
+    concurrency: int = typer.Option(10, help="Number of addresses fetched at once."),
+    cups: int = typer.Option(
+        330, help="Alchemy compute units per second budget for your plan."
+    ),
+    whale_pages: int = typer.Option(
+        5, help="Pages after which an address is split into block-range shards."
+    ),
+    shards: int = typer.Option(
+        8, help="Number of shards a whale address is split into."
+    ),
+):
     """Refresh onchain Ethereum data."""
     if not alchemy_api_key:
         print(
@@ -164,27 +266,83 @@ def refresh_eth_data():
         )
         return
 
-    asyncio.run(eth_indexer_main(engine))
+    asyncio.run(
+        eth_indexer_main(
+            get_engine("bulk"),
+            concurrency=concurrency,
+            cu_per_second=cups,
+            whale_pages=whale_pages,
+            shard_count=shards,
+        )
+    )
 
 
 @indexer_app.command("ens")
-def refresh_ens_data():
+def refresh_ens_data(
+    ttl_days: int = typer.Option(7, help="Refresh ENS data older than this many days."),
+):
     """Refresh ENS data."""
 
-    asyncio.run(ensdata_indexer_main(engine))
+    asyncio.run(ensdata_indexer_main(get_engine("bulk"), ttl_days=ttl_days))
 
 
 @indexer_app.command("usereth")
 def make_user_eth_association():
     """Make user-eth association table."""
 
-    user_eth_association_main(engine)
+    user_eth_association_main(get_engine("bulk"))
+
+
+@indexer_app.command("views")
+def refresh_materialized_views(
+    rebuild: bool = typer.Option(
+        False, help="Recompute the views from scratch, without the archived rows."
+    ),
+):
+    """Refresh the mv_* tables of precomputed aggregates."""
+    engine = get_engine("bulk")
+    if rebuild:
+        with engine.begin() as connection:
+            reset_views(connection)
+    refresh_views(engine)
 
 
 @app.command()
-def download():
+def download(
+    parquet_only: bool = typer.Option(
+        False,
+        help="Only extract the Parquet files, `query` reads them without "
+        "importing them into the database.",
+    ),
+    delta: List[str] = typer.Option(
+        None,
+        help="Apply this delta package, a URL or a file, instead of downloading "
+        "the full package. Repeat it to apply a chain of deltas.",
+    ),
+    table: List[str] = typer.Option(
+        None,
+        help="Only download this table, repeat it for several. Files already "
+        "downloaded and matching the manifest are kept.",
+    ),
+    archive: bool = typer.Option(
+        False, help="Download the whole package as a single archive instead."
+    ),
+):
     """Download datasets."""
-    downloader_main()
+    try:
+        if delta:
+            apply_deltas(get_engine("bulk"), delta)
+        elif archive:
+            directory = download_package(os.path.dirname(db_path))
+            if not parquet_only:
+                load_parquet_files(get_engine("bulk"), directory)
+        elif parquet_only:
+            directory = download_tables(os.path.dirname(db_path), table)
+            print(f"Downloaded the Parquet files to {directory}")
+        else:
+            downloader_main(get_engine("bulk"), table)
+    except (ValueError, requests.RequestException) as e:
+        print(f"Error: {e}")
 
 
 @app.command()
@@ -194,9 +352,59 @@ def upload():
 
 
 @app.command()
-def package():
+def package(
+    compression: str = typer.Option(
+        "zstd", help="zstd, or gzip for tools that can't extract .tar.zst files."
+    ),
+    workers: int = typer.Option(
+        None, help="Tables exported in parallel, one per core by default."
+    ),
+    since: str = typer.Option(
+        None,
+        help="Directory of the release.json of a previous release, to package "
+        "only the rows added or changed since then.",
+    ),
+):
     """Package and zip datasets."""
-    packager_main()
+    if compression not in ARCHIVE_EXTENSIONS:
+        print(f"Error: choose a compression among {', '.join(ARCHIVE_EXTENSIONS)}.")
+        return
+    packager_main(
+        profile_override or "read",
+        compression=compression,
+        workers=workers,
+        since=since,
+    )
+
+
+@app.command("migrate")
+def migrate_database():
+    """Bring the DB schema up to date, the query commands don't."""
+    get_engine("safe")
+
+
+@app.command()
+def compact():
+    """Convert the DB to the compact storage schema."""
+    if not typer.confirm(
+        "Hashes and addresses will be stored as BLOBs and common strings as "
+        "integer codes. Raw SQL has to use unhex0x('0x...') to filter on them. "
+        "Continue?"
+    ):
+        return
+
+    convert_to_compact(get_engine("safe"))
+
+
+@app.command()
+def archive(
+    older_than_days: int = typer.Option(
+        180, help="Archive casts, reactions and eth transactions older than this."
+    ),
+    vacuum: bool = typer.Option(True, help="Reclaim the space freed in the DB."),
+):
+    """Move old rows to month-partitioned Parquet files in datasets/archive."""
+    archiver_main(get_engine("bulk"), older_than_days, vacuum=vacuum)
 
 
 @app.command()
@@ -209,6 +417,31 @@ def query(
     csv: bool = typer.Option(
         False, help="Save the result to a CSV file. Format: {unix_timestamp}.csv"
     ),
+    duckdb: bool = typer.Option(
+        False, help="Run read queries with DuckDB, faster for aggregations."
+    ),
+    parquet_dir: str = typer.Option(
+        None,
+        help="Query the Parquet files of a package instead, with DuckDB or "
+        "Polars without it.",
+    ),
+    limit: int = typer.Option(None, help="Return at most this many rows."),
+    cache: bool = typer.Option(
+        True,
+        help="Reuse the results of queries whose tables are unchanged and the SQL "
+        "of questions asked before.",
+    ),
+    output: str = typer.Option(
+        None,
+        help="Stream the result to a .csv, .parquet or .ndjson file instead of "
+        "printing it, for results larger than memory.",
+    ),
+    timeout: float = typer.Option(
+        120, help="Cancel read queries after this many seconds, 0 to never."
+    ),
+    create_indexes: bool = typer.Option(
+        False, help="Create the indexes suggested for queries scanning large tables."
+    ),
 ):
     if not openai_api_key and raw is None:
         print(
@@ -216,18 +449,35 @@ def query(
         )
         return
 
+    try:
+        engine, parquet_dir = get_query_engine(parquet_dir)
+        runner = QueryRunner(
+            engine,
+            duckdb=duckdb,
+            parquet_dir=parquet_dir,
+            archive=archived_tables(),
+            limit=limit,
+            cache=cache,
+            output=output,
+            timeout=timeout,
+            create_indexes=create_indexes,
+        )
+    except (ImportError, ValueError) as e:
+        typer.echo(f"Error: {e}")
+        return
+
     if raw:
         if os.path.exists(raw):
             try:
                 with open(raw, "r") as f:
                     raw_sql = f.read()
-                    df = execute_raw_sql(engine, raw_sql)
+                    df = runner.execute(raw_sql)
             except Exception as e:
                 typer.echo(f"Error: Could not execute SQL from file. {str(e)}")
         else:
-            df = execute_raw_sql(engine, raw)
+            df = runner.execute(raw)
     elif query:
-        df = execute_natural_language_query(engine, query)
+        df = runner.ask(query)
     # elif advanced:
     #     execute_advanced_query(advanced)
     else:
@@ -241,5 +491,40 @@ def query(
         df.write_csv(f"{int(time.time())}.csv")
 
 
+@app.command()
+def shell(
+    duckdb: bool = typer.Option(
+        False, help="Run read queries with DuckDB, faster for aggregations."
+    ),
+    parquet_dir: str = typer.Option(
+        None, help="Query the Parquet files of a package instead."
+    ),
+    timeout: float = typer.Option(
+        120, help="Cancel read queries after this many seconds, 0 to never."
+    ),
+    create_indexes: bool = typer.Option(
+        False, help="Create the indexes suggested for queries scanning large tables."
+    ),
+):
+    """Query interactively, keeping the database connection warm."""
+    try:
+        # One connection kept open, with its page cache, for the session
+        engine, parquet_dir = get_query_engine(
+            parquet_dir, poolclass=SingletonThreadPool
+        )
+        runner = QueryRunner(
+            engine,
+            duckdb=duckdb,
+            parquet_dir=parquet_dir,
+            archive=archived_tables(),
+            timeout=timeout,
+            create_indexes=create_indexes,
+        )
+    except (ImportError, ValueError) as e:
+        typer.echo(f"Error: {e}")
+        return
+    run_shell(runner)
+
+
 if __name__ == "__main__":
     app()
@@ -0,0 +1,124 @@
+import os
+import time
+from typing import Dict
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from sqlalchemy import Integer, Table, func, literal_column, select
+from sqlalchemy.engine import Engine
+
+from packager.schema import arrow_schema
+from utils.models import Cast, EthTransaction, Reaction
+from utils.state import bump_data_versions
+
+ARCHIVE_DIR = "datasets/archive"
+
+# Tables moved to the archive, by their unix ms timestamp column
+ARCHIVED_TABLES: Dict[Table, str] = {
+    Cast.__table__: "timestamp",
+    Reaction.__table__: "timestamp",
+    EthTransaction.__table__: "timestamp",
+}
+
+
+def month_partitions(table: pa.Table, timestamp_column: str) -> pa.Array:
+    """'YYYY-MM' of every row's unix ms timestamp, in UTC."""
+    timestamps = pc.cast(table.column(timestamp_column), pa.timestamp("ms", tz="UTC"))
+    return pc.strftime(timestamps, format="%Y-%m")
+
+
+def archive_table(
+    engine: Engine,
+    table: Table,
+    timestamp_column: str,
+    cutoff: int,
+    archive_dir: str = ARCHIVE_DIR,
+    chunk_size: int = 100000,
+) -> int:
+    """
+    Moves the rows of `table` older than `cutoff` (unix ms) to Parquet files
+    partitioned by month under `archive_dir`/`table`/month=YYYY-MM/. The
+    newest row is always kept, the indexers resume from it, and so is the
+    row with the highest rowid. Returns the number of rows archived.
+    """
+    timestamp = table.c[timestamp_column]
+    rowid = literal_column(f"{table.name}.rowid", Integer)
+    with engine.connect() as connection:
+        newest, last_rowid = connection.execute(
+            select(func.max(timestamp), func.max(rowid))
+        ).one()
+    if newest is None:
+        return 0
+    cutoff = min(cutoff, newest)
+    # Rows inserted while archiving are left for the next run. Without the
+    # highest rowid, SQLite would give it to the next insert, which rowid
+    # watermarks (views, associations, deltas) would then skip.
+    to_archive = [timestamp < cutoff, rowid < last_rowid]
+
+    table_dir = os.path.join(archive_dir, table.name)
+    run = int(time.time() * 1000)
+    schema = arrow_schema(table)
+    written_files = []
+    archived = 0
+
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            select(table).where(*to_archive)
+        )
+        for number, rows in enumerate(result.partitions(chunk_size)):
+            chunk = pa.Table.from_pylist([dict(row._mapping) for row in rows], schema)
+            chunk = chunk.append_column(
+                "month", month_partitions(chunk, timestamp_column)
+            )
+            ds.write_dataset(
+                chunk,
+                table_dir,
+                format="parquet",
+                partitioning=["month"],
+                partitioning_flavor="hive",
+                basename_template=f"part-{run}-{number}-{{i}}.parquet",
+                existing_data_behavior="overwrite_or_ignore",
+                file_visitor=lambda file: written_files.append(file.path),
+            )
+            archived += len(chunk)
+
+    if not archived:
+        return 0
+
+    try:
+        with engine.begin() as connection:
+            connection.execute(table.delete().where(*to_archive))
+            bump_data_versions(connection, [table.name])
+    except Exception:
+        # The rows are still in the database, don't archive them twice
+        for path in written_files:
+            os.remove(path)
+        raise
+    return archived
+
+
+def main(engine: Engine, older_than_days: int, vacuum: bool = True):
+    cutoff = int((time.time() - older_than_days * 24 * 3600) * 1000)
+    for table, timestamp_column in ARCHIVED_TABLES.items():
+        print(f"Archiving {table.name}...")
+        archived = archive_table(engine, table, timestamp_column, cutoff)
+        print(f"Archived {archived} rows of {table.name}")
+
+    if vacuum:
+        with engine.connect() as connection:
+            print("Vacuuming...")
+            connection.execution_options(isolation_level="AUTOCOMMIT").exec_driver_sql(
+                "VACUUM"
+            )
+
+
+def archived_tables(archive_dir: str = ARCHIVE_DIR) -> Dict[str, str]:
+    """Glob of the Parquet files of every archived table, by table name."""
+    if not os.path.isdir(archive_dir):
+        return {}
+    return {
+        name: os.path.join(archive_dir, name, "*", "*.parquet")
+        for name in sorted(os.listdir(archive_dir))
+        if os.path.isdir(os.path.join(archive_dir, name))
+    }
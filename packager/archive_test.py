@@ -0,0 +1,166 @@
+import os
+import tempfile
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from indexer.user_eth_association import update_associations
+from packager.archive import archive_table, archived_tables
+from packager.package import create_temporary_directory, export_release
+from packager.schema import arrow_schema
+from utils.duckdb_query import connect_duckdb
+from utils.migrations import migrate
+from utils.models import Cast, EthTransaction
+
+APRIL_2023 = 1681623420000
+DAY = 24 * 3600 * 1000
+ALICE = "0x" + "a1" * 20
+
+
+@pytest.fixture
+def tmpdirname():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield tmpdirname
+
+
+def make_cast(number: int, timestamp: int) -> Cast:
+    hash = f"0x{number:064x}"
+    return Cast(
+        hash=hash, thread_hash=hash, text="gm", timestamp=timestamp, author_fid=1
+    )
+
+
+def make_transaction(unique_id: str, timestamp: int) -> EthTransaction:
+    return EthTransaction(
+        unique_id=unique_id,
+        hash=f"0x{unique_id}",
+        timestamp=timestamp,
+        block_num=0,
+        from_address=ALICE,
+        category="external",
+    )
+
+
+def populate(tmpdirname):
+    engine = create_engine(f"sqlite:///{os.path.join(tmpdirname, 'test.db')}")
+    migrate(engine)
+    with sessionmaker(bind=engine)() as session:
+        session.add_all(
+            [
+                make_cast(1, APRIL_2023 - 40 * DAY),
+                make_cast(2, APRIL_2023 - 2 * DAY),
+                make_cast(3, APRIL_2023),
+                make_cast(4, APRIL_2023 + DAY),
+            ]
+        )
+        session.commit()
+    return engine
+
+
+def test_archive_table(tmpdirname):
+    engine = populate(tmpdirname)
+    archive_dir = os.path.join(tmpdirname, "archive")
+
+    archived = archive_table(
+        engine, Cast.__table__, "timestamp", APRIL_2023, archive_dir, chunk_size=1
+    )
+    assert archived == 2
+
+    with sessionmaker(bind=engine)() as session:
+        hot = sorted(cast.timestamp for cast in session.query(Cast))
+    assert hot == [APRIL_2023, APRIL_2023 + DAY]
+
+    cold = ds.dataset(
+        os.path.join(archive_dir, "casts"), format="parquet", partitioning="hive"
+    ).to_table()
+    assert sorted(cold.column("timestamp").to_pylist()) == [
+        APRIL_2023 - 40 * DAY,
+        APRIL_2023 - 2 * DAY,
+    ]
+    assert sorted(os.listdir(os.path.join(archive_dir, "casts"))) == [
+        "month=2023-03",
+        "month=2023-04",
+    ]
+    assert cold.column("hash").to_pylist()[0].startswith("0x")
+
+
+def test_archive_table_keeps_newest_row(tmpdirname):
+    engine = populate(tmpdirname)
+    archive_dir = os.path.join(tmpdirname, "archive")
+
+    archived = archive_table(
+        engine, Cast.__table__, "timestamp", APRIL_2023 * 2, archive_dir
+    )
+    assert archived == 3
+    with sessionmaker(bind=engine)() as session:
+        assert session.query(Cast).one().timestamp == APRIL_2023 + DAY
+
+
+def test_unified_view(tmpdirname):
+    pytest.importorskip("duckdb")
+    engine = populate(tmpdirname)
+    archive_dir = os.path.join(tmpdirname, "archive")
+    archive_table(engine, Cast.__table__, "timestamp", APRIL_2023, archive_dir)
+
+    # The hot rows, as packaged
+    package_dir = os.path.join(tmpdirname, "package")
+    os.mkdir(package_dir)
+    with engine.connect() as connection:
+        rows = connection.execute(select(Cast.__table__)).fetchall()
+    pq.write_table(
+        pa.Table.from_pylist(
+            [dict(row._mapping) for row in rows], arrow_schema(Cast.__table__)
+        ),
+        os.path.join(package_dir, "casts.parquet"),
+    )
+
+    connection = connect_duckdb(
+        parquet_dir=package_dir, archive=archived_tables(archive_dir)
+    )
+    count, first = connection.execute(
+        "SELECT count(*), min(timestamp) FROM casts"
+    ).fetchone()
+    assert (count, first) == (4, APRIL_2023 - 40 * DAY)
+
+
+def test_archive_table_keeps_the_highest_rowid(tmpdirname, make_user):
+    engine = create_engine(f"sqlite:///{os.path.join(tmpdirname, 'test.db')}")
+    migrate(engine)
+    with sessionmaker(bind=engine)() as session:
+        session.add_all(
+            [
+                make_user(1, ALICE),
+                make_transaction("t1", APRIL_2023),
+                # Indexed last, but the oldest
+                make_transaction("t2", APRIL_2023 - 400 * DAY),
+            ]
+        )
+        session.commit()
+    with engine.begin() as connection:
+        update_associations(connection)
+    db_path = os.path.join(tmpdirname, "test.db")
+    base = export_release(
+        db_path, "read", create_temporary_directory(os.path.join(tmpdirname, "full"))
+    )["watermarks"]
+
+    archive_table(
+        engine,
+        EthTransaction.__table__,
+        "timestamp",
+        APRIL_2023 - DAY,
+        os.path.join(tmpdirname, "archive"),
+    )
+    with sessionmaker(bind=engine)() as session:
+        session.add(make_transaction("t3", APRIL_2023 + DAY))
+        session.commit()
+
+    with engine.begin() as connection:
+        assert update_associations(connection) == 1
+    delta_dir = create_temporary_directory(os.path.join(tmpdirname, "delta"))
+    export_release(db_path, "read", delta_dir, workers=1, base=base)
+    delta = pq.read_table(os.path.join(delta_dir, "eth_transactions.parquet"))
+    assert delta.column("unique_id").to_pylist() == ["t3"]
@@ -0,0 +1,218 @@
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import pyarrow.parquet as pq
+from sqlalchemy import Table, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection, Engine
+
+from indexer.user_eth_association import association_select, build_associations
+from utils.models import Base, User, user_eth_transactions_association
+from utils.state import bump_data_versions, get_state, set_state, warpy_state
+
+# Describes a package: its kind, watermarks and, for deltas, those of the
+# release they apply on
+RELEASE_FILE = "release.json"
+
+# Watermarks of the release the database's rows come from
+RELEASE_KEY = "release.watermarks"
+
+# Rows read from a delta's Parquet files at a time
+APPLY_BATCH_SIZE = 50000
+
+Release = Dict[str, Any]
+
+
+class DeltaRule(NamedTuple):
+    # The rows a delta includes, in SQL over the watermarks of the previous
+    # release. Rows at a timestamp watermark are included again, as rows
+    # with the same timestamp may have been indexed after it was taken.
+    where: str
+    # Columns identifying a row in any database, the primary key by default
+    key: Optional[Tuple[str, ...]] = None
+
+
+# Tables only ever appended to, or with a timestamp of their last change.
+# Transactions are indexed in any block order, by address, and reactions
+# are saved after their casts, whatever their age, so these tables use the
+# rowid, which follows insertion order.
+# The others (users, whose counts change, and locations) are small and
+# replaced whole.
+DELTA_RULES: Dict[str, DeltaRule] = {
+    "casts": DeltaRule("timestamp >= :latest_cast_timestamp"),
+    "reactions": DeltaRule("rowid > :reactions_rowid"),
+    "eth_transactions": DeltaRule("rowid > :eth_transactions_rowid"),
+    "erc1155_metadata": DeltaRule(
+        "rowid > :erc1155_metadata_rowid",
+        # ids are assigned by each database
+        key=("eth_transaction_hash", "token_id"),
+    ),
+    # Associations of the delta's transactions, and those built since, as
+    # transactions may be associated after they are packaged. The users
+    # whose address changed are associated again by the client.
+    "user_eth_transactions": DeltaRule(
+        "eth_transaction_unique_id IN (SELECT unique_id FROM eth_transactions "
+        "WHERE rowid > :eth_transactions_rowid) "
+        "OR rowid > :user_eth_transactions_rowid",
+        key=("user_fid", "eth_transaction_unique_id"),
+    ),
+    "ens_data": DeltaRule("fetched_at >= :packaged_at"),
+}
+
+# The watermarks of a release and the queries computing them
+WATERMARK_QUERIES = {
+    "latest_cast_timestamp": "SELECT MAX(timestamp) FROM casts",
+    "highest_fid": "SELECT MAX(author_fid) FROM casts",
+    "highest_block_num": "SELECT MAX(block_num) FROM eth_transactions",
+    "reactions_rowid": "SELECT MAX(rowid) FROM reactions",
+    "eth_transactions_rowid": "SELECT MAX(rowid) FROM eth_transactions",
+    "erc1155_metadata_rowid": "SELECT MAX(rowid) FROM erc1155_metadata",
+    "user_eth_transactions_rowid": "SELECT MAX(rowid) FROM user_eth_transactions",
+}
+
+
+def release_watermarks(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Where the rows of the database stop, deltas start from there."""
+    watermarks = {
+        name: conn.execute(query).fetchone()[0] or 0
+        for name, query in WATERMARK_QUERIES.items()
+    }
+    watermarks["packaged_at"] = int(time.time() * 1000)
+    return watermarks
+
+
+def delta_filters(tables: List[str]) -> Dict[str, Optional[str]]:
+    """The condition on the rows of every table in a delta, None for all rows."""
+    return {
+        table: DELTA_RULES[table].where if table in DELTA_RULES else None
+        for table in tables
+    }
+
+
+def write_release(path: str, release: Release) -> None:
+    with open(path, "w") as f:
+        json.dump(release, f, indent=2, sort_keys=True)
+
+
+def read_release(directory: str) -> Optional[Release]:
+    path = os.path.join(directory, RELEASE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def database_release(connection: Connection) -> Optional[Dict[str, int]]:
+    value = get_state(connection, RELEASE_KEY)
+    return None if value is None else json.loads(value)
+
+
+def set_database_release(connection: Connection, release: Optional[Release]) -> None:
+    if release is None:
+        # Without watermarks, no delta can be applied on the rows
+        connection.execute(warpy_state.delete().where(warpy_state.c.key == RELEASE_KEY))
+    else:
+        set_state(connection, RELEASE_KEY, json.dumps(release["watermarks"]))
+
+
+def upsert_rows(
+    connection: Connection, table: Table, rows: List[Dict[str, Any]]
+) -> None:
+    """Inserts `rows`, updating those already in `table` in place."""
+    rule = DELTA_RULES.get(table.name)
+    key = list(rule.key or []) if rule else []
+    key = key or [column.name for column in table.primary_key]
+    columns = [
+        column.name
+        for column in table.columns
+        if column.name in key or not column.primary_key
+    ]
+    rows = [{column: row.get(column) for column in columns} for row in rows]
+    statement = sqlite_insert(table)
+    updated = {
+        column: statement.excluded[column] for column in columns if column not in key
+    }
+    if updated:
+        statement = statement.on_conflict_do_update(index_elements=key, set_=updated)
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=key)
+    connection.execute(statement, rows)
+
+
+def rebuild_changed_associations(
+    connection: Connection, addresses: Dict[int, Optional[str]]
+) -> None:
+    """
+    Associates again the users who are new or whose address differs from
+    `addresses`. The delta only holds the associations of new transactions.
+    """
+    changed = [
+        fid
+        for fid, address in connection.execute(select(User.fid, User.address))
+        if addresses.get(fid) != address
+    ]
+    if not changed:
+        return
+    association = user_eth_transactions_association
+    connection.execute(association.delete().where(association.c.user_fid.in_(changed)))
+    build_associations(connection, association_select(User.fid.in_(changed)))
+
+
+def apply_delta(engine: Engine, directory: str) -> bool:
+    """
+    Applies the delta package extracted in `directory` to the database,
+    which must hold the release the delta starts from. Upserts keep the
+    rowids of existing rows, so incremental views don't count them twice.
+    Returns False when the delta was already applied.
+    """
+    release = read_release(directory)
+    if release is None or release.get("kind") != "delta":
+        raise ValueError(f"{directory} doesn't hold a delta package")
+
+    with engine.begin() as connection:
+        current = database_release(connection)
+        if current == release["watermarks"]:
+            return False
+        if current != release["base"]:
+            raise ValueError(
+                "The delta applies on the release with the watermarks "
+                f"{release['base']}, the database holds {current}. Apply the "
+                "deltas in between, or download the full package again."
+            )
+
+        files = {
+            os.path.splitext(file)[0]
+            for file in os.listdir(directory)
+            if file.endswith(".parquet")
+        }
+        for table_name in sorted(files - set(Base.metadata.tables)):
+            print(f"Warning: skipping {table_name}.parquet, not a known table.")
+        addresses = dict(connection.execute(select(User.fid, User.address)).all())
+
+        tables = []
+        # Parents first, users are replaced before their associations
+        for table in Base.metadata.sorted_tables:
+            if table.name not in files:
+                continue
+            replaced = table.name in release["replaced"]
+            if replaced:
+                connection.execute(table.delete())
+            elif table is user_eth_transactions_association:
+                rebuild_changed_associations(connection, addresses)
+            path = os.path.join(directory, f"{table.name}.parquet")
+            parquet_file = pq.ParquetFile(path)
+            for batch in parquet_file.iter_batches(batch_size=APPLY_BATCH_SIZE):
+                rows = batch.to_pylist()
+                if replaced:
+                    connection.execute(table.insert(), rows)
+                else:
+                    upsert_rows(connection, table, rows)
+            print(f"Applied {parquet_file.metadata.num_rows:,} rows to {table.name}")
+            tables.append(table.name)
+
+        bump_data_versions(connection, tables)
+        set_database_release(connection, release)
+    return True
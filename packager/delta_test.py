@@ -0,0 +1,173 @@
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from indexer.user_eth_association import update_associations
+from packager.delta import apply_delta, read_release
+from packager.download import load_parquet_files
+from packager.package import create_temporary_directory, export_release
+from utils.migrations import migrate
+from utils.models import Base
+
+
+def insert_rows(engine, casts, follower_count):
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "INSERT OR REPLACE INTO users (fid, display_name, following_count, "
+                "follower_count, verified, generated_farcaster_address) "
+                "VALUES (1, 'alice', 0, :follower_count, 0, '0x1')"
+            ),
+            {"follower_count": follower_count},
+        )
+        for hash, timestamp in casts:
+            connection.execute(
+                text(
+                    "INSERT INTO casts (hash, thread_hash, text, timestamp, "
+                    "author_fid) VALUES (:hash, :hash, 'gm', :timestamp, 1)"
+                ),
+                {"hash": hash, "timestamp": timestamp},
+            )
+
+
+def insert_reaction(engine, hash, timestamp):
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "INSERT INTO reactions (hash, reaction_type, timestamp, "
+                "target_hash, author_fid) VALUES (:hash, 'like', :timestamp, "
+                "'0x01', 1)"
+            ),
+            {"hash": hash, "timestamp": timestamp},
+        )
+
+
+def cast_hashes(engine):
+    with engine.connect() as connection:
+        return [
+            row[0]
+            for row in connection.execute(text("SELECT hash FROM casts ORDER BY hash"))
+        ]
+
+
+def test_delta_packages_apply_on_their_base_release():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source_path = os.path.join(tmpdirname, "source.db")
+        source = create_engine(f"sqlite:///{source_path}")
+        Base.metadata.create_all(source)
+        insert_rows(source, [("0x01", 1000), ("0x02", 2000)], follower_count=5)
+        insert_reaction(source, "0xa1", 2000)
+
+        full_dir = create_temporary_directory(os.path.join(tmpdirname, "full"))
+        full = export_release(source_path, "read", full_dir, workers=1)
+        assert full["kind"] == "full"
+
+        target = create_engine(f"sqlite:///{os.path.join(tmpdirname, 'target.db')}")
+        load_parquet_files(target, full_dir)
+
+        insert_rows(source, [("0x03", 3000)], follower_count=7)
+        # Reactions are fetched after their casts, older than the newest one
+        insert_reaction(source, "0xa2", 1500)
+        delta_dir = create_temporary_directory(os.path.join(tmpdirname, "delta"))
+        delta = export_release(
+            source_path, "read", delta_dir, workers=1, base=full["watermarks"]
+        )
+        assert read_release(delta_dir) == delta
+        assert "users" in delta["replaced"] and "casts" not in delta["replaced"]
+
+        assert apply_delta(target, delta_dir)
+        assert cast_hashes(target) == ["0x01", "0x02", "0x03"]
+        with target.connect() as connection:
+            assert connection.execute(
+                text("SELECT hash FROM reactions ORDER BY hash")
+            ).scalars().all() == ["0xa1", "0xa2"]
+            assert (
+                connection.execute(text("SELECT follower_count FROM users")).scalar()
+                == 7
+            )
+
+        # Applying it again does nothing, a delta of another base is refused
+        assert not apply_delta(target, delta_dir)
+        other_dir = create_temporary_directory(os.path.join(tmpdirname, "other"))
+        export_release(
+            source_path,
+            "read",
+            other_dir,
+            workers=1,
+            base={**full["watermarks"], "packaged_at": 0},
+        )
+        with pytest.raises(ValueError):
+            apply_delta(target, other_dir)
+
+
+def add_user(connection, fid, address):
+    connection.execute(
+        text(
+            "INSERT OR REPLACE INTO users (fid, display_name, following_count, "
+            "follower_count, verified, generated_farcaster_address, address) "
+            "VALUES (:fid, 'user', 0, 0, 0, '0x1', :address)"
+        ),
+        {"fid": fid, "address": address},
+    )
+
+
+def add_transaction(connection, unique_id, block_num, address):
+    connection.execute(
+        text(
+            "INSERT INTO eth_transactions (unique_id, hash, timestamp, "
+            "block_num, from_address, category) "
+            "VALUES (:id, :id, 0, :block_num, :address, 'external')"
+        ),
+        {"id": unique_id, "block_num": block_num, "address": address},
+    )
+
+
+def associations(engine):
+    with engine.connect() as connection:
+        return connection.execute(
+            text("SELECT * FROM user_eth_transactions ORDER BY 1, 2")
+        ).all()
+
+
+def test_delta_packages_follow_transactions_and_associations():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source_path = os.path.join(tmpdirname, "source.db")
+        source = create_engine(f"sqlite:///{source_path}")
+        migrate(source)
+        with source.begin() as connection:
+            add_user(connection, 1, "0xaa")
+            add_user(connection, 2, "0xbb")
+            add_transaction(connection, "0x01", 100, "0xaa")
+            add_transaction(connection, "0x02", 100, "0xbb")
+            add_transaction(connection, "0x03", 100, "0xcc")
+            update_associations(connection)
+
+        full_dir = create_temporary_directory(os.path.join(tmpdirname, "full"))
+        full = export_release(source_path, "read", full_dir, workers=1)
+        target = create_engine(f"sqlite:///{os.path.join(tmpdirname, 'target.db')}")
+        migrate(target)
+        load_parquet_files(target, full_dir)
+
+        with source.begin() as connection:
+            # Indexed after the release, in an older block
+            add_transaction(connection, "0x04", 50, "0xaa")
+            add_user(connection, 2, "0xcc")
+            update_associations(connection)
+        delta_dir = create_temporary_directory(os.path.join(tmpdirname, "delta"))
+        delta = export_release(
+            source_path, "read", delta_dir, workers=1, base=full["watermarks"]
+        )
+        assert "user_eth_transactions" not in delta["replaced"]
+
+        assert apply_delta(target, delta_dir)
+        assert (
+            associations(target)
+            == associations(source)
+            == [
+                (1, "0x01"),
+                (1, "0x04"),
+                (2, "0x03"),
+            ]
+        )
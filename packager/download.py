@@ -1,57 +1,241 @@
 import os
-import sqlite3
-import tarfile
+import tempfile
+from typing import Any, Dict, List, Optional
 
 import pyarrow.parquet as pq
 import requests
+from sqlalchemy.engine import Engine
 from tqdm import tqdm
 
+from indexer.user_eth_association import reset_associations
+from packager.delta import (
+    APPLY_BATCH_SIZE,
+    RELEASE_FILE,
+    apply_delta,
+    read_release,
+    set_database_release,
+    write_release,
+)
+from packager.package import (
+    MANIFEST_FILE,
+    HashingWriter,
+    compute_hash_of_archive,
+    extract_archive,
+)
+from utils.db import create_sqlite_engine
+from utils.migrations import migrate, set_schema_version
+from utils.models import Base
+from utils.state import bump_data_versions
+from utils.storage import configure_storage
+from utils.views import reset_views
 
-def main():
-    filename = "1681979704072.tar.gz"
-    url = f"https://pub-3916d8c82abb435eb70175747fdc2119.r2.dev/{filename}"
+PACKAGE_URL = "https://pub-3916d8c82abb435eb70175747fdc2119.r2.dev"
+
+MANIFEST_URL = f"{PACKAGE_URL}/{MANIFEST_FILE}"
+
+
+def load_parquet_files(
+    engine: Engine, directory: str, tables: Optional[List[str]] = None
+):
+    """
+    Replaces the rows of every table, or of `tables`, with those of its
+    Parquet file in `directory`, in tables created with the models' keys
+    and indexes, and brings them up to date with the migrations.
+    """
+    migrate(engine)
+    with engine.begin() as connection:
+        # Packages are flat, subdirectories hold the archive and other files
+        for file in sorted(os.listdir(directory)):
+            if file.endswith(".parquet"):
+                table_name = os.path.splitext(file)[0]
+                if tables is not None and table_name not in tables:
+                    continue
+                file_path = os.path.join(directory, file)
+
+                table = Base.metadata.tables.get(table_name)
+                if table is None:
+                    # Read the Parquet file into a Pandas DataFrame
+                    df = pq.read_table(file_path).to_pandas()
+                    df.to_sql(
+                        table_name,
+                        connection,
+                        if_exists="replace",
+                        index=False,
+                        chunksize=50000,
+                    )
+                    continue
 
-    # Download the file
+                # Through the models' column types, which write the storage
+                # format of the database, compact or not
+                connection.execute(table.delete())
+                parquet_file = pq.ParquetFile(file_path)
+                columns = [
+                    name for name in parquet_file.schema_arrow.names if name in table.c
+                ]
+                for batch in parquet_file.iter_batches(
+                    batch_size=APPLY_BATCH_SIZE, columns=columns
+                ):
+                    connection.execute(table.insert(), batch.to_pylist())
+
+        bump_data_versions(connection, Base.metadata.tables)
+        # Deltas apply on the release the rows come from
+        release = read_release(directory)
+        full = release and release["kind"] == "full" and tables is None
+        set_database_release(connection, release if full else None)
+        # Their watermarks are rowids of the replaced rows
+        reset_views(connection)
+        reset_associations(connection)
+        # The package may predate some migrations, run them all on its rows
+        set_schema_version(connection, 0)
+    migrate(engine)
+
+
+def download_file(url: str, path: str, sha256: Optional[str] = None) -> None:
+    """
+    Downloads `url` to `path`, checking its SHA-256 against `sha256` while
+    it streams. `path` is only written once the file is complete and valid.
+    """
     response = requests.get(url, stream=True)
+    response.raise_for_status()
     total_size = int(response.headers.get("content-length", 0))
     block_size = 1024
     progress_bar = tqdm(total=total_size, unit="iB", unit_scale=True)
-    with open(filename, "wb") as f:
+    partial_path = f"{path}.part"
+    with open(partial_path, "wb") as f:
+        writer = HashingWriter(f)
         for data in response.iter_content(block_size):
             progress_bar.update(len(data))
-            f.write(data)
+            writer.write(data)
     progress_bar.close()
 
-    # Get the parent directory of the current script
-    parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    extracted_dir = os.path.join(parent_dir, "datasets")
+    if sha256 is not None and writer.hexdigest() != sha256:
+        os.remove(partial_path)
+        raise ValueError(
+            f"The checksum of {url} doesn't match the manifest's, download it again."
+        )
+    os.replace(partial_path, path)
 
-    if not os.path.exists(extracted_dir):
-        os.mkdir(extracted_dir)
 
-    with tarfile.open(filename, "r:gz") as tar:
-        tar.extractall(path=extracted_dir)
+def fetch_manifest(url: str = MANIFEST_URL) -> Optional[Dict[str, Any]]:
+    """The package manifest, None when the bucket doesn't publish one."""
+    response = requests.get(url)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
 
-    # Create the SQLite database inside the same directory
-    db_path = os.path.join(parent_dir, "datasets", "datasets.db")
-    conn = sqlite3.connect(db_path)
 
-    # Iterate over the extracted Parquet files and write them to the SQLite database
-    for root, dirs, files in os.walk(extracted_dir):
-        for file in files:
-            if file.endswith(".parquet"):
-                table_name = os.path.splitext(file)[0]
-                file_path = os.path.join(root, file)
+def file_is_valid(path: str, entry: Dict[str, Any]) -> bool:
+    """Whether `path` is the file described by the manifest `entry`."""
+    return (
+        os.path.exists(path)
+        and os.path.getsize(path) == entry["bytes"]
+        and compute_hash_of_archive(path) == entry["sha256"]
+    )
+
+
+def download_tables(
+    directory: Optional[str] = None,
+    tables: Optional[List[str]] = None,
+    manifest_url: str = MANIFEST_URL,
+) -> str:
+    """
+    Downloads the Parquet files of `tables`, all by default, listed in the
+    package manifest into `directory`, datasets/ by default. Files already
+    there and valid are kept. Without a manifest, the whole package is
+    downloaded as a single archive instead. Returns the directory.
+    """
+    manifest = fetch_manifest(manifest_url)
+    if manifest is None:
+        if tables:
+            raise ValueError(
+                "The package has no manifest to download single tables from, "
+                "download all of them."
+            )
+        print("The package has no manifest, downloading the whole archive.")
+        return download_package(directory)
+    available = manifest["tables"]
+    tables = tables or list(available)
+    unknown = [table for table in tables if table not in available]
+    if unknown:
+        raise ValueError(
+            f"The package has no table {', '.join(unknown)}, it has "
+            f"{', '.join(available)}."
+        )
+
+    if directory is None:
+        parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+        directory = os.path.join(parent_dir, "datasets")
+    os.makedirs(directory, exist_ok=True)
+
+    base_url = manifest_url.rsplit("/", 1)[0]
+    for table in tables:
+        entry = available[table]
+        path = os.path.join(directory, entry["file"])
+        if file_is_valid(path, entry):
+            print(f"{entry['file']} is up to date")
+            continue
+        print(f"Downloading {entry['file']} ({entry['rows']:,} rows)")
+        download_file(f"{base_url}/{entry['file']}", path, entry["sha256"])
+
+    write_release(os.path.join(directory, RELEASE_FILE), manifest["release"])
+    return directory
+
+
+def download_package(directory: Optional[str] = None) -> str:
+    """
+    Downloads the latest package and extracts its Parquet files into
+    `directory`, datasets/ by default. Returns the directory.
+    """
+    filename = "1681979704072.tar.gz"
+    download_file(f"{PACKAGE_URL}/{filename}", filename)
+
+    if directory is None:
+        # Get the parent directory of the current script
+        parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+        directory = os.path.join(parent_dir, "datasets")
+
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+
+    extract_archive(filename, directory)
+    os.remove(filename)
+    return directory
+
+
+def apply_deltas(engine: Engine, locations: List[str]) -> None:
+    """
+    Applies the delta packages at `locations`, URLs or local archives, in
+    the order they were released.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        releases = []
+        for i, location in enumerate(locations):
+            path = location
+            if location.startswith(("http://", "https://")):
+                path = os.path.join(tmpdir, os.path.basename(location))
+                download_file(location, path)
+            directory = os.path.join(tmpdir, str(i))
+            os.makedirs(directory)
+            extract_archive(path, directory)
+            release = read_release(directory)
+            if release is None:
+                raise ValueError(f"{location} isn't a package")
+            releases.append((release["watermarks"]["packaged_at"], location, directory))
 
-                # Read the Parquet file into a Pandas DataFrame
-                df = pq.read_table(file_path).to_pandas()
+        for _, location, directory in sorted(releases):
+            if apply_delta(engine, directory):
+                print(f"Applied {location}")
+            else:
+                print(f"{location} was already applied")
 
-                # Write the DataFrame to the SQLite database
-                df.to_sql(table_name, conn, if_exists="replace", index=False)
 
-    # Close the connection to the SQLite database
-    conn.close()
+def main(engine: Engine, tables: Optional[List[str]] = None):
+    load_parquet_files(engine, download_tables(tables=tables), tables)
 
 
 if __name__ == "__main__":
-    main()
+    db_path = os.path.join(os.path.dirname(__file__), "..", "datasets", "datasets.db")
+    engine = create_sqlite_engine(f"sqlite:///{os.path.abspath(db_path)}", "bulk")
+    configure_storage(engine)
+    main(engine)
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import tempfile
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+from packager.download import (
+    download_file,
+    download_tables,
+    file_is_valid,
+    load_parquet_files,
+)
+from utils.migrations import migrate
+from utils.storage import configure_storage, convert_to_compact
+
+
+def test_load_parquet_files_keeps_model_schema():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        pd.DataFrame({"address": ["0xAB", "0xcd"], "ens": ["ab.eth", None]}).to_parquet(
+            os.path.join(tmpdirname, "ens_data.parquet")
+        )
+
+        engine = create_engine(f"sqlite:///{os.path.join(tmpdirname, 'test.db')}")
+        load_parquet_files(engine, tmpdirname)
+        # Loading again replaces the rows
+        load_parquet_files(engine, tmpdirname)
+
+        with engine.connect() as connection:
+            rows = connection.execute(
+                text("SELECT address, ens FROM ens_data ORDER BY address")
+            ).fetchall()
+        assert [tuple(row) for row in rows] == [("0xab", "ab.eth"), ("0xcd", None)]
+        assert inspect(engine).get_pk_constraint("ens_data")["constrained_columns"] == [
+            "address"
+        ]
+        assert "ix_casts_timestamp" in {
+            index["name"] for index in inspect(engine).get_indexes("casts")
+        }
+
+
+def test_load_parquet_files_writes_compact_storage():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        pd.DataFrame({"address": ["0xAB"], "ens": ["ab.eth"]}).to_parquet(
+            os.path.join(tmpdirname, "ens_data.parquet")
+        )
+        db_url = f"sqlite:///{os.path.join(tmpdirname, 'test.db')}"
+        engine = create_engine(db_url)
+        configure_storage(engine)
+        migrate(engine)
+        convert_to_compact(engine)
+        engine = create_engine(db_url)
+        configure_storage(engine)
+
+        load_parquet_files(engine, tmpdirname)
+
+        with engine.connect() as connection:
+            stored = connection.execute(
+                text("SELECT typeof(address), hex0x(address) FROM ens_data")
+            ).fetchone()
+        assert tuple(stored) == ("blob", "0xab")
+
+
+class FakeResponse:
+    def __init__(self, content: bytes, status_code: int = 200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {"content-length": str(len(content))}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, block_size):
+        for i in range(0, len(self.content), block_size):
+            yield self.content[i : i + block_size]
+
+
+def test_download_file_verifies_the_checksum(monkeypatch):
+    content = b"parquet bytes" * 100
+    monkeypatch.setattr(
+        "packager.download.requests.get", lambda url, stream: FakeResponse(content)
+    )
+    sha256 = hashlib.sha256(content).hexdigest()
+    entry = {"bytes": len(content), "sha256": sha256}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, "casts.parquet")
+        assert not file_is_valid(path, entry)
+
+        download_file("https://example.com/casts.parquet", path, sha256)
+        assert file_is_valid(path, entry)
+
+        with pytest.raises(ValueError):
+            download_file("https://example.com/casts.parquet", path, "0" * 64)
+        # The valid file is kept, no partial download is left
+        assert file_is_valid(path, entry)
+        assert os.listdir(tmpdirname) == ["casts.parquet"]
+
+
+def test_download_tables_falls_back_to_the_archive(monkeypatch):
+    monkeypatch.setattr(
+        "packager.download.requests.get", lambda url: FakeResponse(b"", 404)
+    )
+    monkeypatch.setattr(
+        "packager.download.download_package", lambda directory: "datasets"
+    )
+    assert download_tables("datasets") == "datasets"
+    with pytest.raises(ValueError):
+        download_tables("datasets", ["casts"])
@@ -1,70 +1,582 @@
 # package.py
 import hashlib
+import json
 import os
+import shutil
 import sqlite3
 import tarfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    cast,
+)
 
-import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
 
+from packager.delta import (
+    RELEASE_FILE,
+    WATERMARK_QUERIES,
+    delta_filters,
+    read_release,
+    release_watermarks,
+    write_release,
+)
+from packager.schema import arrow_schema
+from utils.db import connect_sqlite
+from utils.models import Base
+from utils.state import INTERNAL_TABLE_PREFIX
+from utils.types import DictionaryString, compact_columns, decode_column
+from utils.views import VIEW_TABLE_PREFIX
+
+# Rows read, and written as one Parquet row group, at a time
+CHUNK_SIZE = 100000
+
+HASH_BLOCK_SIZE = 1 << 20
+
+# Compressed by the workers exporting the tables, so on every core
+PARQUET_COMPRESSION = "zstd"
+
+# Rows are written in the order of the column queries filter the table on,
+# so the min/max statistics of a row group let readers skip the others.
+# Transactions are in block order, which is their time order.
+SORT_KEYS = {
+    "casts": "timestamp",
+    "reactions": "timestamp",
+    "eth_transactions": "block_num",
+    "users": "fid",
+}
+
+# Few distinct values, dictionary encoded along with the DictionaryString
+# columns. Hashes and free text aren't, their dictionary would be as large
+# as the column.
+LOW_CARDINALITY_COLUMNS = {
+    "casts": ["author_fid"],
+    "reactions": ["author_fid"],
+    "users": ["verified", "location_id"],
+    "user_eth_transactions": ["user_fid"],
+}
+
+# Archive extension by compression, gzip for tools without zstd support
+ARCHIVE_EXTENSIONS = {"zstd": ".tar.zst", "gzip": ".tar.gz"}
+
+# Lists the published files of a package, see manifest_entry()
+MANIFEST_FILE = "manifest.json"
+
+# Columns whose range is listed in the manifest
+KEY_COLUMNS = {
+    "casts": ["timestamp", "author_fid"],
+    "reactions": ["timestamp"],
+    "eth_transactions": ["timestamp", "block_num"],
+    "users": ["fid"],
+    "ens_data": ["fetched_at"],
+}
+
+# Where the Parquet files, manifest and release.json are written, and
+# published from
+PACKAGE_DIR = "temp_parquet_files"
+
+
+class ExportedTable(NamedTuple):
+    rows: int
+    sha256: str
+
+
+def create_temporary_directory(path: str) -> str:
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def sqlite_arrow_type(declared_type: str) -> pa.DataType:
+    """The Arrow type of a column from its declared type, by SQLite's affinity."""
+    declared_type = declared_type.upper()
+    if "INT" in declared_type:
+        return pa.int64()
+    if any(name in declared_type for name in ("REAL", "FLOA", "DOUB")):
+        return pa.float64()
+    return pa.string()
+
+
+def table_schema(conn: sqlite3.Connection, table: str) -> pa.Schema:
+    """
+    The Arrow schema of `table` as it is in the database, with the types of
+    the models for their columns, by declared type for the others.
+    """
+    model = Base.metadata.tables.get(table)
+    model_fields = (
+        {} if model is None else dict(zip(model.c.keys(), arrow_schema(model)))
+    )
+    fields = []
+    for _, name, declared_type, notnull, _, primary_key in conn.execute(
+        f"PRAGMA table_info('{table}')"
+    ):
+        field = model_fields.get(name)
+        if field is None:
+            field = pa.field(
+                name,
+                sqlite_arrow_type(declared_type),
+                nullable=not (notnull or primary_key),
+            )
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def to_arrow_array(values: List[Any], data_type: pa.DataType) -> pa.Array:
+    try:
+        return pa.array(values, type=data_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if data_type != pa.string():
+            raise
+        # SQLite doesn't enforce types, text columns may hold some numbers
+        return pa.array(
+            [None if value is None else str(value) for value in values],
+            type=data_type,
+        )
+
+
+def is_indexed(conn: sqlite3.Connection, table: str, column: str) -> bool:
+    """Whether an index of `table`, or its rowid, starts with `column`."""
+    for index in conn.execute(f"PRAGMA index_list('{table}')").fetchall():
+        info = conn.execute(f"PRAGMA index_info('{index[1]}')").fetchall()
+        if any(row[0] == 0 and row[2] == column for row in info):
+            return True
+    info = conn.execute(f"PRAGMA table_info('{table}')").fetchall()
+    primary_key = [row for row in info if row[5]]
+    return (
+        len(primary_key) == 1
+        and primary_key[0][1] == column
+        and primary_key[0][2].upper() == "INTEGER"
+    )
+
+
+def iter_table_chunks(
+    conn: sqlite3.Connection,
+    table: str,
+    columns: List[str],
+    chunk_size: int = CHUNK_SIZE,
+    where: Optional[str] = None,
+    params: Optional[Dict[str, Any]] = None,
+    order_by: Optional[str] = None,
+) -> Iterator[List[Tuple]]:
+    """
+    The rows of `table` matching `where` ordered by `order_by`, one of
+    `columns`, then rowid, `chunk_size` at a time. Each chunk starts after
+    the last row of the previous one, so reading it is an index seek
+    whatever the offset, provided `order_by` is indexed.
+    """
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    query = (
+        f"SELECT rowid, {column_list} FROM {table} "
+        f"WHERE ({where or 1}) AND {{}} ORDER BY {{}} LIMIT :chunk_size"
+    )
+    # (condition, order) of each pass, NULLs sort first and row values
+    # comparisons skip them
+    passes = [("rowid > :last_rowid", "rowid")]
+    if order_by is not None:
+        passes = [
+            (f'"{order_by}" IS NULL AND rowid > :last_rowid', "rowid"),
+            (
+                f'("{order_by}", rowid) > (:last_key, :last_rowid)',
+                f'"{order_by}", rowid',
+            ),
+        ]
+    key_index = columns.index(order_by) + 1 if order_by is not None else None
+
+    for condition, order in passes:
+        # Integers sort before text and blobs in SQLite
+        last: Dict[str, Any] = {"last_rowid": -(1 << 63), "last_key": -(1 << 63)}
+        while True:
+            rows = conn.execute(
+                query.format(condition, order),
+                {**(params or {}), **last, "chunk_size": chunk_size},
+            ).fetchall()
+            if not rows:
+                break
+            last = {
+                "last_rowid": rows[-1][0],
+                "last_key": None if key_index is None else rows[-1][key_index],
+            }
+            yield [row[1:] for row in rows]
+
+
+def sort_key(conn: sqlite3.Connection, table: str, columns: List[str]) -> Optional[str]:
+    column = SORT_KEYS.get(table)
+    if column is None or column not in columns:
+        return None
+    if not is_indexed(conn, table, column):
+        print(
+            f"Warning: {table}.{column} isn't indexed, {table} is exported in "
+            "insertion order. Running any indexer migrates the database to index it."
+        )
+        return None
+    return column
+
+
+def writer_options(table: str, schema: pa.Schema) -> Dict[str, Any]:
+    """
+    Parquet writer options for `table`: dictionaries for low-cardinality
+    columns only, deltas for the sort key, zstd and statistics for all.
+    """
+    options: Dict[str, Any] = {
+        "compression": PARQUET_COMPRESSION,
+        "write_statistics": True,
+    }
+    model = Base.metadata.tables.get(table)
+    if model is None:
+        return options
+
+    dictionary = [
+        column.name
+        for column in model.columns
+        if isinstance(column.type, DictionaryString)
+    ] + LOW_CARDINALITY_COLUMNS.get(table, [])
+    options["use_dictionary"] = [name for name in dictionary if name in schema.names]
+    key = SORT_KEYS.get(table)
+    if key in schema.names and schema.field(key).type == pa.int64():
+        # Sorted integers are stored as small differences
+        options["column_encoding"] = {key: "DELTA_BINARY_PACKED"}
+    return options
 
-def main():
-    # Open a connection to the SQLite database
-    parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    db_path = os.path.join(parent_dir, "datasets", "datasets.db")
-    conn = sqlite3.connect(db_path)
 
-    # Get the latest cast timestamp
-    cursor = conn.cursor()
-    cursor.execute("SELECT MAX(timestamp) FROM casts")
-    latest_timestamp = cursor.fetchone()[0]
+class HashingWriter:
+    """Writes to `file`, computing the SHA-256 of what was written on the fly."""
 
-    # Get the highest fid
-    cursor.execute("SELECT MAX(author_fid) FROM casts")
-    highest_fid = cursor.fetchone()[0]
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.closed = False
 
-    # Get the highest block number from the Ethereum transactions
-    cursor.execute("SELECT MAX(block_num) FROM eth_transactions")
-    highest_block_num = cursor.fetchone()[0]
+    def write(self, data: bytes) -> int:
+        self.sha256.update(data)
+        return self.file.write(data)
 
-    # Create a temporary directory to store the Parquet files
-    tmpdir = "temp_parquet_files"
-    if not os.path.exists(tmpdir):
-        os.mkdir(tmpdir)
+    def tell(self) -> int:
+        return self.file.tell()
 
-    # Convert each table to a Parquet file and save it in the temporary directory
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = [x[0] for x in cursor.fetchall()]
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        # The file is closed by its owner
+        self.closed = True
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+
+def write_table_to_parquet(
+    conn: sqlite3.Connection,
+    table: str,
+    path: str,
+    chunk_size: int = CHUNK_SIZE,
+    where: Optional[str] = None,
+    params: Optional[Dict[str, Any]] = None,
+) -> ExportedTable:
+    """
+    Streams the rows of `table` matching `where` to the Parquet file `path`,
+    sorted by its sort key, a row group per chunk so memory doesn't grow
+    with the table and readers can skip row groups by their statistics.
+    The file is hashed as it is written.
+    """
+    schema = table_schema(conn, table)
+    decoded = compact_columns(Base.metadata).get(table, {})
+    order_by = sort_key(conn, table, schema.names)
+    rows_written = 0
+    with open(path, "wb") as f:
+        sink = HashingWriter(f)
+        with pq.ParquetWriter(
+            pa.PythonFile(sink, mode="w"), schema, **writer_options(table, schema)
+        ) as writer:
+            for rows in iter_table_chunks(
+                conn, table, schema.names, chunk_size, where, params, order_by
+            ):
+                arrays = []
+                for field, values in zip(schema, zip(*rows)):
+                    values = list(values)
+                    # Published datasets always use hex strings, whatever the
+                    # storage
+                    if field.name in decoded:
+                        values = decode_column(decoded[field.name], values)
+                    arrays.append(to_arrow_array(values, field.type))
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                rows_written += len(rows)
+    return ExportedTable(rows_written, sink.hexdigest())
+
+
+def convert_tables_to_parquet(
+    conn: sqlite3.Connection,
+    tables: List[str],
+    tmpdir: str,
+    chunk_size: int = CHUNK_SIZE,
+) -> None:
     for table in tables:
-        df = pd.read_sql_query(f"SELECT * FROM {table}", conn)
-        pq.write_table(
-            table=pa.Table.from_pandas(df),
-            where=os.path.join(tmpdir, f"{table}.parquet"),
+        exported = write_table_to_parquet(
+            conn, table, os.path.join(tmpdir, f"{table}.parquet"), chunk_size
+        )
+        print(f"Exported {exported.rows:,} rows of {table}")
+
+
+def export_table(
+    db_path: str,
+    profile: str,
+    table: str,
+    tmpdir: str,
+    chunk_size: int,
+    where: Optional[str] = None,
+    params: Optional[Dict[str, Any]] = None,
+) -> ExportedTable:
+    conn = connect_sqlite(db_path, profile)
+    try:
+        return write_table_to_parquet(
+            conn,
+            table,
+            os.path.join(tmpdir, f"{table}.parquet"),
+            chunk_size,
+            where,
+            params,
+        )
+    finally:
+        conn.close()
+
+
+def export_tables_in_parallel(
+    db_path: str,
+    profile: str,
+    tables: List[str],
+    tmpdir: str,
+    chunk_size: int = CHUNK_SIZE,
+    workers: Optional[int] = None,
+    filters: Optional[Dict[str, Optional[str]]] = None,
+    params: Optional[Dict[str, Any]] = None,
+) -> Dict[str, ExportedTable]:
+    """
+    Exports every table in its own process, with its own connection, a
+    chunk in memory per process. Only the rows matching the condition of a
+    table in `filters` are exported.
+    """
+    filters = filters or {}
+    exported = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                export_table,
+                db_path,
+                profile,
+                table,
+                tmpdir,
+                chunk_size,
+                filters.get(table),
+                params,
+            ): table
+            for table in tables
+        }
+        for future in as_completed(futures):
+            table = futures[future]
+            exported[table] = future.result()
+            print(f"Exported {exported[table].rows:,} rows of {table}")
+    return exported
+
+
+def manifest_entry(path: str, exported: ExportedTable) -> Dict[str, Any]:
+    """
+    Describes a published Parquet file, so downloads can pick and verify
+    it without opening it: its size and checksum, schema and the range of
+    its key columns, from the statistics of its row groups.
+    """
+    metadata = pq.read_metadata(path)
+    schema = metadata.schema.to_arrow_schema()
+    table = os.path.splitext(os.path.basename(path))[0]
+    stats = {}
+    for column in KEY_COLUMNS.get(table, []):
+        index = schema.get_field_index(column)
+        if index < 0:
+            continue
+        ranges = [
+            (statistics.min, statistics.max)
+            for statistics in (
+                metadata.row_group(i).column(index).statistics
+                for i in range(metadata.num_row_groups)
+            )
+            if statistics is not None and statistics.has_min_max
+        ]
+        if ranges:
+            stats[column] = {
+                "min": min(low for low, _ in ranges),
+                "max": max(high for _, high in ranges),
+            }
+    return {
+        "file": os.path.basename(path),
+        "rows": exported.rows,
+        "bytes": os.path.getsize(path),
+        "sha256": exported.sha256,
+        "schema": [
+            {"name": field.name, "type": str(field.type), "nullable": field.nullable}
+            for field in schema
+        ],
+        "stats": stats,
+    }
+
+
+def add_directory(tar: tarfile.TarFile, source_dir: str) -> None:
+    for root, dirs, files in os.walk(source_dir):
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            tar.add(path, arcname=os.path.relpath(path, source_dir))
+
+
+def create_archive(
+    source_dir: str, archive_path: str, compression: str = "zstd"
+) -> str:
+    """
+    Archives the files of `source_dir` in one sequential write, returns the
+    SHA-256 of the archive.
+    """
+    if compression not in ARCHIVE_EXTENSIONS:
+        raise ValueError(
+            f"Unknown compression {compression}, choose one of "
+            f"{', '.join(ARCHIVE_EXTENSIONS)}"
         )
+    with open(archive_path, "wb") as f:
+        writer = HashingWriter(f)
+        if compression == "gzip":
+            # tarfile only calls write() on the file
+            with tarfile.open(fileobj=cast(BinaryIO, writer), mode="w|gz") as tar:
+                add_directory(tar, source_dir)
+        else:
+            sink = pa.PythonFile(writer, mode="w")
+            with pa.CompressedOutputStream(sink, "zstd") as stream:
+                with tarfile.open(fileobj=stream, mode="w|") as tar:
+                    add_directory(tar, source_dir)
+    return writer.hexdigest()
 
-    # Close the connection to the SQLite database
+
+def create_tar_gz_archive(source_dir: str, archive_path: str) -> str:
+    return create_archive(source_dir, archive_path, "gzip")
+
+
+def extract_archive(archive_path: str, directory: str) -> None:
+    """Extracts a package, zstd or gzip compressed."""
+    if archive_path.endswith(ARCHIVE_EXTENSIONS["zstd"]):
+        with pa.CompressedInputStream(pa.OSFile(archive_path), "zstd") as stream:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                tar.extractall(path=directory)
+    else:
+        with tarfile.open(archive_path, "r:*") as tar:
+            tar.extractall(path=directory)
+
+
+def compute_hash_of_archive(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def packaged_tables(conn: sqlite3.Connection) -> List[str]:
+    # Materialized views are recomputed from the tables after downloading
+    return [
+        name
+        for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        if not name.startswith((INTERNAL_TABLE_PREFIX, VIEW_TABLE_PREFIX))
+    ]
+
+
+def export_release(
+    db_path: str,
+    profile: str,
+    tmpdir: str,
+    chunk_size: int = CHUNK_SIZE,
+    workers: Optional[int] = None,
+    base: Optional[Dict[str, int]] = None,
+) -> Dict[str, Any]:
+    """
+    Exports the tables, their release.json and manifest to `tmpdir`: all
+    their rows, or those added or changed since the release with the
+    watermarks `base`.
+    """
+    conn = connect_sqlite(db_path, profile)
+    watermarks = release_watermarks(conn)
+    tables = packaged_tables(conn)
     conn.close()
 
-    # Create a tar.gz archive of the Parquet files
-    with tarfile.open("datasets.tar.gz", "w:gz") as tar:
-        for root, dirs, files in os.walk(tmpdir):
-            for file in files:
-                path = os.path.join(root, file)
-                tar.add(path, arcname=os.path.relpath(path, tmpdir))
-
-    # Create a hash of the tar.gz archive
-    with open("datasets.tar.gz", "rb") as f:
-        hash = hashlib.sha256(f.read()).hexdigest()
-
-    # Delete the temporary directory and its contents
-    for root, dirs, files in os.walk(tmpdir, topdown=False):
-        for file in files:
-            os.remove(os.path.join(root, file))
-        for dir in dirs:
-            os.rmdir(os.path.join(root, dir))
-    os.rmdir(tmpdir)
+    filters = delta_filters(tables) if base else {}
+    exported = export_tables_in_parallel(
+        db_path, profile, tables, tmpdir, chunk_size, workers, filters, base
+    )
+    release = {
+        "kind": "delta" if base else "full",
+        "watermarks": watermarks,
+        "base": base,
+        # Tables whose rows the package replaces, the others' are upserted
+        "replaced": [table for table in tables if filters.get(table) is None],
+    }
+    write_release(os.path.join(tmpdir, RELEASE_FILE), release)
+    manifest = {
+        "release": release,
+        "tables": {
+            table: manifest_entry(
+                os.path.join(tmpdir, f"{table}.parquet"), exported[table]
+            )
+            for table in sorted(exported)
+        },
+    }
+    with open(os.path.join(tmpdir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return release
+
+
+def main(
+    profile: str = "read",
+    chunk_size: Optional[int] = None,
+    compression: str = "zstd",
+    workers: Optional[int] = None,
+    since: Optional[str] = None,
+):
+    """
+    Packages the datasets, or with `since`, the directory holding the
+    release.json of a previous release, only the rows added or changed
+    since then.
+    """
+    base = None
+    if since is not None:
+        previous = read_release(since)
+        if previous is None:
+            print(f"Error: no {RELEASE_FILE} in {since}.")
+            return
+        base = previous["watermarks"]
+        missing = sorted(set(WATERMARK_QUERIES) - set(base))
+        if missing:
+            print(
+                f"Error: the release in {since} has no {', '.join(missing)} "
+                "watermarks, package a full release first."
+            )
+            return
+
+    parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    db_path = os.path.join(parent_dir, "datasets", "datasets.db")
+
+    # Convert each table to a Parquet file, published along with the archive
+    shutil.rmtree(PACKAGE_DIR, ignore_errors=True)
+    create_temporary_directory(PACKAGE_DIR)
+    release = export_release(
+        db_path, profile, PACKAGE_DIR, chunk_size or CHUNK_SIZE, workers, base
+    )
+    watermarks = release["watermarks"]
+    name = f"datasets-delta-{watermarks['packaged_at']}" if base else "datasets"
+    archive_path = f"{name}{ARCHIVE_EXTENSIONS[compression]}"
+    hash = create_archive(PACKAGE_DIR, archive_path, compression)
+
+    # The next delta starts from this release
+    write_release(RELEASE_FILE, release)
 
     print(
-        f"Dataset latest cast timestamp: {latest_timestamp}; dataset highest fid: {highest_fid}; dataset highest block number: {highest_block_num}; tar.gz shasum: {hash}"
+        f"Dataset latest cast timestamp: {watermarks['latest_cast_timestamp']}; dataset highest fid: {watermarks['highest_fid']}; dataset highest block number: {watermarks['highest_block_num']}; {archive_path} shasum: {hash}"
     )
@@ -1,16 +1,23 @@
 import hashlib
+import json
 import os
 import sqlite3
 import tarfile
 import tempfile
 
+import pyarrow as pa
 import pyarrow.parquet as pq
 
 from packager.package import (
+    MANIFEST_FILE,
     compute_hash_of_archive,
     convert_tables_to_parquet,
+    create_archive,
     create_tar_gz_archive,
     create_temporary_directory,
+    export_release,
+    export_tables_in_parallel,
+    extract_archive,
 )
 
 
@@ -82,3 +89,158 @@ def test_compute_hash_of_archive():
             expected_hash = hashlib.sha256(f.read()).hexdigest()
 
         assert file_hash == expected_hash
+
+
+def test_convert_tables_to_parquet_streams_model_tables_in_chunks():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        conn = sqlite3.connect(":memory:")
+        # As stored on compact databases: BLOB hashes and dictionary codes
+        conn.execute(
+            "CREATE TABLE reactions (hash BLOB PRIMARY KEY, reaction_type BLOB, "
+            "timestamp INTEGER, target_hash BLOB, author_fid INTEGER)"
+        )
+        conn.executemany(
+            "INSERT INTO reactions VALUES (?, ?, ?, ?, ?)",
+            [
+                (bytes([i]) * 32, i % 2, 1000 + i, None, i if i % 3 else None)
+                for i in range(5)
+            ],
+        )
+
+        convert_tables_to_parquet(conn, ["reactions"], tmpdirname, chunk_size=2)
+
+        parquet_file = pq.ParquetFile(os.path.join(tmpdirname, "reactions.parquet"))
+        assert parquet_file.metadata.num_row_groups == 3
+        table = parquet_file.read()
+        assert table.schema.field("timestamp").type == pa.int64()
+        assert table.schema.field("author_fid").type == pa.int64()
+        assert table.column("hash")[1].as_py() == "0x" + "01" * 32
+        assert table.column("reaction_type").to_pylist() == [
+            "like",
+            "recast",
+            "like",
+            "recast",
+            "like",
+        ]
+        assert table.column("author_fid").to_pylist() == [None, 1, 2, None, 4]
+
+        conn.close()
+
+
+def test_export_tables_in_parallel():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        db_path = os.path.join(tmpdirname, "datasets.db")
+        conn = sqlite3.connect(db_path)
+        for table in ("a", "b", "c"):
+            conn.execute(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY, name TEXT)")
+            conn.executemany(
+                f"INSERT INTO {table} (name) VALUES (?)",
+                [(f"{table}{i}",) for i in range(5)],
+            )
+        conn.commit()
+        conn.close()
+
+        out_dir = create_temporary_directory(os.path.join(tmpdirname, "out"))
+        export_tables_in_parallel(
+            db_path, "read", ["a", "b", "c"], out_dir, chunk_size=2, workers=2
+        )
+
+        for table in ("a", "b", "c"):
+            df = pq.read_table(os.path.join(out_dir, f"{table}.parquet")).to_pandas()
+            assert df["name"].tolist() == [f"{table}{i}" for i in range(5)]
+
+
+def test_create_zstd_archive_hashes_while_writing():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source_dir = create_temporary_directory(os.path.join(tmpdirname, "source"))
+        with open(os.path.join(source_dir, "test.txt"), "w") as f:
+            f.write("Hello, World!")
+
+        archive_path = os.path.join(tmpdirname, "archive.tar.zst")
+        file_hash = create_archive(source_dir, archive_path, "zstd")
+        assert file_hash == compute_hash_of_archive(archive_path)
+
+        extract_dir = os.path.join(tmpdirname, "extracted")
+        extract_archive(archive_path, extract_dir)
+        with open(os.path.join(extract_dir, "test.txt")) as f:
+            assert f.read() == "Hello, World!"
+
+
+def test_export_release_writes_a_manifest():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        db_path = os.path.join(tmpdirname, "datasets.db")
+        conn = sqlite3.connect(db_path)
+        conn.execute(
+            "CREATE TABLE casts (hash TEXT PRIMARY KEY, thread_hash TEXT, "
+            "text TEXT, timestamp INTEGER, author_fid INTEGER, parent_hash TEXT)"
+        )
+        conn.executemany(
+            "INSERT INTO casts VALUES (?, ?, 'gm', ?, ?, NULL)",
+            [(f"0x0{i}", f"0x0{i}", 1000 * i, i) for i in range(1, 4)],
+        )
+        conn.execute("CREATE TABLE eth_transactions (block_num INTEGER)")
+        conn.execute("CREATE TABLE reactions (timestamp INTEGER)")
+        conn.execute("CREATE TABLE erc1155_metadata (id INTEGER)")
+        conn.execute("CREATE TABLE user_eth_transactions (user_fid INTEGER)")
+        conn.commit()
+        conn.close()
+
+        out_dir = create_temporary_directory(os.path.join(tmpdirname, "out"))
+        export_release(db_path, "read", out_dir, workers=1)
+
+        with open(os.path.join(out_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        assert manifest["release"]["kind"] == "full"
+        entry = manifest["tables"]["casts"]
+        path = os.path.join(out_dir, entry["file"])
+        assert entry["rows"] == 3
+        assert entry["bytes"] == os.path.getsize(path)
+        assert entry["sha256"] == compute_hash_of_archive(path)
+        assert entry["stats"]["timestamp"] == {"min": 1000, "max": 3000}
+        assert {"name": "timestamp", "type": "int64", "nullable": False} in entry[
+            "schema"
+        ]
+
+
+def test_convert_tables_to_parquet_sorts_by_the_indexed_sort_key():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        conn = sqlite3.connect(":memory:")
+        conn.execute(
+            "CREATE TABLE reactions (hash TEXT PRIMARY KEY, reaction_type TEXT, "
+            "timestamp INTEGER, target_hash TEXT, author_fid INTEGER)"
+        )
+        conn.execute("CREATE INDEX ix_reactions_timestamp ON reactions (timestamp)")
+        timestamps = [30, 10, None, 20, 10, 30, 10]
+        conn.executemany(
+            "INSERT INTO reactions VALUES (?, 'like', ?, NULL, 1)",
+            [(f"0x{i:02x}", timestamp) for i, timestamp in enumerate(timestamps)],
+        )
+
+        convert_tables_to_parquet(conn, ["reactions"], tmpdirname, chunk_size=2)
+
+        path = os.path.join(tmpdirname, "reactions.parquet")
+        table = pq.read_table(path)
+        assert table.column("timestamp").to_pylist() == [
+            None,
+            10,
+            10,
+            10,
+            20,
+            30,
+            30,
+        ]
+        assert table.column("hash").to_pylist()[1:4] == ["0x01", "0x04", "0x06"]
+
+        metadata = pq.read_metadata(path)
+        columns = metadata.schema.to_arrow_schema().names
+        row_group = metadata.row_group(2)
+        timestamp = row_group.column(columns.index("timestamp"))
+        assert "DELTA_BINARY_PACKED" in timestamp.encodings
+        assert (timestamp.statistics.min, timestamp.statistics.max) == (10, 20)
+        assert (
+            "RLE_DICTIONARY"
+            in row_group.column(columns.index("reaction_type")).encodings
+        )
+        assert "RLE_DICTIONARY" not in row_group.column(columns.index("hash")).encodings
+
+        conn.close()
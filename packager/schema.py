@@ -0,0 +1,21 @@
+import pyarrow as pa
+from sqlalchemy import Float, Integer, Table
+
+
+def arrow_type(column) -> pa.DataType:
+    """The Arrow type of a model column, hashes and codes as their text form."""
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, Float):
+        return pa.float64()
+    return pa.string()
+
+
+def arrow_schema(table: Table) -> pa.Schema:
+    """The Arrow schema of a model table, as published in packages."""
+    return pa.schema(
+        [
+            pa.field(column.name, arrow_type(column), nullable=column.nullable)
+            for column in table.columns
+        ]
+    )
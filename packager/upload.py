@@ -4,6 +4,8 @@ import boto3
 from botocore.exceptions import NoCredentialsError
 from tqdm import tqdm
 
+from packager.package import MANIFEST_FILE, PACKAGE_DIR
+
 
 def upload_to_s3(file_name: str, bucket_name: str, object_name: str):
     s3 = boto3.resource(
@@ -28,6 +30,18 @@ def upload_to_s3(file_name: str, bucket_name: str, object_name: str):
         return False
 
 
+def upload_package_files(directory: str, bucket_name: str) -> bool:
+    """
+    Publishes the Parquet files and release.json of a package, then its
+    manifest, so the manifest never lists files that aren't uploaded yet.
+    """
+    files = sorted(file for file in os.listdir(directory) if file != MANIFEST_FILE)
+    for file in files + [MANIFEST_FILE]:
+        if not upload_to_s3(os.path.join(directory, file), bucket_name, file):
+            return False
+    return True
+
+
 def main():
     tar_gz_file_path = "1681979704072.tar.gz"
     tar_gz_file_name = os.path.basename(tar_gz_file_path)
@@ -37,3 +51,7 @@ def main():
 
     # Set the S3 object name
     upload_to_s3(tar_gz_file_path, bucket_name, tar_gz_file_name)
+
+    # Per-table files, for downloads of some tables only
+    if os.path.exists(os.path.join(PACKAGE_DIR, MANIFEST_FILE)):
+        upload_package_files(PACKAGE_DIR, bucket_name)
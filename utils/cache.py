@@ -0,0 +1,136 @@
+import hashlib
+import os
+import re
+from typing import Callable, Dict, Iterable, List, Optional
+
+import polars as pl
+import pyarrow.parquet as pq
+from sqlalchemy.engine import Engine
+
+from utils.models import Base
+from utils.state import get_data_versions
+from utils.views import views_metadata
+
+CACHE_DIR = "datasets/cache"
+MAX_CACHE_BYTES = 512 * 1024**2
+
+# String literals are kept as they are, whitespace elsewhere is collapsed
+_LITERAL_OR_SPACE = re.compile(r"('(?:[^']|'')*')|\s+")
+
+# Results of queries using these change without the data changing
+NON_DETERMINISTIC = re.compile(
+    r"(?i)\b(random|randomblob|changes|total_changes|last_insert_rowid"
+    r"|current_date|current_time|current_timestamp)\b|'now'"
+)
+
+
+def normalize_sql(sql: str) -> str:
+    sql = _LITERAL_OR_SPACE.sub(lambda match: match.group(1) or " ", sql)
+    return sql.strip().rstrip(";").strip()
+
+
+def referenced_tables(
+    sql: str, table_names: Optional[Iterable[str]] = None
+) -> List[str]:
+    """The model and view tables whose name appears in `sql`."""
+    if table_names is None:
+        table_names = [*Base.metadata.tables, *views_metadata.tables]
+    return sorted(
+        name for name in table_names if re.search(rf"(?i)\b{re.escape(name)}\b", sql)
+    )
+
+
+def result_cache_key(sql: str, versions: Dict[str, str], *options) -> str:
+    digest = hashlib.sha256()
+    parts = [normalize_sql(sql)]
+    parts += [f"{table}={version}" for table, version in sorted(versions.items())]
+    parts += [str(option) for option in options]
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Query results stored as zstd-compressed Parquet files in `directory`,
+    the least recently used ones removed once they take more than
+    `max_bytes`.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.parquet")
+
+    def get(self, key: str) -> Optional[pl.DataFrame]:
+        path = self._path(key)
+        try:
+            table = pq.read_table(path)
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # Marks it as recently used
+        return pl.DataFrame(table)
+
+    def put(self, key: str, df: pl.DataFrame) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        # Written aside then renamed, concurrent readers never see half a file
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        pq.write_table(df.to_arrow(), temporary_path, compression="zstd")
+        os.replace(temporary_path, path)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".parquet"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def cached_query(
+    engine: Engine,
+    sql: str,
+    execute: Callable[[str], Optional[pl.DataFrame]],
+    cache: ResultCache,
+    *options,
+) -> Optional[pl.DataFrame]:
+    """
+    The result of `execute(sql)`, from `cache` when the tables the query
+    reads haven't changed since it was cached. `options` are the other
+    inputs of the result, like the backend or the row limit.
+    """
+    if NON_DETERMINISTIC.search(sql):
+        return execute(sql)
+
+    tables = referenced_tables(sql)
+    with engine.connect() as connection:
+        versions = get_data_versions(connection, tables)
+    if len(versions) < len(tables):
+        # Changes to a table without a version can't be told apart
+        return execute(sql)
+    key = result_cache_key(sql, versions, *options)
+
+    df = cache.get(key)
+    if df is not None:
+        print("Returning the cached result, the data hasn't changed since.")
+        return df
+
+    # Writes during the query bump the versions read above, so a result
+    # newer than its key is never served again
+    df = execute(sql)
+    if df is not None:
+        cache.put(key, df)
+    return df
@@ -0,0 +1,120 @@
+import os
+import tempfile
+
+import polars as pl
+import pytest
+from sqlalchemy import create_engine
+
+from utils.cache import (
+    ResultCache,
+    cached_query,
+    normalize_sql,
+    referenced_tables,
+    result_cache_key,
+)
+from utils.migrations import migrate
+from utils.state import (
+    bump_data_versions,
+    data_version_key,
+    get_data_versions,
+    warpy_state,
+)
+
+
+@pytest.fixture
+def cache():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield ResultCache(tmpdirname)
+
+
+def cached_counts(*args):
+    df = cached_query(*args)
+    assert df is not None
+    return df["n"].to_list()
+
+
+def test_normalize_sql():
+    assert normalize_sql(" SELECT *\n  FROM casts\tWHERE text = 'a  b' ;") == (
+        "SELECT * FROM casts WHERE text = 'a  b'"
+    )
+
+
+def test_referenced_tables():
+    assert referenced_tables("select count(*) from Casts join users using (fid)") == [
+        "casts",
+        "users",
+    ]
+    assert referenced_tables("select * from users_backup") == []
+
+
+def test_cached_query(cache):
+    engine = create_engine("sqlite:///:memory:")
+    migrate(engine)
+    calls = []
+
+    def execute(sql):
+        calls.append(sql)
+        return pl.DataFrame({"n": [len(calls)]})
+
+    sql = "SELECT count(*) AS n FROM casts"
+    assert cached_counts(engine, sql, execute, cache) == [1]
+    assert cached_counts(engine, sql + " ;", execute, cache) == [1]
+    # Other tables changing keeps the result
+    with engine.begin() as connection:
+        bump_data_versions(connection, ["users"])
+    assert cached_counts(engine, sql, execute, cache) == [1]
+
+    with engine.begin() as connection:
+        bump_data_versions(connection, ["casts"])
+    assert cached_counts(engine, sql, execute, cache) == [2]
+    assert cached_counts(engine, sql, execute, cache, "duckdb") == [3]
+
+    cached_query(engine, "SELECT random() FROM casts", execute, cache)
+    cached_query(engine, "SELECT random() FROM casts", execute, cache)
+    assert len(calls) == 5
+
+
+def test_cached_query_does_not_write(cache):
+    engine = create_engine("sqlite:///:memory:")
+    migrate(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            warpy_state.delete().where(warpy_state.c.key == data_version_key("casts"))
+        )
+    calls = []
+
+    def execute(sql):
+        calls.append(sql)
+        return pl.DataFrame({"n": [len(calls)]})
+
+    # Without a version, the result is neither cached nor is one written
+    sql = "SELECT count(*) AS n FROM casts"
+    cached_query(engine, sql, execute, cache)
+    assert cached_counts(engine, sql, execute, cache) == [2]
+    with engine.connect() as connection:
+        assert get_data_versions(connection, ["casts", "users"]).keys() == {"users"}
+
+
+def test_result_cache_evicts_least_recently_used(cache):
+    df = pl.DataFrame({"n": list(range(1000))})
+    cache.put("a", df)
+    cache.put("b", df)
+    os.utime(os.path.join(cache.directory, "a.parquet"), (0, 0))
+    os.utime(os.path.join(cache.directory, "b.parquet"), (1, 1))
+    assert cache.get("a") is not None  # Now the most recently used
+
+    cache.max_bytes = os.path.getsize(os.path.join(cache.directory, "a.parquet"))
+    cache.evict()
+    assert cache.get("b") is None
+    result = cache.get("a")
+    assert result is not None
+    assert result.frame_equal(df)
+
+
+def test_result_cache_key():
+    assert result_cache_key("SELECT 1", {"casts": "a"}) != result_cache_key(
+        "SELECT 1", {"casts": "b"}
+    )
+    assert result_cache_key("SELECT 1", {}, None) != result_cache_key(
+        "SELECT 1", {}, 10
+    )
@@ -0,0 +1,69 @@
+import sqlite3
+from typing import Dict, Union
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import URL, Engine
+
+DB_PATH = "datasets/datasets.db"
+
+# PRAGMAs applied to every new connection, by profile
+PROFILES: Dict[str, Dict[str, Union[int, str]]] = {
+    # Indexers and imports: durable up to the last commits on a power loss
+    "bulk": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -512 * 1024,  # KiB
+        "temp_store": "MEMORY",
+        "mmap_size": 1024**3,
+        "busy_timeout": 30000,
+    },
+    # Queries and exports: readers don't block on the indexers' writes
+    "read": {
+        "journal_mode": "WAL",
+        "cache_size": -256 * 1024,
+        "temp_store": "MEMORY",
+        "mmap_size": 1024**3,
+        "busy_timeout": 30000,
+    },
+    # SQLite's defaults, every commit synced to disk
+    "safe": {
+        "synchronous": "FULL",
+        "busy_timeout": 30000,
+    },
+}
+
+
+def apply_profile(dbapi_connection: sqlite3.Connection, profile: str) -> None:
+    if profile not in PROFILES:
+        raise ValueError(
+            f"Unknown profile {profile}, choose one of {', '.join(PROFILES)}"
+        )
+    cursor = dbapi_connection.cursor()
+    for pragma, value in PROFILES[profile].items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    cursor.close()
+
+
+def create_sqlite_engine(
+    url: Union[str, URL] = f"sqlite:///{DB_PATH}", profile: str = "safe", **kwargs
+) -> Engine:
+    """
+    Creates an engine whose connections use the PRAGMAs of `profile`,
+    `kwargs` are passed on to create_engine.
+    """
+    apply_profile(sqlite3.connect(":memory:"), profile)  # Fail early
+
+    engine = create_engine(url, **kwargs)
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        apply_profile(dbapi_connection, profile)
+
+    return engine
+
+
+def connect_sqlite(path: str = DB_PATH, profile: str = "safe") -> sqlite3.Connection:
+    """A plain sqlite3 connection using the PRAGMAs of `profile`."""
+    connection = sqlite3.connect(path)
+    apply_profile(connection, profile)
+    return connection
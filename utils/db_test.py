@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import text
+
+from utils.db import connect_sqlite, create_sqlite_engine
+
+
+@pytest.fixture
+def db_path():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield os.path.join(tmpdirname, "test.db")
+
+
+def pragmas(execute):
+    return tuple(
+        execute(f"PRAGMA {pragma}")
+        for pragma in ("journal_mode", "synchronous", "temp_store", "cache_size")
+    )
+
+
+def test_create_sqlite_engine_profiles(db_path):
+    engine = create_sqlite_engine(f"sqlite:///{db_path}", "bulk")
+    with engine.connect() as connection:
+        values = pragmas(lambda sql: connection.execute(text(sql)).scalar())
+    assert values == ("wal", 1, 2, -512 * 1024)
+
+    engine = create_sqlite_engine(f"sqlite:///{db_path}", "safe")
+    with engine.connect() as connection:
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 2
+
+
+def test_connect_sqlite(db_path):
+    connection = connect_sqlite(db_path, "read")
+    values = pragmas(lambda sql: connection.execute(sql).fetchone()[0])
+    connection.close()
+    assert values == ("wal", 2, 2, -256 * 1024)
+
+
+def test_unknown_profile(db_path):
+    with pytest.raises(ValueError):
+        create_sqlite_engine(f"sqlite:///{db_path}", "fast")
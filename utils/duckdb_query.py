@@ -0,0 +1,228 @@
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterator, Optional
+
+import polars as pl
+import pyarrow as pa
+from rich import box
+from rich.console import Console
+from rich.panel import Panel
+from sqlalchemy.engine import Engine
+
+from utils.export import print_rate
+from utils.models import Base
+from utils.plan import QueryTimeoutError
+from utils.state import INTERNAL_TABLE_PREFIX
+from utils.types import DictionaryString, HexString, compact_columns, is_compact
+
+console = Console()
+
+WRITE_PATTERN = re.compile(r"(?i)\b(insert|update|delete|drop|create|alter)\b")
+
+# The SQL functions utils/storage.py registers on SQLite connections
+MACROS = [
+    "CREATE MACRO hex0x(value) AS "
+    "CASE WHEN typeof(value) = 'BLOB' THEN '0x' || lower(hex(value)) "
+    "ELSE CAST(value AS VARCHAR) END",
+    "CREATE MACRO unhex0x(value) AS unhex(substr(lower(value), 3))",
+]
+
+
+def import_duckdb():
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError(
+            "The DuckDB backend needs the duckdb package: pip install duckdb"
+        ) from None
+    return duckdb
+
+
+def quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def decoded_columns(table_name: str) -> str:
+    """
+    Select list turning the BLOBs and dictionary codes of a compact table
+    back into text, so it can be unioned with its archived Parquet files.
+    """
+    columns = compact_columns(Base.metadata).get(table_name)
+    if not columns:
+        return "*"
+    expressions = []
+    for column in Base.metadata.tables[table_name].columns:
+        column_type = columns.get(column.name)
+        if isinstance(column_type, HexString):
+            expressions.append(f"hex0x({column.name}) AS {column.name}")
+        elif isinstance(column_type, DictionaryString):
+            cases = " ".join(
+                f"WHEN '{code}' THEN {quote(value)}"
+                for code, value in enumerate(column_type.vocabulary)
+            )
+            expressions.append(
+                f"CASE CAST({column.name} AS VARCHAR) {cases} "
+                f"ELSE CAST({column.name} AS VARCHAR) END AS {column.name}"
+            )
+        else:
+            expressions.append(column.name)
+    return ", ".join(expressions)
+
+
+def parquet_tables(directory: str) -> Dict[str, str]:
+    """The Parquet file of every table of the package in `directory`."""
+    if not os.path.isdir(directory):
+        return {}
+    # Packages are flat, subdirectories hold the archive and other files
+    return {
+        os.path.splitext(file)[0]: os.path.join(directory, file)
+        for file in sorted(os.listdir(directory))
+        if file.endswith(".parquet")
+    }
+
+
+def connect_duckdb(
+    sqlite_path: Optional[str] = None,
+    parquet_dir: Optional[str] = None,
+    archive: Optional[Dict[str, str]] = None,
+    compact: bool = False,
+):
+    """
+    An in-memory DuckDB connection with one view per table, reading either
+    the SQLite database at `sqlite_path`, attached read only, or the Parquet
+    files of a package in `parquet_dir`. Tables with archived Parquet files
+    in `archive` (globs by table name) span both the hot and the cold rows.
+    """
+    duckdb = import_duckdb()
+    connection = duckdb.connect()
+    for macro in MACROS:
+        connection.execute(macro)
+
+    sources = {}
+    if parquet_dir:
+        for table_name, path in parquet_tables(parquet_dir).items():
+            sources[table_name] = f"SELECT * FROM read_parquet({quote(path)})"
+    elif sqlite_path:
+        connection.execute("INSTALL sqlite")
+        connection.execute("LOAD sqlite")
+        connection.execute(
+            f"ATTACH {quote(sqlite_path)} AS warpy (TYPE SQLITE, READ_ONLY)"
+        )
+        table_names = connection.execute(
+            "SELECT table_name FROM information_schema.tables "
+            "WHERE table_catalog = 'warpy'"
+        ).fetchall()
+        for (table_name,) in table_names:
+            columns = decoded_columns(table_name) if compact else "*"
+            sources[table_name] = f"SELECT {columns} FROM warpy.{table_name}"
+    else:
+        raise ValueError("Either sqlite_path or parquet_dir is required")
+
+    for table_name, glob in (archive or {}).items():
+        cold = f"SELECT * FROM read_parquet({quote(glob)}, hive_partitioning = false)"
+        hot = sources.get(table_name)
+        sources[table_name] = f"{hot} UNION ALL BY NAME {cold}" if hot else cold
+
+    for table_name, source in sources.items():
+        if not table_name.startswith(INTERNAL_TABLE_PREFIX):
+            connection.execute(f"CREATE VIEW {table_name} AS {source}")
+    return connection
+
+
+def hex_encode_binary_columns(table: pa.Table) -> pa.Table:
+    """BLOBs of compact databases are shown as 0x-prefixed hex, as in SQLite."""
+    for i, field in enumerate(table.schema):
+        if pa.types.is_binary(field.type) or pa.types.is_large_binary(field.type):
+            values = [
+                None if value is None else "0x" + value.hex()
+                for value in table.column(i).to_pylist()
+            ]
+            table = table.set_column(i, field.name, pa.array(values, pa.string()))
+    return table
+
+
+def execute_duckdb_sql(
+    engine: Engine,
+    query: str,
+    parquet_dir: Optional[str] = None,
+    archive: Optional[Dict[str, str]] = None,
+    limit: Optional[int] = None,
+    timeout: Optional[float] = None,
+) -> Optional[pl.DataFrame]:
+    """
+    Runs a read query with DuckDB's vectorized, multi-threaded engine over
+    the database of `engine`, or over the Parquet files in `parquet_dir`,
+    including the rows archived in `archive`. Writes are refused, the
+    query runner sends them to execute_raw_sql on SQLite.
+    """
+    print()
+    console.print(
+        Panel(query, title="Running SQL with DuckDB", box=box.SQUARE, expand=False)
+    )
+    print()
+
+    if WRITE_PATTERN.search(query):
+        print("DuckDB only runs read queries.")
+        return None
+
+    started_at = time.perf_counter()
+    batches = iter_duckdb_batches(
+        engine, query, parquet_dir, archive, limit=limit, timeout=timeout
+    )
+    try:
+        table = pa.Table.from_batches(list(batches))
+    except QueryTimeoutError as e:
+        print(f"{e}, raise it with --timeout.")
+        return None
+    print_rate(table.num_rows, started_at)
+    return pl.DataFrame(table)
+
+
+def iter_duckdb_batches(
+    engine: Engine,
+    query: str,
+    parquet_dir: Optional[str] = None,
+    archive: Optional[Dict[str, str]] = None,
+    batch_size: int = 65536,
+    limit: Optional[int] = None,
+    timeout: Optional[float] = None,
+) -> Iterator[pa.RecordBatch]:
+    """
+    Streams the result of a read query as Arrow record batches, cancelling
+    it after `timeout` seconds.
+    """
+    duckdb = import_duckdb()
+    connection = connect_duckdb(
+        engine.url.database, parquet_dir, archive, is_compact(engine.dialect)
+    )
+    timer = threading.Timer(timeout, connection.interrupt) if timeout else None
+    if timer is not None:
+        timer.start()
+    try:
+        result = connection.execute(query)
+        # Renamed in newer DuckDB versions
+        to_reader = (
+            getattr(result, "to_arrow_reader", None) or result.fetch_record_batch
+        )
+        reader = to_reader(batch_size)
+        remaining = limit
+        for batch in reader:
+            if remaining is not None:
+                batch = batch.slice(0, remaining)
+                remaining -= batch.num_rows
+            table = hex_encode_binary_columns(pa.Table.from_batches([batch]))
+            yield from table.to_batches() or [
+                pa.RecordBatch.from_pylist([], table.schema)
+            ]
+            if remaining == 0:
+                break
+    except duckdb.InterruptException as e:
+        raise QueryTimeoutError(
+            f"The query was cancelled after the time budget of {timeout}s"
+        ) from e
+    finally:
+        if timer is not None:
+            timer.cancel()
+        connection.close()
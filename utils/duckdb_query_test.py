@@ -0,0 +1,102 @@
+import os
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils.duckdb_query import (
+    execute_duckdb_sql,
+    hex_encode_binary_columns,
+    iter_duckdb_batches,
+)
+from utils.plan import QueryTimeoutError
+
+HASH = "0x" + "ab" * 32
+
+
+def test_hex_encode_binary_columns():
+    table = pa.table(
+        {"hash": pa.array([bytes.fromhex(HASH[2:]), None]), "count": [1, 2]}
+    )
+    assert hex_encode_binary_columns(table).to_pydict() == {
+        "hash": [HASH, None],
+        "count": [1, 2],
+    }
+
+
+def test_execute_duckdb_sql_rejects_writes():
+    engine = create_engine("sqlite:///:memory:")
+    assert execute_duckdb_sql(engine, "DELETE FROM casts") is None
+
+
+@pytest.fixture
+def tmpdirname():
+    pytest.importorskip("duckdb")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield tmpdirname
+
+
+def test_execute_duckdb_sql_on_parquet(tmpdirname):
+    pq.write_table(
+        pa.table({"hash": [HASH, HASH], "reaction_type": ["like", "recast"]}),
+        os.path.join(tmpdirname, "reactions.parquet"),
+    )
+    engine = create_engine("sqlite:///:memory:")
+    df = execute_duckdb_sql(
+        engine,
+        "SELECT reaction_type, count(*) AS n FROM reactions " "GROUP BY 1 ORDER BY 1",
+        parquet_dir=tmpdirname,
+    )
+    assert df.to_dicts() == [
+        {"reaction_type": "like", "n": 1},
+        {"reaction_type": "recast", "n": 1},
+    ]
+
+
+def test_execute_duckdb_sql_on_sqlite(tmpdirname):
+    duckdb = pytest.importorskip("duckdb")
+    try:
+        # Downloaded on first use
+        duckdb.connect().execute("INSTALL sqlite")
+    except duckdb.IOException as e:
+        pytest.skip(f"DuckDB's sqlite extension is unavailable: {e}")
+
+    engine = create_engine(f"sqlite:///{os.path.join(tmpdirname, 'test.db')}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE casts (hash BLOB, timestamp INTEGER)"))
+        connection.execute(
+            text("INSERT INTO casts VALUES (:hash, 1)"),
+            {"hash": bytes.fromhex(HASH[2:])},
+        )
+    df = execute_duckdb_sql(
+        engine, f"SELECT hash FROM casts WHERE hash = unhex0x('{HASH}')"
+    )
+    assert df is not None
+    assert df.to_dicts() == [{"hash": HASH}]
+
+
+def test_iter_duckdb_batches_limit(tmpdirname):
+    pq.write_table(
+        pa.table({"fid": list(range(100))}), os.path.join(tmpdirname, "users.parquet")
+    )
+    engine = create_engine("sqlite:///:memory:")
+    batches = iter_duckdb_batches(
+        engine, "SELECT * FROM users", parquet_dir=tmpdirname, batch_size=8, limit=20
+    )
+    assert sum(batch.num_rows for batch in batches) == 20
+
+
+def test_iter_duckdb_batches_timeout(tmpdirname):
+    pq.write_table(pa.table({"fid": [1]}), os.path.join(tmpdirname, "users.parquet"))
+    engine = create_engine("sqlite:///:memory:")
+    with pytest.raises(QueryTimeoutError):
+        list(
+            iter_duckdb_batches(
+                engine,
+                "SELECT count(*) FROM users, range(100000000000)",
+                parquet_dir=tmpdirname,
+                timeout=0.2,
+            )
+        )
@@ -0,0 +1,61 @@
+import os
+import time
+from typing import Iterable
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+
+EXPORT_FORMATS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+}
+
+
+def export_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXPORT_FORMATS:
+        raise ValueError(
+            f"Unknown output format {extension or path}, "
+            f"use one of {', '.join(EXPORT_FORMATS)}"
+        )
+    return EXPORT_FORMATS[extension]
+
+
+def print_rate(rows: int, started_at: float) -> None:
+    elapsed = max(time.perf_counter() - started_at, 1e-9)
+    print(f"{rows:,} rows in {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s)")
+
+
+def write_batches(batches: Iterable[pa.RecordBatch], path: str) -> int:
+    """
+    Writes record batches to `path` as they come, in the format of its
+    extension, so only one batch is held in memory. Returns the number of
+    rows written.
+    """
+    output_format = export_format(path)
+    started_at = time.perf_counter()
+    rows = 0
+    writer = None
+    with open(path, "wb") as f:
+        try:
+            for batch in batches:
+                if output_format == "ndjson":
+                    pl.DataFrame(pa.Table.from_batches([batch])).write_ndjson(f)
+                else:
+                    if writer is None:
+                        writer = (
+                            csv.CSVWriter(f, batch.schema)
+                            if output_format == "csv"
+                            else pq.ParquetWriter(f, batch.schema, compression="zstd")
+                        )
+                    writer.write_batch(batch)
+                rows += batch.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+    print_rate(rows, started_at)
+    return rows
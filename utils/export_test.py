@@ -0,0 +1,75 @@
+import json
+import os
+import tempfile
+
+import polars as pl
+import pyarrow.parquet as pq
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils.export import export_format, write_batches
+from utils.query import execute_raw_sql, iter_raw_sql_batches
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite:///:memory:")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE casts (hash TEXT, text TEXT)"))
+        for i in range(10):
+            connection.execute(
+                text("INSERT INTO casts VALUES (:hash, :text)"),
+                {"hash": f"0x{i:02x}", "text": None if i < 5 else f"cast {i}"},
+            )
+    return engine
+
+
+def test_iter_raw_sql_batches(engine):
+    batches = list(iter_raw_sql_batches(engine, "SELECT * FROM casts", batch_size=4))
+    assert [batch.num_rows for batch in batches] == [4, 4, 2]
+    # The text column only has nulls in the first batch
+    assert all(batch.schema == batches[0].schema for batch in batches)
+
+    limited = list(iter_raw_sql_batches(engine, "SELECT * FROM casts", 4, limit=5))
+    assert [batch.num_rows for batch in limited] == [4, 1]
+
+
+def test_iter_raw_sql_batches_without_rows(engine):
+    (batch,) = iter_raw_sql_batches(engine, "SELECT * FROM casts WHERE 0")
+    assert batch.num_rows == 0
+    assert batch.schema.names == ["hash", "text"]
+
+
+def test_iter_raw_sql_batches_changing_types(engine):
+    query = "SELECT CASE WHEN hash < '0x05' THEN 1 ELSE text END AS x FROM casts"
+    with pytest.raises(ValueError, match="CAST"):
+        list(iter_raw_sql_batches(engine, query, batch_size=5))
+
+
+def test_execute_raw_sql_limit(engine):
+    df = execute_raw_sql(engine, "SELECT * FROM casts ORDER BY hash", limit=3)
+    assert df["hash"].to_list() == ["0x00", "0x01", "0x02"]
+
+
+def test_export_format():
+    assert export_format("out.jsonl") == "ndjson"
+    with pytest.raises(ValueError):
+        export_format("out.xlsx")
+
+
+@pytest.mark.parametrize("extension", [".csv", ".parquet", ".ndjson"])
+def test_write_batches(engine, extension):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, f"result{extension}")
+        batches = iter_raw_sql_batches(engine, "SELECT * FROM casts", batch_size=3)
+        assert write_batches(batches, path) == 10
+
+        if extension == ".csv":
+            df = pl.read_csv(path)
+        elif extension == ".parquet":
+            df = pl.from_arrow(pq.read_table(path))
+        else:
+            with open(path) as f:
+                df = pl.DataFrame([json.loads(line) for line in f])
+        assert df.height == 10
+        assert df["text"].to_list()[-1] == "cast 9"
@@ -0,0 +1,131 @@
+from typing import Callable, List, Optional, Sequence
+
+from sqlalchemy import Column, Table, column, func, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from utils.models import Base, Reaction
+from utils.state import (
+    INTERNAL_TABLE_PREFIX,
+    add_data_versions,
+    bump_data_versions,
+    create_internal_tables,
+    internal_metadata,
+)
+from utils.types import HexString
+
+
+def get_schema_version(connection: Connection) -> int:
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_schema_version(connection: Connection, version: int) -> None:
+    connection.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+
+def delete_duplicates(
+    connection: Connection, table: Table, columns: Sequence[Column]
+) -> int:
+    """Deletes the rows of `table` repeating `columns`, keeps the first one."""
+    rowid = column("rowid")
+    first_rows = select(func.min(rowid)).select_from(table).group_by(*columns)
+    result = connection.execute(table.delete().where(rowid.not_in(first_rows)))
+    if result.rowcount:
+        print(f"Deleted {result.rowcount} duplicate rows from {table.name}")
+    return result.rowcount
+
+
+def _add_ens_data_fetched_at(connection: Connection) -> None:
+    columns = inspect(connection).get_columns("ens_data")
+    if "fetched_at" not in {column["name"] for column in columns}:
+        connection.execute(text("ALTER TABLE ens_data ADD COLUMN fetched_at INTEGER"))
+
+
+def _lowercase_hex_columns(connection: Connection) -> None:
+    """Hashes and addresses are compared as lowercase strings everywhere."""
+    for table in Base.metadata.sorted_tables:
+        for hex_column in table.columns:
+            if not isinstance(hex_column.type, HexString):
+                continue
+            name = hex_column.name
+            mixed_case = f"typeof({name}) = 'text' AND {name} != lower({name})"
+            connection.execute(
+                text(
+                    f"UPDATE OR IGNORE {table.name} SET {name} = lower({name}) "
+                    f"WHERE {mixed_case}"
+                )
+            )
+            # Rows left are duplicates of a row already stored lowercase
+            connection.execute(text(f"DELETE FROM {table.name} WHERE {mixed_case}"))
+
+
+def _delete_duplicate_rows(connection: Connection) -> None:
+    """Tables that got a unique index after they could hold duplicates."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.unique:
+                delete_duplicates(connection, table, index.columns)
+
+
+def _create_model_indexes(connection: Connection) -> None:
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _index_reactions_timestamp(connection: Connection) -> List[str]:
+    # Packages export reactions in timestamp order, through this index
+    for index in Reaction.__table__.indexes:
+        if index.name == "ix_reactions_timestamp":
+            index.create(connection, checkfirst=True)
+    # No rows changed, the cached results stay valid
+    return []
+
+
+# Append only: a database at version N has run the first N migrations.
+# Migrations must be idempotent, databases created before this module
+# existed start at version 0 whatever they already contain. They return
+# the tables whose rows they changed, None for all of them.
+MIGRATIONS: List[Callable[[Connection], Optional[List[str]]]] = [
+    _add_ens_data_fetched_at,
+    _lowercase_hex_columns,
+    _delete_duplicate_rows,
+    _create_model_indexes,
+    _index_reactions_timestamp,
+]
+
+
+def is_up_to_date(engine: Engine) -> bool:
+    """Whether migrate() has nothing left to do, checked without writing."""
+    tables = set(inspect(engine).get_table_names())
+    if not set(Base.metadata.tables) | set(internal_metadata.tables) <= tables:
+        return False
+    with engine.connect() as connection:
+        return get_schema_version(connection) >= len(MIGRATIONS)
+
+
+def migrate(engine: Engine) -> None:
+    """
+    Brings the database schema up to date: creates missing tables, then runs
+    the migrations the database hasn't run yet, each in its own transaction.
+    New databases are created with the current schema right away.
+    """
+    tables = inspect(engine).get_table_names()
+    is_new = not [name for name in tables if not name.startswith(INTERNAL_TABLE_PREFIX)]
+
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+        create_internal_tables(connection)
+        add_data_versions(connection, Base.metadata.tables)
+        if is_new:
+            set_schema_version(connection, len(MIGRATIONS))
+            return
+        version = get_schema_version(connection)
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"Migrating the database to version {number}...")
+        with engine.begin() as connection:
+            changed = migration(connection)
+            bump_data_versions(
+                connection, Base.metadata.tables if changed is None else changed
+            )
+            set_schema_version(connection, number)
@@ -0,0 +1,127 @@
+from sqlalchemy import create_engine, inspect, text
+
+from utils.migrations import (
+    MIGRATIONS,
+    get_schema_version,
+    is_up_to_date,
+    migrate,
+    set_schema_version,
+)
+from utils.state import get_data_versions
+
+HASH = "0x" + "ab" * 32
+
+
+def index_names(engine, table_name):
+    return {index["name"] for index in inspect(engine).get_indexes(table_name)}
+
+
+def test_migrate_new_database():
+    engine = create_engine("sqlite:///:memory:")
+    migrate(engine)
+
+    with engine.connect() as connection:
+        assert get_schema_version(connection) == len(MIGRATIONS)
+    assert "ix_casts_timestamp" in index_names(engine, "casts")
+    assert "ix_eth_transactions_from_address" in index_names(engine, "eth_transactions")
+
+
+def test_migrate_existing_database():
+    engine = create_engine("sqlite:///:memory:")
+    with engine.begin() as connection:
+        # Tables as created by the first versions of warpy
+        connection.execute(
+            text(
+                "CREATE TABLE ens_data (address VARCHAR PRIMARY KEY, ens VARCHAR, "
+                "url VARCHAR, github VARCHAR, twitter VARCHAR, telegram VARCHAR, "
+                "email VARCHAR, discord VARCHAR)"
+            )
+        )
+        connection.execute(
+            text(
+                "CREATE TABLE erc1155_metadata (id INTEGER PRIMARY KEY, "
+                "eth_transaction_hash VARCHAR, token_id VARCHAR, value VARCHAR)"
+            )
+        )
+        connection.execute(
+            text(
+                "CREATE TABLE user_eth_transactions "
+                "(user_fid INTEGER, eth_transaction_unique_id VARCHAR)"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO ens_data (address, ens) VALUES "
+                "('0xABCD', 'upper.eth'), ('0xabcd', 'lower.eth'), ('0xEF', 'ef.eth')"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO erc1155_metadata (eth_transaction_hash, token_id, value) "
+                f"VALUES ('{HASH.upper()}', '0x1', '0x1'), ('{HASH}', '0x1', '0x1'), "
+                f"('{HASH}', '0x2', '0x1')"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO user_eth_transactions VALUES "
+                "(1, 't1'), (1, 't1'), (1, 't2'), (2, 't1'), (1, 't1')"
+            )
+        )
+
+    migrate(engine)
+    # Running it again is a no-op
+    migrate(engine)
+
+    with engine.connect() as connection:
+        assert get_schema_version(connection) == len(MIGRATIONS)
+        ens_data = connection.execute(
+            text("SELECT address, ens, fetched_at FROM ens_data ORDER BY address")
+        ).fetchall()
+        metadata = connection.execute(
+            text("SELECT id, eth_transaction_hash FROM erc1155_metadata ORDER BY id")
+        ).fetchall()
+        associations = connection.execute(
+            text("SELECT * FROM user_eth_transactions ORDER BY 1, 2")
+        ).fetchall()
+
+    assert [tuple(row) for row in ens_data] == [
+        ("0xabcd", "lower.eth", None),
+        ("0xef", "ef.eth", None),
+    ]
+    assert [tuple(row) for row in metadata] == [(1, HASH), (3, HASH)]
+    assert [tuple(row) for row in associations] == [(1, "t1"), (1, "t2"), (2, "t1")]
+
+    assert "ix_erc1155_metadata_hash_token_id" in index_names(
+        engine, "erc1155_metadata"
+    )
+    assert "ix_user_eth_transactions_user_fid_unique_id" in index_names(
+        engine, "user_eth_transactions"
+    )
+    # Tables that didn't exist are created
+    assert "ix_reactions_target_hash" in index_names(engine, "reactions")
+
+
+def test_is_up_to_date():
+    engine = create_engine("sqlite:///:memory:")
+    assert not is_up_to_date(engine)
+    migrate(engine)
+    assert is_up_to_date(engine)
+
+    with engine.begin() as connection:
+        set_schema_version(connection, len(MIGRATIONS) - 1)
+    assert not is_up_to_date(engine)
+
+
+def test_index_migration_keeps_data_versions():
+    engine = create_engine("sqlite:///:memory:")
+    migrate(engine)
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_reactions_timestamp"))
+        set_schema_version(connection, len(MIGRATIONS) - 1)
+        versions = get_data_versions(connection, ["reactions"])
+
+    migrate(engine)
+    assert "ix_reactions_timestamp" in index_names(engine, "reactions")
+    with engine.connect() as connection:
+        assert get_data_versions(connection, ["reactions"]) == versions
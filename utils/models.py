@@ -1,18 +1,34 @@
-from sqlalchemy import Column, Float, ForeignKey, Integer, String, Table
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer, String, Table
 from sqlalchemy.orm import declarative_base, relationship
 
+from utils.types import DictionaryString, HexString
+
 Base = declarative_base()
 
+# Dictionary encoded values of the compact storage schema, append only
+REACTION_TYPES = ("like", "recast")
+TRANSFER_CATEGORIES = (
+    "external",
+    "internal",
+    "erc20",
+    "erc721",
+    "erc1155",
+    "specialnft",
+    "empty",
+    "unknown",
+)
+COMMON_ASSETS = ("ETH", "WETH", "USDC", "USDT", "DAI", "MATIC", "APE", "SHIB", "LINK")
+
 
 class Cast(Base):
     __tablename__ = "casts"
 
-    hash = Column(String, primary_key=True, nullable=False)
-    thread_hash = Column(String, nullable=False)
+    hash = Column(HexString, primary_key=True, nullable=False)
+    thread_hash = Column(HexString, nullable=False)
     text = Column(String, nullable=False)
-    timestamp = Column(Integer, nullable=False)
-    author_fid = Column(Integer, ForeignKey("users.fid"), nullable=False)
-    parent_hash = Column(String, ForeignKey("casts.hash"), nullable=True)
+    timestamp = Column(Integer, nullable=False, index=True)
+    author_fid = Column(Integer, ForeignKey("users.fid"), nullable=False, index=True)
+    parent_hash = Column(HexString, ForeignKey("casts.hash"), nullable=True, index=True)
 
     reactions = relationship("Reaction", back_populates="target")
 
@@ -25,6 +41,12 @@ user_eth_transactions_association = Table(
     Column(
         "eth_transaction_unique_id", String, ForeignKey("eth_transactions.unique_id")
     ),
+    Index(
+        "ix_user_eth_transactions_user_fid_unique_id",
+        "user_fid",
+        "eth_transaction_unique_id",
+        unique=True,
+    ),
 )
 
 
@@ -39,7 +61,9 @@ class User(Base):
     follower_count = Column(Integer, nullable=False)
     verified = Column(Integer, nullable=False)
     generated_farcaster_address = Column(String, nullable=False)
-    address = Column(String, ForeignKey("ens_data.address"), nullable=True)
+    address = Column(
+        HexString, ForeignKey("ens_data.address"), nullable=True, index=True
+    )
     registered_at = Column(Integer, nullable=True)
     location_id = Column(String, ForeignKey("locations.id"), nullable=True)
 
@@ -62,17 +86,17 @@ class Location(Base):
 
 class Reaction(Base):
     __tablename__ = "reactions"
-    hash = Column(String, primary_key=True)
-    reaction_type = Column(String)  # like & recast
-    timestamp = Column(Integer)
-    target_hash = Column(String, ForeignKey("casts.hash"))
-    author_fid = Column(Integer, ForeignKey("users.fid"))
+    hash = Column(HexString, primary_key=True)
+    reaction_type = Column(DictionaryString(REACTION_TYPES))  # like & recast
+    timestamp = Column(Integer, index=True)
+    target_hash = Column(HexString, ForeignKey("casts.hash"), index=True)
+    author_fid = Column(Integer, ForeignKey("users.fid"), index=True)
     target = relationship("Cast", back_populates="reactions")
 
 
 class ENSData(Base):
     __tablename__ = "ens_data"
-    address = Column(String, primary_key=True, nullable=False)
+    address = Column(HexString, primary_key=True, nullable=False)
     ens = Column(String, nullable=True)
     url = Column(String, nullable=True)
     github = Column(String, nullable=True)
@@ -80,6 +104,7 @@ class ENSData(Base):
     telegram = Column(String, nullable=True)
     email = Column(String, nullable=True)
     discord = Column(String, nullable=True)
+    fetched_at = Column(Integer, nullable=True)  # unix ms of the last refresh
 
     users = relationship("User", back_populates="ens_data_rel")
 
@@ -88,16 +113,16 @@ class EthTransaction(Base):
     __tablename__ = "eth_transactions"
 
     unique_id = Column(String, primary_key=True, nullable=False)
-    hash = Column(String, primary_key=False, nullable=False)
+    hash = Column(HexString, primary_key=False, nullable=False)
     timestamp = Column(Integer, nullable=False)
-    block_num = Column(Integer, nullable=False)
-    from_address = Column(String, nullable=True)
-    to_address = Column(String, nullable=True)
+    block_num = Column(Integer, nullable=False, index=True)
+    from_address = Column(HexString, nullable=True, index=True)
+    to_address = Column(HexString, nullable=True, index=True)
     value = Column(Float, nullable=True)
     erc721_token_id = Column(String, nullable=True)
     token_id = Column(String, nullable=True)
-    asset = Column(String, nullable=True)
-    category = Column(String, nullable=False)
+    asset = Column(DictionaryString(COMMON_ASSETS), nullable=True)
+    category = Column(DictionaryString(TRANSFER_CATEGORIES), nullable=False)
 
     users = relationship(
         "User",
@@ -109,10 +134,19 @@ class EthTransaction(Base):
 
 class ERC1155Metadata(Base):
     __tablename__ = "erc1155_metadata"
+    __table_args__ = (
+        # One row per token of a transfer
+        Index(
+            "ix_erc1155_metadata_hash_token_id",
+            "eth_transaction_hash",
+            "token_id",
+            unique=True,
+        ),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
     eth_transaction_hash = Column(
-        String, ForeignKey("eth_transactions.hash"), nullable=False
+        HexString, ForeignKey("eth_transactions.hash"), nullable=False
     )
     token_id = Column(String, nullable=False)
     value = Column(String, nullable=False)
@@ -0,0 +1,75 @@
+import time
+from typing import Iterator, Optional
+
+import polars as pl
+import pyarrow as pa
+from rich import box
+from rich.console import Console
+from rich.panel import Panel
+from sqlalchemy.engine import Engine
+
+from utils.duckdb_query import WRITE_PATTERN, parquet_tables
+from utils.export import print_rate
+from utils.models import Base
+from utils.state import INTERNAL_TABLE_PREFIX
+
+console = Console()
+
+
+def database_is_empty(engine: Engine) -> bool:
+    with engine.connect() as connection:
+        return not any(
+            connection.exec_driver_sql(f"SELECT 1 FROM {name} LIMIT 1").first()
+            for name in Base.metadata.tables
+        )
+
+
+def polars_sql_context(parquet_dir: str) -> pl.SQLContext:
+    """
+    A Polars SQL context with a lazy scan of every Parquet file of
+    `parquet_dir`, so queries only read the columns and row groups they
+    need.
+    """
+    context = pl.SQLContext()
+    for table_name, path in parquet_tables(parquet_dir).items():
+        if not table_name.startswith(INTERNAL_TABLE_PREFIX):
+            context.register(table_name, pl.scan_parquet(path))
+    return context
+
+
+def polars_query(
+    query: str, parquet_dir: str, limit: Optional[int] = None
+) -> pl.LazyFrame:
+    lazy_frame = polars_sql_context(parquet_dir).execute(query)
+    return lazy_frame if limit is None else lazy_frame.limit(limit)
+
+
+def iter_polars_batches(
+    query: str, parquet_dir: str, limit: Optional[int] = None
+) -> Iterator[pa.RecordBatch]:
+    """The result as record batches, computed in memory first."""
+    table = polars_query(query, parquet_dir, limit).collect().to_arrow()
+    yield from table.to_batches() or [pa.RecordBatch.from_pylist([], table.schema)]
+
+
+def execute_polars_sql(
+    query: str, parquet_dir: str, limit: Optional[int] = None
+) -> Optional[pl.DataFrame]:
+    """
+    Runs a read query over the Parquet files in `parquet_dir` with Polars,
+    for when DuckDB isn't installed. Polars' SQL covers less than SQLite's.
+    """
+    print()
+    console.print(
+        Panel(query, title="Running SQL with Polars", box=box.SQUARE, expand=False)
+    )
+    print()
+
+    if WRITE_PATTERN.search(query):
+        print("Parquet files are read only, run writes on the database.")
+        return None
+
+    started_at = time.perf_counter()
+    df = polars_query(query, parquet_dir, limit).collect()
+    print_rate(df.height, started_at)
+    return df
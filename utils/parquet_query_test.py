@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils.duckdb_query import parquet_tables
+from utils.models import Base
+from utils.parquet_query import database_is_empty, execute_polars_sql, polars_query
+
+
+@pytest.fixture
+def parquet_dir():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        pq.write_table(
+            pa.table({"fid": [1, 2, 3], "username": ["a", "b", "c"]}),
+            os.path.join(tmpdirname, "users.parquet"),
+        )
+        os.mkdir(os.path.join(tmpdirname, "archive"))
+        yield tmpdirname
+
+
+def test_parquet_tables(parquet_dir):
+    assert list(parquet_tables(parquet_dir)) == ["users"]
+
+
+def test_polars_query_pushes_down(parquet_dir):
+    lazy_frame = polars_query("SELECT username FROM users WHERE fid > 1", parquet_dir)
+    plan = lazy_frame.describe_optimized_plan()
+    assert "PARQUET SCAN" in plan and "SELECTION" in plan
+    assert lazy_frame.collect()["username"].to_list() == ["b", "c"]
+
+
+def test_execute_polars_sql(parquet_dir):
+    df = execute_polars_sql("SELECT fid FROM users", parquet_dir, limit=2)
+    assert df["fid"].to_list() == [1, 2]
+    assert execute_polars_sql("DELETE FROM users", parquet_dir) is None
+
+
+def test_database_is_empty():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    assert database_is_empty(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO ens_data (address) VALUES ('0xab')"))
+    assert not database_is_empty(engine)
@@ -0,0 +1,202 @@
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set
+
+from sqlalchemy import exc
+from sqlalchemy.engine import Connection
+
+# Tables scanned in full are flagged from this many rows on
+LARGE_TABLE_ROWS = 100000
+
+# SQLite VM instructions between two checks of the time budget
+PROGRESS_INSTRUCTIONS = 10000
+
+_NOT_ALIASES = set(
+    "as cross except full group having indexed inner intersect join left limit "
+    "natural not on order outer right union using where window".split()
+)
+
+_PREDICATE = r"(?:=|<|>|!=|\bIN\b|\bLIKE\b|\bGLOB\b|\bBETWEEN\b|\bIS\b)"
+
+
+class QueryTimeoutError(Exception):
+    pass
+
+
+class FullScan(NamedTuple):
+    table: str
+    rows: int
+    # Scanned again for every row of an outer loop: a cartesian join, or a
+    # join on columns without an index
+    nested: bool
+    # Filtered or joined on, without being the first column of an index
+    unindexed_columns: List[str]
+
+
+def table_aliases(sql: str, tables: Set[str]) -> Dict[str, str]:
+    """Table by name or alias, for the tables of `tables` in `sql`."""
+    aliases = {table: table for table in tables}
+    for table in tables:
+        pattern = rf"\b{re.escape(table)}\s+(?:AS\s+)?(\w+)"
+        for match in re.finditer(pattern, sql, re.IGNORECASE):
+            alias = match.group(1).lower()
+            if alias not in _NOT_ALIASES and alias not in tables:
+                aliases[alias] = table
+    return aliases
+
+
+def filtered_columns(sql: str, columns: List[str], names: Set[str]) -> List[str]:
+    """The columns compared in `sql`, unqualified or qualified with `names`."""
+    found = []
+    for column in columns:
+        qualified = rf"(?:\b(\w+)\s*\.\s*)?\b{re.escape(column)}\b"
+        patterns = [rf"{qualified}\s*{_PREDICATE}", rf"(?:=|<|>)\s*{qualified}"]
+        for pattern in patterns:
+            if any(
+                match.group(1) is None or match.group(1).lower() in names
+                for match in re.finditer(pattern, sql, re.IGNORECASE)
+            ):
+                found.append(column)
+                break
+    return found
+
+
+def indexed_columns(connection: Connection, table: str) -> Set[str]:
+    """Columns some index of `table` starts with, the rowid included."""
+    columns: Set[str] = set()
+    for index in connection.exec_driver_sql(f"PRAGMA index_list('{table}')"):
+        info = connection.exec_driver_sql(f"PRAGMA index_info('{index[1]}')")
+        columns.update(row[2] for row in info if row[0] == 0)
+    primary_key = [
+        row[1]
+        for row in connection.exec_driver_sql(f"PRAGMA table_info('{table}')")
+        if row[5]
+    ]
+    if len(primary_key) == 1:
+        columns.add(primary_key[0])
+    return columns
+
+
+def table_rows(connection: Connection, table: str) -> int:
+    """The largest rowid, as good as the row count and read in O(1)."""
+    try:
+        return (
+            connection.exec_driver_sql(f"SELECT max(rowid) FROM {table}").scalar() or 0
+        )
+    except exc.OperationalError:  # WITHOUT ROWID tables
+        return connection.exec_driver_sql(f"SELECT count(*) FROM {table}").scalar()
+
+
+def find_full_scans(
+    connection: Connection, sql: str, large_table_rows: int = LARGE_TABLE_ROWS
+) -> List[FullScan]:
+    """The tables of large size `sql` reads in full, by its query plan."""
+    tables = {
+        row[0].lower()
+        for row in connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    }
+    aliases = table_aliases(sql, tables)
+    plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+
+    scans = []
+    loops_by_parent: Dict[int, int] = {}
+    for _, parent, _, detail in plan:
+        loop = re.match(r"(SCAN|SEARCH) (\w+)", detail)
+        if not loop:
+            continue
+        outer_loops = loops_by_parent.get(parent, 0)
+        loops_by_parent[parent] = outer_loops + 1
+
+        table = aliases.get(loop.group(2).lower())
+        if loop.group(1) != "SCAN" or "INDEX" in detail or table is None:
+            continue
+        rows = table_rows(connection, table)
+        if rows < large_table_rows:
+            continue
+
+        names = {name for name, aliased in aliases.items() if aliased == table}
+        columns = [
+            row[1]
+            for row in connection.exec_driver_sql(f"PRAGMA table_info('{table}')")
+        ]
+        indexed = indexed_columns(connection, table)
+        unindexed = [
+            column
+            for column in filtered_columns(sql, columns, names)
+            if column not in indexed
+        ]
+        scans.append(FullScan(table, rows, outer_loops > 0, unindexed))
+    return scans
+
+
+def index_statements(scan: FullScan) -> List[str]:
+    return [
+        f"CREATE INDEX IF NOT EXISTS ix_{scan.table}_{column} "
+        f"ON {scan.table} ({column})"
+        for column in scan.unindexed_columns
+    ]
+
+
+def review_query_plan(
+    connection: Connection,
+    sql: str,
+    create_indexes: bool = False,
+    large_table_rows: int = LARGE_TABLE_ROWS,
+) -> List[FullScan]:
+    """
+    Warns about the full scans of large tables in the plan of `sql`, and
+    suggests the indexes that would avoid them, creating them when
+    `create_indexes` is set.
+    """
+    scans = find_full_scans(connection, sql, large_table_rows)
+    for scan in scans:
+        if scan.nested:
+            print(
+                f"Warning: {scan.table} ({scan.rows:,} rows) is scanned in full "
+                "for every row of another table, check the join conditions."
+            )
+        else:
+            print(f"Warning: {scan.table} ({scan.rows:,} rows) is scanned in full.")
+        for statement in index_statements(scan):
+            if create_indexes:
+                print(f"Creating the index: {statement}")
+                connection.exec_driver_sql(statement)
+            else:
+                print(f"  Suggested index (--create-indexes creates it): {statement}")
+    return scans
+
+
+@contextmanager
+def time_budget(connection: Connection, seconds: Optional[float]) -> Iterator:
+    """
+    Interrupts the SQLite statements run on `connection` once `seconds`
+    have passed, raising QueryTimeoutError.
+    """
+    if not seconds:
+        yield
+        return
+
+    dbapi_connection: sqlite3.Connection = connection.connection.dbapi_connection
+    deadline = time.perf_counter() + seconds
+    dbapi_connection.set_progress_handler(
+        lambda: time.perf_counter() > deadline, PROGRESS_INSTRUCTIONS
+    )
+    try:
+        yield
+    except (exc.OperationalError, sqlite3.OperationalError) as e:
+        if "interrupted" in str(e):
+            raise QueryTimeoutError(
+                f"The query was cancelled after the time budget of {seconds}s"
+            ) from e
+        raise
+    finally:
+        dbapi_connection.set_progress_handler(None, PROGRESS_INSTRUCTIONS)
+
+
+def print_timings(timings: Dict[str, float]) -> None:
+    steps = ", ".join(f"{step} {seconds:.2f}s" for step, seconds in timings.items())
+    print(f"Timings: {steps}, total {sum(timings.values()):.2f}s")
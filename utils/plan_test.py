@@ -0,0 +1,81 @@
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils.plan import (
+    QueryTimeoutError,
+    find_full_scans,
+    review_query_plan,
+    table_aliases,
+    time_budget,
+)
+from utils.query import execute_raw_sql
+
+
+@pytest.fixture
+def engine():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        engine = create_engine(f"sqlite:///{tmpdirname}/test.db")
+        with engine.begin() as connection:
+            connection.execute(
+                text("CREATE TABLE casts (hash TEXT PRIMARY KEY, author_fid INTEGER)")
+            )
+            connection.execute(
+                text("CREATE TABLE users (fid INTEGER PRIMARY KEY, username TEXT)")
+            )
+            connection.execute(
+                text(
+                    "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n "
+                    "WHERE i < 200) INSERT INTO casts SELECT 'h' || i, i FROM n"
+                )
+            )
+            connection.execute(
+                text("INSERT INTO users SELECT author_fid, 'u' FROM casts")
+            )
+        yield engine
+
+
+def test_table_aliases():
+    sql = "SELECT * FROM casts AS c JOIN users u ON u.fid = c.author_fid WHERE 1"
+    assert table_aliases(sql, {"casts", "users"}) == {
+        "casts": "casts",
+        "users": "users",
+        "c": "casts",
+        "u": "users",
+    }
+
+
+def test_find_full_scans(engine):
+    with engine.connect() as connection:
+        (scan,) = find_full_scans(
+            connection,
+            "SELECT * FROM users u JOIN casts c ON c.author_fid = u.fid "
+            "WHERE u.fid = 3",
+            large_table_rows=100,
+        )
+        assert scan.table == "casts"
+        assert scan.unindexed_columns == ["author_fid"]
+
+        scans = find_full_scans(connection, "SELECT * FROM casts, users", 100)
+        assert [scan.nested for scan in scans] == [False, True]
+        assert find_full_scans(connection, "SELECT * FROM casts, users", 1000) == []
+
+
+def test_review_query_plan_creates_indexes(engine):
+    sql = "SELECT * FROM casts WHERE author_fid = 3"
+    with engine.begin() as connection:
+        assert review_query_plan(connection, sql, True, large_table_rows=100)
+        assert not review_query_plan(connection, sql, True, large_table_rows=100)
+
+
+def test_time_budget(engine):
+    cartesian = "SELECT count(*) FROM casts a, casts b, casts c, casts d"
+    with engine.connect() as connection:
+        with pytest.raises(QueryTimeoutError):
+            with time_budget(connection, 0.1):
+                connection.exec_driver_sql(cartesian).scalar()
+        # The handler is removed afterwards
+        assert connection.exec_driver_sql("SELECT count(*) FROM users").scalar() == 200
+
+    assert execute_raw_sql(engine, cartesian, timeout=0.1) is None
@@ -1,16 +1,36 @@
+import functools
+import hashlib
 import os
 import re
-from typing import Optional
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import polars as pl
+import pyarrow as pa
 from dotenv import load_dotenv
 from langchain.chat_models import ChatOpenAI
-from langchain.schema import AIMessage, HumanMessage, SystemMessage
+from langchain.schema import AIMessage, BaseMessage, HumanMessage, SystemMessage
 from rich import box
 from rich.console import Console
 from rich.panel import Panel
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.engine import Engine
 
+from utils.cache import referenced_tables
+from utils.export import print_rate
+from utils.models import Base
+from utils.plan import QueryTimeoutError, print_timings, review_query_plan, time_budget
+from utils.state import bump_data_versions, warpy_nl_queries
+from utils.storage import compact_schema_hint
+from utils.types import (
+    DictionaryString,
+    decode_column,
+    dictionary_result_columns,
+    is_compact,
+)
+from utils.views import views_schema_hint
+
 console = Console()
 
 load_dotenv()
@@ -21,66 +41,290 @@ def remove_imports_from_models(model_str):
     return model_str[start:]
 
 
+@functools.lru_cache(maxsize=None)
 def get_sqlalchemy_models():
-    with open("utils/models.py", "r") as f:
+    path = os.path.join(os.path.dirname(__file__), "models.py")
+    with open(path, "r") as f:
         sqlalchemy_models = f.read()
     return remove_imports_from_models(sqlalchemy_models)
 
 
-def execute_raw_sql(engine: Engine, query: str) -> Optional[pl.DataFrame]:
+def to_arrow_array(values: List[Any]) -> pa.Array:
+    """SQLite columns can mix types, those that do are turned to strings."""
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if value is None else str(value) for value in values])
+
+
+def result_schema(batch: pa.RecordBatch) -> pa.Schema:
+    """The schema of a result, inferred from its first batch."""
+    return pa.schema(
+        pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+        for field in batch.schema
+    )
+
+
+def conform_batch(batch: pa.RecordBatch, schema: pa.Schema) -> pa.RecordBatch:
+    arrays = []
+    for array, field in zip(batch.columns, schema):
+        try:
+            arrays.append(array.cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            raise ValueError(
+                f"Column {field.name} holds {array.type} values after "
+                f"{field.type} ones, CAST it in the SQL."
+            ) from None
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_raw_sql_batches(
+    engine: Engine,
+    query: str,
+    batch_size: int = 65536,
+    limit: Optional[int] = None,
+    timeout: Optional[float] = None,
+    timings: Optional[Dict[str, float]] = None,
+) -> Iterator[pa.RecordBatch]:
+    """
+    Streams the result of a read query as Arrow record batches of up to
+    `batch_size` rows, at most `limit` rows, so results of any size can be
+    exported in constant memory. Column types are inferred from the first
+    batch, columns without values in it are strings. The query is cancelled
+    after `timeout` seconds, the time spent in SQLite and converting rows is
+    added up in `timings`.
+    """
+    timings = {} if timings is None else timings
+    timings.setdefault("sqlite", 0.0)
+    timings.setdefault("convert", 0.0)
+
+    with engine.connect() as con, time_budget(con, timeout):
+        started_at = time.perf_counter()
+        result = con.execution_options(stream_results=True).exec_driver_sql(query)
+        names = list(result.keys())
+        warn_undecoded_columns(engine, names)
+        partitions = result.partitions(batch_size)
+        schema = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            rows = next(partitions, None)
+            timings["sqlite"] += time.perf_counter() - started_at
+            if rows is None:
+                break
+
+            started_at = time.perf_counter()
+            if remaining is not None:
+                rows = rows[:remaining]
+                remaining -= len(rows)
+            arrays = [
+                to_arrow_array(decode_result_column(engine, name, list(values)))
+                for name, values in zip(names, zip(*rows))
+            ]
+            batch = pa.RecordBatch.from_arrays(arrays, names=names)
+            if schema is None:
+                schema = result_schema(batch)
+            batch = conform_batch(batch, schema)
+            timings["convert"] += time.perf_counter() - started_at
+
+            yield batch
+            started_at = time.perf_counter()
+        result.close()
+
+        if schema is None:
+            yield pa.RecordBatch.from_arrays(
+                [pa.array([], pa.string()) for _ in names], names=names
+            )
+
+
+def execute_raw_sql(
+    engine: Engine,
+    query: str,
+    limit: Optional[int] = None,
+    timeout: Optional[float] = None,
+    create_indexes: bool = False,
+) -> Optional[pl.DataFrame]:
     print()
     console.print(Panel(query, title="Running SQL", box=box.SQUARE, expand=False))
     print()
 
-    with engine.connect() as con:
-        if re.search(r"(?i)\b(insert|update|delete|drop)\b", query):
-            user_confirmation = input(
-                "This operation will modify or delete data. Are you sure you want to proceed? [y/N]: "
-            )
+    if re.search(r"(?i)\b(insert|update|delete|drop)\b", query):
+        user_confirmation = input(
+            "This operation will modify or delete data. Are you sure you want to proceed? [y/N]: "
+        )
 
-            if user_confirmation.lower() != "y":
-                print("Operation cancelled.")
-                return None
+        if user_confirmation.lower() != "y":
+            print("Operation cancelled.")
+            return None
 
+        with engine.begin() as con:
             result = con.execute(query)
             print(f"{result.rowcount} rows affected.")
-        else:
-            result = con.execute(query)
-            column_names = result.keys()
-            data = [tuple(row) for row in result.fetchall()]
-            df = pl.DataFrame(data, schema=column_names)
-            return df
+            bump_data_versions(con, referenced_tables(query) or Base.metadata.tables)
+        return None
 
+    started_at = time.perf_counter()
+    with engine.begin() as con:
+        review_query_plan(con, query, create_indexes)
+    timings = {"plan": time.perf_counter() - started_at}
+
+    try:
+        table = pa.Table.from_batches(
+            list(
+                iter_raw_sql_batches(
+                    engine, query, limit=limit, timeout=timeout, timings=timings
+                )
+            )
+        )
+    except QueryTimeoutError as e:
+        print(f"{e}, raise it with --timeout.")
+        return None
+    print_timings(timings)
+    print_rate(table.num_rows, started_at)
+    return pl.DataFrame(table)
 
-def execute_natural_language_query(
-    engine: Engine, query: str
-) -> Optional[pl.DataFrame]:
-    chat = ChatOpenAI(temperature=0, openai_api_key=os.getenv("OPENAI_API_KEY"))
 
-    initial_prompt_raw = """
+@functools.lru_cache(maxsize=None)
+def model_dictionary_columns() -> Tuple[Dict[str, DictionaryString], Set[str]]:
+    return dictionary_result_columns(Base.metadata)
+
+
+def decode_result_column(engine: Engine, name: str, values: List[Any]) -> List[Any]:
+    """
+    Hex-encodes BLOBs of a raw SQL result column and, on compact databases,
+    decodes the dictionary codes of a column named like the only dictionary
+    column of that name.
+    """
+    column_type = None
+    if is_compact(engine.dialect):
+        column_type = model_dictionary_columns()[0].get(name)
+    return decode_column(column_type, values)
+
+
+def warn_undecoded_columns(engine: Engine, names: List[str]) -> None:
+    if not is_compact(engine.dialect):
+        return
+    ambiguous = [name for name in names if name in model_dictionary_columns()[1]]
+    if ambiguous:
+        print(
+            f"Warning: {', '.join(ambiguous)} may hold dictionary codes of "
+            "several tables, they are returned as stored. Translate the codes "
+            "in the SQL with a CASE expression to get their text."
+        )
+
+
+SYSTEM_PROMPT = "You are a SQL writer. If the user asks about anything than SQL, deny. You are a very good SQL writer. Nothing else. Don't explain, don't say anything except the SQL."
+
+INITIAL_PROMPT = """
     Your job is to turn user queries (in natural language) to SQL. Only return the SQL and nothing else. Don't explain, don't say "here's your query." Just give the SQL. Say "Yes." if you understand.
 
-    Timestamp is in unix millisecond format, anything timestamp related must be multiplied by 1000. The database is in SQLite, adjust accordingly. Here are the schema:
+    Timestamp is in unix millisecond format, anything timestamp related must be multiplied by 1000. The database is in {dialect}, adjust accordingly. Here are the schema:
     """
 
-    system_prompt = SystemMessage(
-        content="You are a SQL writer. If the user asks about anything than SQL, deny. You are a very good SQL writer. Nothing else. Don't explain, don't say anything except the SQL."
+# Turns the prompt messages into the LLM's answer
+LLMClient = Callable[[List[BaseMessage]], str]
+
+
+@functools.lru_cache(maxsize=None)
+def build_prompt(dialect: str, schema_hint: str) -> Tuple[BaseMessage, ...]:
+    """The messages preceding every question, built once per schema."""
+    initial_prompt = INITIAL_PROMPT.format(dialect=dialect)
+    return (
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(
+            content=f"{initial_prompt}\n\n{get_sqlalchemy_models()}\n\n{schema_hint}"
+        ),
+        AIMessage(content="Yes."),
     )
 
-    initial_prompt = HumanMessage(
-        content=f"{initial_prompt_raw}\n\n{get_sqlalchemy_models()}"
+
+def prompt_hash(prompt: Tuple[BaseMessage, ...]) -> str:
+    """Changes with the schema, the SQL of cached translations with it."""
+    digest = hashlib.sha256()
+    for message in prompt:
+        digest.update(message.content.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split()).rstrip("?.! ")
+
+
+def extract_sql(answer: str) -> str:
+    """The SQL of the LLM's answer, without the Markdown code fence."""
+    match = re.search(r"```(?:sql)?\s*(.*?)```", answer, re.DOTALL | re.IGNORECASE)
+    return (match.group(1) if match else answer).strip()
+
+
+@functools.lru_cache(maxsize=None)
+def openai_client() -> LLMClient:
+    chat = ChatOpenAI(temperature=0, openai_api_key=os.getenv("OPENAI_API_KEY"))
+    return lambda messages: chat(messages).content
+
+
+def get_cached_sql(engine: Engine, prompt_hash: str, question: str) -> Optional[str]:
+    with engine.begin() as connection:
+        return connection.execute(
+            select(warpy_nl_queries.c.sql).where(
+                warpy_nl_queries.c.prompt_hash == prompt_hash,
+                warpy_nl_queries.c.question == normalize_question(question),
+            )
+        ).scalar()
+
+
+def cache_sql(engine: Engine, prompt_hash: str, question: str, sql: str) -> None:
+    statement = sqlite_insert(warpy_nl_queries).values(
+        prompt_hash=prompt_hash, question=normalize_question(question), sql=sql
     )
+    with engine.begin() as connection:
+        connection.execute(
+            statement.on_conflict_do_update(
+                index_elements=[
+                    warpy_nl_queries.c.prompt_hash,
+                    warpy_nl_queries.c.question,
+                ],
+                set_={"sql": sql},
+            )
+        )
 
-    ai_response = AIMessage(content="Yes.")
 
-    query_message = HumanMessage(content=query)
+def execute_natural_language_query(
+    engine: Engine,
+    query: str,
+    dialect: str = "SQLite",
+    execute: Optional[Callable[[str], Optional[pl.DataFrame]]] = None,
+    llm: Optional[LLMClient] = None,
+    use_cache: bool = True,
+    views: bool = True,
+) -> Optional[pl.DataFrame]:
+    """
+    Asks the LLM for the SQL answering `query`, then runs it with `execute`,
+    by default on SQLite. The SQL of questions that ran and returned rows
+    is reused for the same question, ignoring case, spacing and the final
+    punctuation, until the schema changes. With `views`, the LLM is told
+    about the materialized views, to answer from them when it can.
+    """
+    schema_hint = compact_schema_hint(engine)
+    if views:
+        schema_hint = f"{schema_hint}\n\n{views_schema_hint(engine)}".strip()
+    prompt = build_prompt(dialect, schema_hint)
+    schema = prompt_hash(prompt)
 
-    messages = [system_prompt, initial_prompt, ai_response, query_message]
     print()
     console.print(Panel(query, title="Your query", box=box.SQUARE, expand=False))
 
-    sql_query = chat(messages)
-    return execute_raw_sql(engine, sql_query.content)
+    sql_query = get_cached_sql(engine, schema, query) if use_cache else None
+    if sql_query is not None:
+        print("Reusing the SQL of the same question asked before.")
+    else:
+        llm = llm or openai_client()
+        sql_query = extract_sql(llm([*prompt, HumanMessage(content=query)]))
+
+    df = (execute or functools.partial(execute_raw_sql, engine))(sql_query)
+    # Only SQL that ran and returned rows is reused
+    if use_cache and df is not None and df.height > 0:
+        cache_sql(engine, schema, query, sql_query)
+    return df
 
 
 # def execute_advanced_query(query: str):
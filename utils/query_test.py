@@ -0,0 +1,79 @@
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils.query import (
+    build_prompt,
+    execute_natural_language_query,
+    extract_sql,
+    normalize_question,
+)
+from utils.state import create_internal_tables
+
+
+@pytest.fixture
+def engine():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        engine = create_engine(f"sqlite:///{tmpdirname}/test.db")
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE users (fid INTEGER)"))
+            connection.execute(text("INSERT INTO users VALUES (1), (2)"))
+            create_internal_tables(connection)
+        yield engine
+
+
+class StubLLM:
+    def __init__(self, answer: str):
+        self.answer = answer
+        self.prompts = []
+
+    def __call__(self, messages):
+        self.prompts.append(messages)
+        return self.answer
+
+
+def test_normalize_question():
+    assert normalize_question("  How many   Users? ") == "how many users"
+
+
+def test_extract_sql():
+    assert extract_sql("```sql\nSELECT 1;\n```") == "SELECT 1;"
+    assert extract_sql(" SELECT 1 ") == "SELECT 1"
+
+
+def test_build_prompt_is_built_once():
+    assert build_prompt("SQLite", "") is build_prompt("SQLite", "")
+    assert "DuckDB" in build_prompt("DuckDB", "")[1].content
+
+
+def test_execute_natural_language_query_reuses_sql(engine):
+    llm = StubLLM("SELECT count(*) AS n FROM users")
+    df = execute_natural_language_query(engine, "How many users?", llm=llm)
+    assert df["n"].to_list() == [2]
+    assert llm.prompts[0][-1].content == "How many users?"
+
+    df = execute_natural_language_query(engine, "how many users", llm=llm)
+    assert df["n"].to_list() == [2]
+    assert len(llm.prompts) == 1
+
+    execute_natural_language_query(engine, "how many users", llm=llm, use_cache=False)
+    # Another schema doesn't reuse it
+    execute_natural_language_query(engine, "how many users", "DuckDB", llm=llm)
+    assert len(llm.prompts) == 3
+
+
+def test_execute_natural_language_query_skips_failed_sql(engine):
+    llm = StubLLM("SELECT * FROM missing")
+    for _ in range(2):
+        with pytest.raises(Exception):
+            execute_natural_language_query(engine, "missing rows", llm=llm)
+    assert len(llm.prompts) == 2
+
+
+def test_execute_natural_language_query_skips_empty_results(engine):
+    llm = StubLLM("SELECT * FROM users WHERE fid > 10")
+    for _ in range(2):
+        df = execute_natural_language_query(engine, "users after 10", llm=llm)
+        assert df.height == 0
+    assert len(llm.prompts) == 2
@@ -0,0 +1,170 @@
+import os
+from typing import Dict, Optional
+
+import polars as pl
+from sqlalchemy.engine import Engine
+
+from utils.cache import ResultCache, cached_query
+from utils.duckdb_query import (
+    WRITE_PATTERN,
+    execute_duckdb_sql,
+    import_duckdb,
+    iter_duckdb_batches,
+    parquet_tables,
+)
+from utils.export import export_format, write_batches
+from utils.parquet_query import (
+    database_is_empty,
+    execute_polars_sql,
+    iter_polars_batches,
+)
+from utils.plan import QueryTimeoutError, review_query_plan
+from utils.query import (
+    execute_natural_language_query,
+    execute_raw_sql,
+    iter_raw_sql_batches,
+)
+
+
+class QueryRunner:
+    """
+    Runs SQL and questions on the backend picked for the database: SQLite,
+    DuckDB when asked for or when rows are archived, and the Parquet files
+    of a package when the database is empty. Shared by the query command
+    and the shell, which keeps one runner, and so its engine, warm.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        duckdb: bool = False,
+        parquet_dir: Optional[str] = None,
+        archive: Optional[Dict[str, str]] = None,
+        limit: Optional[int] = None,
+        cache: bool = True,
+        output: Optional[str] = None,
+        timeout: Optional[float] = None,
+        create_indexes: bool = False,
+    ):
+        if output:
+            export_format(output)  # Fail early
+
+        datasets_dir = os.path.dirname(engine.url.database or "")
+        if (
+            parquet_dir is None
+            and parquet_tables(datasets_dir)
+            and database_is_empty(engine)
+        ):
+            parquet_dir = datasets_dir
+            print(
+                f"The database is empty, querying the Parquet files in {datasets_dir}."
+            )
+
+        if archive and not duckdb and parquet_dir is None:
+            try:
+                import_duckdb()
+                duckdb = True
+                print("Older rows are archived, querying with DuckDB to include them.")
+            except ImportError:
+                print(
+                    "Warning: rows archived in datasets/archive aren't included, "
+                    "install duckdb (pip install duckdb) to query them too."
+                )
+
+        # Parquet files are read with Polars when DuckDB isn't installed
+        polars = False
+        if parquet_dir is not None and not duckdb:
+            try:
+                import_duckdb()
+                duckdb = True
+            except ImportError:
+                polars = True
+
+        if duckdb:
+            import_duckdb()
+
+        self.engine = engine
+        self.duckdb = duckdb
+        self.polars = polars
+        self.parquet_dir = parquet_dir
+        self.archive = archive
+        self.limit = limit
+        self.cache = cache
+        self.output = output
+        self.timeout = timeout
+        self.create_indexes = create_indexes
+
+    @property
+    def dialect(self) -> str:
+        if self.duckdb:
+            return "DuckDB"
+        return "Polars SQL" if self.polars else "SQLite"
+
+    def execute(self, sql: str) -> Optional[pl.DataFrame]:
+        if self.output and not WRITE_PATTERN.search(sql):
+            self.export(sql, self.output)
+            return None
+
+        # Package files aren't versioned like the database's tables
+        if self.cache and self.parquet_dir is None:
+            backend = "duckdb" if self.duckdb else "sqlite"
+            return cached_query(
+                self.engine, sql, self.run, ResultCache(), backend, self.limit
+            )
+        return self.run(sql)
+
+    def run(self, sql: str) -> Optional[pl.DataFrame]:
+        # DuckDB attaches the database read only, writes stay on SQLite
+        writes_database = self.parquet_dir is None and WRITE_PATTERN.search(sql)
+        if self.duckdb and not writes_database:
+            return execute_duckdb_sql(
+                self.engine,
+                sql,
+                self.parquet_dir,
+                self.archive,
+                self.limit,
+                self.timeout,
+            )
+        # Polars only reads Parquet files, parquet_dir is always set with it
+        if self.polars and self.parquet_dir is not None:
+            return execute_polars_sql(sql, self.parquet_dir, self.limit)
+        return execute_raw_sql(
+            self.engine, sql, self.limit, self.timeout, self.create_indexes
+        )
+
+    def export(self, sql: str, output: str) -> None:
+        """Streams the result of `sql` to the file `output`."""
+        if self.duckdb:
+            batches = iter_duckdb_batches(
+                self.engine,
+                sql,
+                self.parquet_dir,
+                self.archive,
+                limit=self.limit,
+                timeout=self.timeout,
+            )
+        elif self.polars and self.parquet_dir is not None:
+            batches = iter_polars_batches(sql, self.parquet_dir, self.limit)
+        else:
+            with self.engine.begin() as connection:
+                review_query_plan(connection, sql, self.create_indexes)
+            batches = iter_raw_sql_batches(
+                self.engine, sql, limit=self.limit, timeout=self.timeout
+            )
+        try:
+            write_batches(batches, output)
+        except QueryTimeoutError as e:
+            print(f"Error: {e}, {output} is incomplete.")
+            return
+        print(f"Saved the result to {output}")
+
+    def ask(self, question: str) -> Optional[pl.DataFrame]:
+        return execute_natural_language_query(
+            self.engine,
+            question,
+            self.dialect,
+            self.execute,
+            use_cache=self.cache,
+            # Packages don't include the views
+            views=self.parquet_dir is None,
+        )
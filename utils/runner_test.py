@@ -0,0 +1,22 @@
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils.migrations import migrate
+from utils.runner import QueryRunner
+
+
+def test_writes_run_on_sqlite_with_duckdb(monkeypatch):
+    pytest.importorskip("duckdb")
+    monkeypatch.setattr("builtins.input", lambda prompt: "y")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        engine = create_engine(f"sqlite:///{os.path.join(tmpdirname, 'test.db')}")
+        migrate(engine)
+        runner = QueryRunner(engine, duckdb=True)
+
+        runner.run("INSERT INTO locations (id, description) VALUES ('1', 'Earth')")
+        with engine.connect() as connection:
+            count = connection.execute(text("SELECT COUNT(*) FROM locations"))
+            assert count.scalar() == 1
@@ -0,0 +1,124 @@
+import os
+import time
+from typing import Callable, List, Optional
+
+from prompt_toolkit import PromptSession
+from prompt_toolkit.history import FileHistory, History, InMemoryHistory
+from sqlalchemy import inspect
+
+from utils.duckdb_query import parquet_tables
+from utils.export import export_format
+from utils.runner import QueryRunner
+
+HISTORY_PATH = "datasets/.query_history"
+
+HELP = """\
+End SQL statements with ; to run them, they can span several lines.
+  ? <question>         Ask a question in natural language
+  .tables              List the tables
+  .limit <rows>|off    Return at most this many rows
+  .output <file>|off   Stream results to a .csv, .parquet or .ndjson file
+  .cache on|off        Reuse cached results and translated questions
+  .help                Show this message
+  .quit                Leave the shell (or Ctrl-D)"""
+
+
+class QueryShell:
+    """
+    An interactive prompt running SQL and questions with one QueryRunner,
+    so the engine and its connection, the compiled prompt and the LLM
+    client are set up once for the whole session.
+    """
+
+    def __init__(self, runner: QueryRunner, output: Callable[[str], None] = print):
+        self.runner = runner
+        self.output = output
+        self.lines: List[str] = []
+
+    @property
+    def prompt(self) -> str:
+        return "...> " if self.lines else "warpy> "
+
+    def feed(self, line: str) -> bool:
+        """Handles a line of input, returns False when the shell should stop."""
+        stripped = line.strip()
+        if not self.lines:
+            if not stripped:
+                return True
+            if stripped.startswith("."):
+                return self.command(stripped)
+            if stripped.startswith("?"):
+                self.timed(lambda: self.runner.ask(stripped[1:].strip()))
+                return True
+
+        self.lines.append(line)
+        if stripped.endswith(";"):
+            sql = "\n".join(self.lines).strip()
+            self.lines = []
+            self.timed(lambda: self.runner.execute(sql))
+        return True
+
+    def timed(self, run: Callable) -> None:
+        started_at = time.perf_counter()
+        try:
+            df = run()
+        except KeyboardInterrupt:
+            self.output("Cancelled.")
+            return
+        except Exception as e:
+            self.output(f"Error: {e}")
+            return
+        if df is not None:
+            self.output(str(df))
+        self.output(f"({time.perf_counter() - started_at:.2f}s)")
+
+    def command(self, line: str) -> bool:
+        name, _, argument = line.partition(" ")
+        argument = argument.strip()
+        if name in (".quit", ".exit"):
+            return False
+        if name == ".help":
+            self.output(HELP)
+        elif name == ".tables":
+            self.output("\n".join(self.tables()))
+        elif name == ".limit":
+            self.runner.limit = None if argument in ("", "off") else int(argument)
+            self.output(f"Limit: {self.runner.limit or 'off'}")
+        elif name == ".output":
+            if argument not in ("", "off"):
+                export_format(argument)
+            self.runner.output = None if argument in ("", "off") else argument
+            self.output(f"Output: {self.runner.output or 'off'}")
+        elif name == ".cache":
+            self.runner.cache = argument != "off"
+            self.output(f"Cache: {'on' if self.runner.cache else 'off'}")
+        else:
+            self.output(f"Unknown command {name}, see .help")
+        return True
+
+    def tables(self) -> List[str]:
+        if self.runner.parquet_dir is not None:
+            return list(parquet_tables(self.runner.parquet_dir))
+        return inspect(self.runner.engine).get_table_names()
+
+    def run(self, history: Optional[History] = None) -> None:
+        session: PromptSession = PromptSession(history=history or InMemoryHistory())
+        self.output("Type .help for the commands, end SQL statements with ;")
+        while True:
+            try:
+                line = session.prompt(self.prompt)
+            except KeyboardInterrupt:
+                self.lines = []
+                continue
+            except EOFError:
+                break
+            try:
+                if not self.feed(line):
+                    break
+            except ValueError as e:
+                self.output(f"Error: {e}")
+
+
+def run_shell(runner: QueryRunner, history_path: str = HISTORY_PATH) -> None:
+    os.makedirs(os.path.dirname(history_path) or ".", exist_ok=True)
+    QueryShell(runner).run(FileHistory(history_path))
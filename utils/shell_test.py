@@ -0,0 +1,56 @@
+import polars as pl
+
+from utils.shell import QueryShell
+
+
+class StubRunner:
+    def __init__(self):
+        self.queries = []
+        self.limit = None
+        self.output = None
+        self.cache = True
+        self.parquet_dir = None
+
+    def execute(self, sql):
+        self.queries.append(sql)
+        return pl.DataFrame({"n": [1]})
+
+    def ask(self, question):
+        self.queries.append(("?", question))
+        return None
+
+
+def make_shell():
+    printed = []
+    return QueryShell(StubRunner(), printed.append), printed
+
+
+def test_statements_span_lines():
+    shell, printed = make_shell()
+    assert shell.feed("SELECT count(*)")
+    assert shell.prompt == "...> "
+    assert shell.feed("FROM casts;")
+    assert shell.runner.queries == ["SELECT count(*)\nFROM casts;"]
+    assert shell.prompt == "warpy> "
+    assert printed[-1].endswith("s)")  # Timing of the query
+
+
+def test_questions_and_commands():
+    shell, printed = make_shell()
+    shell.feed("? how many casts")
+    assert shell.runner.queries == [("?", "how many casts")]
+
+    shell.feed(".limit 10")
+    assert shell.runner.limit == 10
+    shell.feed(".output result.parquet")
+    assert shell.runner.output == "result.parquet"
+    shell.feed(".cache off")
+    assert not shell.runner.cache
+    assert not shell.feed(".quit")
+
+
+def test_errors_keep_the_shell_running():
+    shell, printed = make_shell()
+    shell.runner.execute = lambda sql: 1 / 0
+    assert shell.feed("SELECT 1;")
+    assert printed == ["Error: division by zero"]
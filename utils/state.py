@@ -0,0 +1,103 @@
+import uuid
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection
+
+from utils.types import HexString
+
+# Bookkeeping tables of warpy itself, kept out of utils/models.py so they
+# are neither part of the query prompt nor of the packaged datasets. Their
+# names start with INTERNAL_TABLE_PREFIX.
+INTERNAL_TABLE_PREFIX = "warpy_"
+
+internal_metadata = MetaData()
+
+warpy_state = Table(
+    "warpy_state",
+    internal_metadata,
+    Column("key", String, primary_key=True, nullable=False),
+    Column("value", String, nullable=False),
+)
+
+# The SQL of questions asked in natural language, see utils/query.py
+warpy_nl_queries = Table(
+    "warpy_nl_queries",
+    internal_metadata,
+    Column("prompt_hash", String, primary_key=True, nullable=False),
+    Column("question", String, primary_key=True, nullable=False),
+    Column("sql", String, nullable=False),
+)
+
+# The address of every user when associations were last built, to find the
+# users whose address changed since, see indexer/user_eth_association.py
+warpy_user_addresses = Table(
+    "warpy_user_addresses",
+    internal_metadata,
+    Column("fid", Integer, primary_key=True, nullable=False),
+    Column("address", HexString, nullable=True),
+)
+
+
+def create_internal_tables(connection: Connection) -> None:
+    """Run by migrate(), the functions below expect the tables to exist."""
+    internal_metadata.create_all(connection)
+
+
+def get_state(
+    connection: Connection, key: str, default: Optional[str] = None
+) -> Optional[str]:
+    value = connection.execute(
+        select(warpy_state.c.value).where(warpy_state.c.key == key)
+    ).scalar()
+    return default if value is None else value
+
+
+def set_state(connection: Connection, key: str, value: str) -> None:
+    statement = sqlite_insert(warpy_state).values(key=key, value=value)
+    connection.execute(
+        statement.on_conflict_do_update(
+            index_elements=[warpy_state.c.key], set_={"value": value}
+        )
+    )
+
+
+def data_version_key(table_name: str) -> str:
+    return f"data_version.{table_name}"
+
+
+def bump_data_versions(connection: Connection, table_names: Iterable[str]) -> None:
+    """
+    Marks the data of the tables as changed, invalidating the cached results
+    of the queries reading them. Writers call it in their transaction.
+    """
+    for table_name in set(table_names):
+        set_state(connection, data_version_key(table_name), uuid.uuid4().hex)
+
+
+def add_data_versions(connection: Connection, table_names: Iterable[str]) -> None:
+    """Gives the tables without a data version one, run along their creation."""
+    for table_name in set(table_names):
+        statement = sqlite_insert(warpy_state).values(
+            key=data_version_key(table_name), value=uuid.uuid4().hex
+        )
+        connection.execute(
+            statement.on_conflict_do_nothing(index_elements=[warpy_state.c.key])
+        )
+
+
+def get_data_versions(
+    connection: Connection, table_names: Iterable[str]
+) -> Dict[str, str]:
+    """
+    The data version of the tables which have one, read without writing.
+    Versions are random tokens, so two databases never share one.
+    """
+    keys = {data_version_key(table_name): table_name for table_name in table_names}
+    rows = connection.execute(
+        select(warpy_state.c.key, warpy_state.c.value).where(
+            warpy_state.c.key.in_(keys)
+        )
+    )
+    return {keys[key]: value for key, value in rows}
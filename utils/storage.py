@@ -0,0 +1,144 @@
+from typing import Any, Optional
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    Table,
+    event,
+    inspect,
+    literal_column,
+    select,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql import text
+
+from utils.db import create_sqlite_engine
+from utils.models import Base
+from utils.state import bump_data_versions, get_state, set_state, warpy_state
+from utils.types import (
+    DictionaryString,
+    bytes_to_hex,
+    compact_columns,
+    hex_to_bytes,
+    is_compact,
+)
+
+
+def _hex0x(value: Any) -> Any:
+    return bytes_to_hex(value) if isinstance(value, bytes) else value
+
+
+def _unhex0x(value: Any) -> Any:
+    if isinstance(value, str):
+        return hex_to_bytes(value.lower()) or value
+    return value
+
+
+def _register_functions(dbapi_connection, connection_record) -> None:
+    # Lets raw SQL read and filter hashes and addresses of compact databases
+    dbapi_connection.create_function("hex0x", 1, _hex0x, deterministic=True)
+    dbapi_connection.create_function("unhex0x", 1, _unhex0x, deterministic=True)
+
+
+def configure_storage(engine: Engine) -> None:
+    """
+    Must be called right after creating an engine: registers the hex0x and
+    unhex0x SQL functions and switches the models to the compact storage
+    schema if the database was converted to it.
+    """
+    event.listen(engine, "connect", _register_functions)
+    with engine.begin() as connection:
+        # Not migrated yet, the models are created with the text schema
+        storage: Optional[str] = None
+        if inspect(connection).has_table(warpy_state.name):
+            storage = get_state(connection, "storage")
+    engine.dialect.warpy_compact_storage = storage == "compact"
+
+
+def compact_schema_hint(engine: Engine) -> str:
+    """Explains the compact storage schema to someone writing raw SQL."""
+    if not is_compact(engine.dialect):
+        return ""
+
+    codes = []
+    for table, columns in compact_columns(Base.metadata).items():
+        for name, column_type in columns.items():
+            if isinstance(column_type, DictionaryString):
+                mapping = ", ".join(
+                    f"{code}={value}"
+                    for code, value in enumerate(column_type.vocabulary)
+                )
+                codes.append(f"{table}.{name} ({mapping})")
+
+    return (
+        "Hash and address columns are stored as BLOBs, compare them with "
+        "unhex0x('0x...'). These columns are stored as integer codes, other "
+        f"values as text: {'; '.join(codes)}."
+    )
+
+
+def convert_to_compact(engine: Engine, chunk_size: int = 50000) -> None:
+    """
+    Rewrites every table with hash, address or dictionary columns in the
+    compact storage schema, normalizing hex values to lowercase on the way,
+    then vacuums the database. Engines created before the conversion must
+    be recreated.
+    """
+    with engine.begin() as connection:
+        if get_state(connection, "storage") == "compact":
+            print("The database already uses the compact storage schema.")
+            return
+
+    # A fresh engine, types already compiled for text storage are cached
+    compact_engine = create_sqlite_engine(engine.url, "bulk")
+    compact_engine.dialect.warpy_compact_storage = True
+
+    existing_tables = set(inspect(compact_engine).get_table_names())
+    tables = [
+        table
+        for table in Base.metadata.sorted_tables
+        if table.name in compact_columns(Base.metadata)
+        and table.name in existing_tables
+    ]
+
+    with compact_engine.begin() as connection:
+        for table in tables:
+            print(f"Compacting {table.name}...")
+            staging_name = f"{table.name}__compact"
+            ddl = str(CreateTable(table).compile(compact_engine)).replace(
+                f"CREATE TABLE {table.name} (", f"CREATE TABLE {staging_name} (", 1
+            )
+            connection.execute(text(ddl))
+
+            staging = Table(
+                staging_name,
+                MetaData(),
+                Column("rowid", Integer),
+                *[Column(column.name, column.type) for column in table.columns],
+            )
+            # Lowercasing can make primary keys collide, keep the first row
+            insert = staging.insert().prefix_with("OR IGNORE")
+            # Rowids are kept, incremental indexers use them as watermarks
+            rowid = literal_column(f"{table.name}.rowid", Integer).label("rowid")
+            result = connection.execute(select(rowid, *table.columns))
+            for rows in result.partitions(chunk_size):
+                connection.execute(insert, [dict(row._mapping) for row in rows])
+
+            connection.execute(text(f"DROP TABLE {table.name}"))
+            connection.execute(
+                text(f"ALTER TABLE {staging_name} RENAME TO {table.name}")
+            )
+            for index in table.indexes:
+                index.create(connection)
+
+        bump_data_versions(connection, [table.name for table in tables])
+        set_state(connection, "storage", "compact")
+
+    with compact_engine.connect() as connection:
+        print("Vacuuming...")
+        connection.execution_options(isolation_level="AUTOCOMMIT").execute(
+            text("VACUUM")
+        )
+    compact_engine.dispose()
@@ -0,0 +1,132 @@
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from utils.migrations import migrate
+from utils.models import EthTransaction, Reaction, User
+from utils.query import execute_raw_sql
+from utils.storage import configure_storage, convert_to_compact
+from utils.types import DictionaryString, dictionary_result_columns, is_compact
+
+HASH = "0x" + "ab" * 32
+ADDRESS = "0x" + "cd" * 20
+MIXED_CASE_ADDRESS = "0x" + "Cd" * 20
+
+
+@pytest.fixture
+def db_url():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        yield f"sqlite:///{os.path.join(tmpdirname, 'test.db')}"
+
+
+def make_engine(db_url: str):
+    engine = create_engine(db_url)
+    configure_storage(engine)
+    return engine
+
+
+def populate(engine):
+    with sessionmaker(bind=engine)() as session:
+        session.add_all(
+            [
+                User(
+                    fid=1,
+                    display_name="one",
+                    following_count=0,
+                    follower_count=0,
+                    verified=0,
+                    generated_farcaster_address="",
+                    address=MIXED_CASE_ADDRESS,
+                ),
+                Reaction(
+                    hash=HASH,
+                    reaction_type="like",
+                    timestamp=1,
+                    target_hash=HASH,
+                    author_fid=1,
+                ),
+                EthTransaction(
+                    unique_id="0x1:log:1",
+                    hash=HASH,
+                    timestamp=1,
+                    block_num=1,
+                    from_address=ADDRESS,
+                    to_address=None,
+                    asset="SOMETOKEN",
+                    category="erc20",
+                ),
+            ]
+        )
+        session.commit()
+
+
+def test_text_storage_normalizes_case(db_url):
+    engine = make_engine(db_url)
+    migrate(engine)
+    populate(engine)
+
+    assert not is_compact(engine.dialect)
+    with engine.connect() as connection:
+        stored = connection.execute(text("SELECT address FROM users")).scalar()
+    assert stored == ADDRESS
+
+
+def test_convert_to_compact(db_url):
+    engine = make_engine(db_url)
+    migrate(engine)
+    populate(engine)
+
+    with engine.connect() as connection:
+        rowids = connection.execute(text("SELECT rowid FROM eth_transactions")).all()
+
+    convert_to_compact(engine)
+    engine = make_engine(db_url)
+    assert is_compact(engine.dialect)
+
+    with engine.connect() as connection:
+        stored = connection.execute(
+            text(
+                "SELECT typeof(hash), length(hash), typeof(category), "
+                "typeof(asset), typeof(from_address), typeof(to_address) "
+                "FROM eth_transactions"
+            )
+        ).fetchone()
+    assert tuple(stored) == ("blob", 32, "integer", "text", "blob", "null")
+    with engine.connect() as connection:
+        assert (
+            connection.execute(text("SELECT rowid FROM eth_transactions")).all()
+            == rowids
+        )
+
+    with sessionmaker(bind=engine)() as session:
+        transaction = session.query(EthTransaction).one()
+        assert transaction.hash == HASH
+        assert transaction.category == "erc20"
+        assert transaction.asset == "SOMETOKEN"
+        assert session.query(Reaction).one().reaction_type == "like"
+        # Binds are converted as well, whatever the case
+        user = session.query(User).filter(User.address == MIXED_CASE_ADDRESS)
+        assert user.one().fid == 1
+
+    df = execute_raw_sql(
+        engine,
+        f"SELECT hash, category FROM eth_transactions "
+        f"WHERE from_address = unhex0x('{ADDRESS}')",
+    )
+    assert df.to_dicts() == [{"hash": HASH, "category": "erc20"}]
+
+
+def test_dictionary_result_columns_skips_ambiguous_names():
+    metadata = MetaData()
+    Table("a", metadata, Column("kind", DictionaryString(["x", "y"])))
+    Table("b", metadata, Column("kind", DictionaryString(["z"])))
+    Table("c", metadata, Column("label", DictionaryString(["x"])))
+    Table("d", metadata, Column("state", DictionaryString(["x"])))
+    Table("e", metadata, Column("state", Integer))
+
+    types, ambiguous = dictionary_result_columns(metadata)
+    assert list(types) == ["label"]
+    assert ambiguous == {"kind", "state"}
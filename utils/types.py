@@ -0,0 +1,151 @@
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import String
+from sqlalchemy.engine import Dialect
+from sqlalchemy.types import TypeDecorator, UserDefinedType
+
+
+def is_compact(dialect: Dialect) -> bool:
+    """Whether the engine of `dialect` uses the compact storage schema."""
+    return getattr(dialect, "warpy_compact_storage", False)
+
+
+class Blob(UserDefinedType):
+    """
+    A column without type affinity: SQLite stores BLOBs, integers and text
+    as given, and values are passed to and from the driver untouched.
+    """
+
+    cache_ok = True
+
+    def get_col_spec(self, **kw) -> str:
+        return "BLOB"
+
+
+def hex_to_bytes(value: str) -> Optional[bytes]:
+    """'0xAbC1' -> b'\\xab\\xc1', None if `value` isn't 0x-prefixed hex."""
+    if not value.startswith("0x") or len(value) % 2:
+        return None
+    try:
+        return bytes.fromhex(value[2:])
+    except ValueError:
+        return None
+
+
+def bytes_to_hex(value: bytes) -> str:
+    return "0x" + value.hex()
+
+
+class HexString(TypeDecorator):
+    """
+    0x-prefixed hashes and addresses. Always stored lowercase so joins
+    between tables match, and as fixed-width BLOBs on compact databases.
+    Values that aren't valid hex are stored as text either way.
+    """
+
+    impl = String
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect: Dialect):
+        if is_compact(dialect):
+            return dialect.type_descriptor(Blob())
+        return dialect.type_descriptor(String())
+
+    def process_bind_param(self, value: Optional[str], dialect: Dialect) -> Any:
+        if value is None:
+            return None
+        value = value.lower()
+        if is_compact(dialect):
+            return hex_to_bytes(value) or value
+        return value
+
+    def process_result_value(self, value: Any, dialect: Dialect) -> Optional[str]:
+        if isinstance(value, bytes):
+            return bytes_to_hex(value)
+        return value
+
+
+class DictionaryString(TypeDecorator):
+    """
+    Low-cardinality strings. Compact databases store the position of a
+    value in `vocabulary` instead of its text, values outside of the
+    vocabulary are stored as text.
+    """
+
+    impl = String
+    cache_ok = True
+
+    def __init__(self, vocabulary: Sequence[str], *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.vocabulary = tuple(vocabulary)
+        self.codes = {value: code for code, value in enumerate(self.vocabulary)}
+
+    def load_dialect_impl(self, dialect: Dialect):
+        if is_compact(dialect):
+            # Codes are stored as integers and other values as text
+            return dialect.type_descriptor(Blob())
+        return dialect.type_descriptor(String())
+
+    def process_bind_param(self, value: Optional[str], dialect: Dialect) -> Any:
+        if value is not None and is_compact(dialect):
+            return self.codes.get(value, value)
+        return value
+
+    def process_result_value(self, value: Any, dialect: Dialect) -> Optional[str]:
+        return self.decode(value)
+
+    def decode(self, value: Any) -> Optional[str]:
+        if isinstance(value, int) and 0 <= value < len(self.vocabulary):
+            return self.vocabulary[value]
+        return value
+
+
+def compact_columns(metadata) -> Dict[str, Dict[str, TypeDecorator]]:
+    """Columns with a compact representation, by table and column name."""
+    columns: Dict[str, Dict[str, TypeDecorator]] = {}
+    for table in metadata.sorted_tables:
+        for column in table.columns:
+            if isinstance(column.type, (HexString, DictionaryString)):
+                columns.setdefault(table.name, {})[column.name] = column.type
+    return columns
+
+
+def dictionary_result_columns(
+    metadata,
+) -> Tuple[Dict[str, "DictionaryString"], Set[str]]:
+    """
+    The dictionary columns a raw SQL result column can be decoded as, by
+    name, and the names that are ambiguous: shared by columns of other
+    vocabularies or by plain columns, so a result can't tell which it is.
+    """
+    by_name: Dict[str, Set[Optional[Tuple[str, ...]]]] = {}
+    types: Dict[str, DictionaryString] = {}
+    for table in metadata.sorted_tables:
+        for column in table.columns:
+            vocabulary = None
+            if isinstance(column.type, DictionaryString):
+                vocabulary = column.type.vocabulary
+                types[column.name] = column.type
+            by_name.setdefault(column.name, set()).add(vocabulary)
+    ambiguous = {name for name in types if len(by_name[name]) > 1}
+    return (
+        {
+            name: column_type
+            for name, column_type in types.items()
+            if name not in ambiguous
+        },
+        ambiguous,
+    )
+
+
+def decode_column(column_type: Optional[TypeDecorator], values: List[Any]) -> List[Any]:
+    """
+    Turns raw values read outside of the ORM back into their text form:
+    BLOBs become 0x-prefixed hex, dictionary codes of a known column
+    (`column_type`) become their strings.
+    """
+    if isinstance(column_type, DictionaryString):
+        return [column_type.decode(value) for value in values]
+    return [
+        bytes_to_hex(value) if isinstance(value, bytes) else value for value in values
+    ]
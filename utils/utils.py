@@ -1,9 +1,15 @@
 import datetime
-from typing import List, Optional, Type
+from typing import Any, Dict, List, Optional, Type
 
+from sqlalchemy import Table
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 
 from utils.models import Base, Cast, User
+from utils.state import bump_data_versions
+
+# Rows given to the driver at a time by bulk_insert_ignore
+BULK_INSERT_CHUNK_SIZE = 10000
 
 
 def save_objects(session: Session, models: List[Type[Base]]):
@@ -11,9 +17,31 @@ def save_objects(session: Session, models: List[Type[Base]]):
         return
 
     [session.merge(obj) for obj in models]
+    bump_data_versions(session.connection(), (model.__table__.name for model in models))
     session.commit()
 
 
+def bulk_insert_ignore(
+    session: Session, table: Table, rows: List[Dict[str, Any]]
+) -> int:
+    """
+    Inserts rows with a single INSERT ... ON CONFLICT DO NOTHING statement,
+    compiled once and executed for chunks of rows, so rows clashing with a
+    primary or unique key are skipped without querying for them first.
+    Returns the number of rows inserted. Doesn't commit.
+    """
+    if not rows:
+        return 0
+
+    connection = session.connection()
+    statement = sqlite_insert(table).on_conflict_do_nothing()
+    inserted = 0
+    for i in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+        chunk = rows[i : i + BULK_INSERT_CHUNK_SIZE]  # noqa: E203
+        inserted += connection.execute(statement, chunk).rowcount
+    return inserted
+
+
 def save_casts_to_sqlite(session, casts: List[Cast], timestamp: int) -> None:
     TOTAL_DAYS = 3
 
@@ -31,6 +59,7 @@ def save_casts_to_sqlite(session, casts: List[Cast], timestamp: int) -> None:
 
     if new_casts:
         session.bulk_save_objects(new_casts)
+        bump_data_versions(session.connection(), [Cast.__tablename__])
         session.commit()
 
 
@@ -64,4 +93,5 @@ def update_users_warpcast(session: Session, user_list: List[User]) -> None:
         else:
             session.add(user)
 
+    bump_data_versions(session.connection(), [User.__tablename__])
     session.commit()
@@ -0,0 +1,240 @@
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    inspect,
+    literal_column,
+    select,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import ColumnElement
+
+from utils.models import Cast, User
+from utils.state import (
+    add_data_versions,
+    bump_data_versions,
+    get_data_versions,
+    get_state,
+    set_state,
+    warpy_state,
+)
+
+# Materialized views are plain tables, queried like the models' ones
+VIEW_TABLE_PREFIX = "mv_"
+
+views_metadata = MetaData()
+
+
+class Aggregate(NamedTuple):
+    expression: ColumnElement
+    # How two partial results combine in incremental views: "sum", "min"
+    # or "max"
+    merge: Optional[str] = "sum"
+
+
+class MaterializedView(NamedTuple):
+    table: Table
+    source: Table
+    group_by: Dict[str, ColumnElement]
+    aggregates: Dict[str, Aggregate]
+    where: List[ColumnElement]
+    # Shown to the LLM, so questions it matches become lookups in the view
+    description: str
+    # Rows are only ever appended to the source, the new ones are merged
+    # into the view by rowid. Otherwise the view is recomputed whenever the
+    # source's data version changes.
+    incremental: bool
+
+
+def day_of(timestamp: ColumnElement) -> ColumnElement:
+    """'YYYY-MM-DD' of a unix ms timestamp, in UTC."""
+    return func.strftime("%Y-%m-%d", timestamp / 1000, "unixepoch", type_=String)
+
+
+def materialized_view(
+    name: str,
+    source: Table,
+    group_by: Dict[str, ColumnElement],
+    aggregates: Dict[str, Aggregate],
+    description: str,
+    where: Optional[List[ColumnElement]] = None,
+    incremental: bool = False,
+) -> MaterializedView:
+    if incremental and not all(aggregate.merge for aggregate in aggregates.values()):
+        raise ValueError(f"The aggregates of {name} can't be merged incrementally")
+    table = Table(
+        f"{VIEW_TABLE_PREFIX}{name}",
+        views_metadata,
+        *[
+            Column(column, expression.type, primary_key=True)
+            for column, expression in group_by.items()
+        ],
+        *[Column(column, Integer) for column in aggregates],
+    )
+    return MaterializedView(
+        table, source, group_by, aggregates, where or [], description, incremental
+    )
+
+
+VIEWS = [
+    materialized_view(
+        "daily_casts",
+        Cast.__table__,
+        {"day": day_of(Cast.timestamp)},
+        {"casts": Aggregate(func.count())},
+        "number of casts per UTC day (YYYY-MM-DD)",
+        incremental=True,
+    ),
+    materialized_view(
+        "caster_stats",
+        Cast.__table__,
+        {"author_fid": Cast.author_fid},
+        {
+            "casts": Aggregate(func.count()),
+            "first_cast_at": Aggregate(func.min(Cast.timestamp), "min"),
+            "last_cast_at": Aggregate(func.max(Cast.timestamp), "max"),
+        },
+        "number of casts and first and last cast timestamps of every author",
+        incremental=True,
+    ),
+    materialized_view(
+        "daily_registrations",
+        User.__table__,
+        {"day": day_of(User.registered_at)},
+        {"users": Aggregate(func.count())},
+        "number of users registered per UTC day (YYYY-MM-DD)",
+        where=[User.registered_at > 0],
+    ),
+    materialized_view(
+        "location_stats",
+        User.__table__,
+        {"location_id": User.location_id},
+        {
+            "users": Aggregate(func.count()),
+            "total_followers": Aggregate(func.sum(User.follower_count)),
+            "max_followers": Aggregate(func.max(User.follower_count), "max"),
+            # SQLite returns the other columns of the row holding the max()
+            "most_followed_fid": Aggregate(User.fid, None),
+        },
+        "users, their total followers and the most followed user (fid, "
+        "max_followers) of every locations.id",
+        where=[User.location_id.isnot(None)],
+    ),
+]
+
+
+def watermark_key(view: MaterializedView) -> str:
+    return f"views.{view.table.name}.rowid"
+
+
+def version_key(view: MaterializedView) -> str:
+    return f"views.{view.table.name}.source_version"
+
+
+def aggregate_select(view: MaterializedView, *criteria):
+    return (
+        select(
+            *[expression.label(name) for name, expression in view.group_by.items()],
+            *[
+                aggregate.expression.label(name)
+                for name, aggregate in view.aggregates.items()
+            ],
+        )
+        .where(*view.where, *criteria)
+        .group_by(*view.group_by.values())
+    )
+
+
+def merge_rows(connection: Connection, view: MaterializedView, rows) -> None:
+    """Adds aggregated rows to the view, combining those of existing groups."""
+    statement = sqlite_insert(view.table).from_select(
+        [*view.group_by, *view.aggregates], rows
+    )
+    merged = {}
+    for name, aggregate in view.aggregates.items():
+        current, new = view.table.c[name], statement.excluded[name]
+        if aggregate.merge == "sum":
+            merged[name] = current + new
+        elif aggregate.merge is not None:
+            # SQLite's min() and max() of several arguments are scalar
+            merged[name] = getattr(func, aggregate.merge)(current, new)
+    connection.execute(
+        statement.on_conflict_do_update(index_elements=list(view.group_by), set_=merged)
+    )
+
+
+def refresh_view(connection: Connection, view: MaterializedView) -> bool:
+    """
+    Brings `view` up to date with its source table, returns whether it
+    changed. Incremental views keep counting the rows archived from their
+    source.
+    """
+    view.table.create(connection, checkfirst=True)
+
+    if view.incremental:
+        rowid = literal_column(f"{view.source.name}.rowid", Integer)
+        watermark = int(get_state(connection, watermark_key(view)) or 0)
+        head = connection.execute(
+            select(func.max(rowid)).select_from(view.source)
+        ).scalar()
+        if not head or head <= watermark:
+            return False
+        merge_rows(
+            connection, view, aggregate_select(view, rowid > watermark, rowid <= head)
+        )
+        set_state(connection, watermark_key(view), str(head))
+    else:
+        add_data_versions(connection, [view.source.name])
+        version = get_data_versions(connection, [view.source.name])[view.source.name]
+        if get_state(connection, version_key(view)) == version:
+            return False
+        connection.execute(view.table.delete())
+        connection.execute(
+            view.table.insert().from_select(
+                [*view.group_by, *view.aggregates], aggregate_select(view)
+            )
+        )
+        set_state(connection, version_key(view), version)
+
+    bump_data_versions(connection, [view.table.name])
+    return True
+
+
+def refresh_views(engine: Engine) -> None:
+    for view in VIEWS:
+        with engine.begin() as connection:
+            if refresh_view(connection, view):
+                print(f"Refreshed {view.table.name}")
+
+
+def reset_views(connection: Connection) -> None:
+    """Empties the views, for when their sources were replaced."""
+    for view in VIEWS:
+        view.table.drop(connection, checkfirst=True)
+        connection.execute(
+            warpy_state.delete().where(
+                warpy_state.c.key.in_([watermark_key(view), version_key(view)])
+            )
+        )
+
+
+def views_schema_hint(engine: Engine) -> str:
+    """Describes the views to someone writing SQL, so they use them."""
+    existing = set(inspect(engine).get_table_names())
+    views = "; ".join(
+        f"{view.table.name}({', '.join(view.table.c.keys())}): {view.description}"
+        for view in VIEWS
+        if view.table.name in existing
+    )
+    if not views:
+        return ""
+    return (
+        "These precomputed tables answer common questions without scanning "
+        f"the others, use them when they can: {views}."
+    )
@@ -0,0 +1,97 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils.migrations import migrate
+from utils.state import bump_data_versions
+from utils.views import VIEWS, refresh_views, reset_views, views_schema_hint
+
+DAY = 86400000
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite:///:memory:")
+    migrate(engine)
+    return engine
+
+
+def insert_casts(engine, *casts):
+    with engine.begin() as connection:
+        for i, (timestamp, author_fid) in enumerate(casts):
+            connection.execute(
+                text(
+                    "INSERT INTO casts (hash, thread_hash, text, timestamp, author_fid) "
+                    "VALUES (:hash, :hash, '', :timestamp, :author_fid)"
+                ),
+                {
+                    "hash": f"0x{timestamp:x}{i}",
+                    "timestamp": timestamp,
+                    "author_fid": 1,
+                },
+            )
+
+
+def insert_user(engine, fid, registered_at, location_id, follower_count):
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "INSERT OR REPLACE INTO users (fid, display_name, following_count, "
+                "follower_count, verified, generated_farcaster_address, "
+                "registered_at, location_id) VALUES (:fid, '', 0, :follower_count, "
+                "0, '', :registered_at, :location_id)"
+            ),
+            locals(),
+        )
+        bump_data_versions(connection, ["users"])
+
+
+def rows(engine, table):
+    with engine.connect() as connection:
+        return [
+            tuple(row) for row in connection.execute(text(f"SELECT * FROM {table}"))
+        ]
+
+
+def test_casts_views_merge_new_rows(engine):
+    insert_casts(engine, (0, 1), (DAY, 1))
+    refresh_views(engine)
+    insert_casts(engine, (DAY + 1, 1), (3 * DAY, 1))
+    refresh_views(engine)
+
+    assert rows(engine, "mv_daily_casts") == [
+        ("1970-01-01", 1),
+        ("1970-01-02", 2),
+        ("1970-01-04", 1),
+    ]
+    assert rows(engine, "mv_caster_stats") == [(1, 4, 0, 3 * DAY)]
+
+
+def test_users_views_are_recomputed(engine):
+    insert_user(engine, 1, DAY, "nyc", 10)
+    insert_user(engine, 2, DAY, "nyc", 30)
+    refresh_views(engine)
+    assert rows(engine, "mv_location_stats") == [("nyc", 2, 40, 30, 2)]
+
+    # Users are updated in place
+    insert_user(engine, 2, 2 * DAY, "sf", 30)
+    refresh_views(engine)
+    assert rows(engine, "mv_location_stats") == [
+        ("nyc", 1, 10, 10, 1),
+        ("sf", 1, 30, 30, 2),
+    ]
+    assert rows(engine, "mv_daily_registrations") == [
+        ("1970-01-02", 1),
+        ("1970-01-03", 1),
+    ]
+
+
+def test_reset_views(engine):
+    insert_casts(engine, (0, 1))
+    refresh_views(engine)
+    with engine.begin() as connection:
+        reset_views(connection)
+    assert views_schema_hint(engine) == ""
+
+    refresh_views(engine)
+    assert rows(engine, "mv_daily_casts") == [("1970-01-01", 1)]
+    assert all(view.table.name in views_schema_hint(engine) for view in VIEWS)
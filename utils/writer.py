@@ -0,0 +1,137 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+
+Job = Callable[[Session], Any]
+
+
+class _BatchSession(Session):
+    """Commits of the jobs only flush, the writer commits once per batch."""
+
+    def commit(self) -> None:
+        self.flush()
+
+    def commit_batch(self) -> None:
+        super().commit()
+
+
+class DatabaseWriter:
+    """
+    Serializes the writes of concurrently running indexers: jobs, functions
+    taking a session, are queued from any thread or coroutine and run one
+    after another by a single writer thread holding the only write session.
+    Jobs queued together are committed in one transaction, a job's future
+    resolves once its writes are committed. With WAL, reads from other
+    sessions never wait on the writer.
+    """
+
+    def __init__(self, engine: Engine, max_batch: int = 100):
+        self.session = sessionmaker(bind=engine, class_=_BatchSession)()
+        self.max_batch = max_batch
+        self.queue: "queue.Queue[Optional[Tuple[Job, Future]]]" = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, job: Job) -> Future:
+        if not self.thread.is_alive():
+            raise RuntimeError("The database writer is closed")
+        future: Future = Future()
+        self.queue.put((job, future))
+        return future
+
+    def write(self, job: Job) -> Any:
+        """Runs `job` and waits for its writes to be committed."""
+        return self.submit(job).result()
+
+    async def run(self, job: Job) -> Any:
+        """Like write, without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(job))
+
+    def close(self) -> None:
+        """Waits for the queued jobs to be committed, then stops the writer."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def __enter__(self) -> "DatabaseWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _next_batch(self) -> Tuple[List[Tuple[Job, Future]], bool]:
+        batch = [self.queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in batch
+        return [item for item in batch if item is not None], stop
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if batch:
+                self._write_batch(batch)
+        self.session.close()
+
+    def _write_batch(self, batch: List[Tuple[Job, Future]]) -> None:
+        # Jobs cancelled while queued are dropped
+        batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if len(batch) == 1:
+            job, future = batch[0]
+            try:
+                future.set_result(self._write_single(job))
+            except Exception as e:
+                future.set_exception(e)
+            return
+
+        try:
+            results = [job(self.session) for job, _ in batch]
+            self.session.commit_batch()
+        except Exception:
+            self.session.rollback()
+            self.session.expunge_all()
+            # Retry the jobs one by one so only the failing one fails
+            for job, future in batch:
+                try:
+                    future.set_result(self._write_single(job))
+                except Exception as e:
+                    future.set_exception(e)
+            return
+
+        # Bound the identity map, jobs share the session for the whole run
+        self.session.expunge_all()
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _write_single(self, job: Job) -> Any:
+        try:
+            result = job(self.session)
+            self.session.commit_batch()
+            return result
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.expunge_all()
+
+
+@contextmanager
+def shared_writer(
+    engine: Engine, writer: Optional[DatabaseWriter]
+) -> Iterator[DatabaseWriter]:
+    """`writer` when given, else a writer of its own closed on exit."""
+    if writer is not None:
+        yield writer
+        return
+    with DatabaseWriter(engine) as writer:
+        yield writer
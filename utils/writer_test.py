@@ -0,0 +1,86 @@
+import asyncio
+import os
+import tempfile
+import threading
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from utils.db import create_sqlite_engine
+from utils.models import Base, Location
+from utils.writer import DatabaseWriter
+
+
+@pytest.fixture
+def test_engine():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        engine = create_sqlite_engine(
+            f"sqlite:///{os.path.join(tmpdirname, 'test.db')}", "bulk"
+        )
+        Base.metadata.create_all(engine)
+        yield engine
+
+
+def add_location(id: str):
+    def job(session):
+        session.add(Location(id=id, description=id))
+        session.commit()  # Deferred to the end of the batch
+        return id
+
+    return job
+
+
+def locations(engine):
+    with sessionmaker(bind=engine)() as session:
+        return sorted(location.id for location in session.query(Location))
+
+
+def test_writer_serializes_threads_and_coroutines(test_engine):
+    commits = []
+    event.listen(test_engine, "commit", lambda connection: commits.append(1))
+
+    with DatabaseWriter(test_engine) as writer:
+        started = threading.Event()
+        # Jobs queued while the writer is busy are committed together
+        writer.submit(lambda session: started.wait(5))
+
+        threads = [
+            threading.Thread(target=writer.submit, args=(add_location(f"t{i}"),))
+            for i in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        async def write_from_coroutines():
+            return await asyncio.gather(
+                *[writer.run(add_location(f"c{i}")) for i in range(20)]
+            )
+
+        started.set()
+        results = asyncio.run(write_from_coroutines())
+
+    assert results == [f"c{i}" for i in range(20)]
+    assert len(locations(test_engine)) == 40
+    assert len(commits) < 40
+
+
+def test_writer_isolates_failing_jobs(test_engine):
+    with DatabaseWriter(test_engine) as writer:
+        started = threading.Event()
+        writer.submit(lambda session: started.wait(5))
+        first = writer.submit(add_location("a"))
+        duplicate = writer.submit(add_location("a"))
+        last = writer.submit(add_location("b"))
+        started.set()
+
+        assert first.result() == "a"
+        assert last.result() == "b"
+        with pytest.raises(Exception):
+            duplicate.result()
+
+    assert locations(test_engine) == ["a", "b"]
+    with pytest.raises(RuntimeError):
+        writer.submit(add_location("c"))